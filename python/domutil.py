@@ -17,7 +17,180 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import xml
+import xml.dom
+import xml.parsers.expat
 from xml.dom import minidom
+try:
+	from xml.etree import cElementTree as ElementTree
+except ImportError:
+	from xml.etree import ElementTree
+from cStringIO import StringIO
+
+#
+# Parsed documents
+#
+# parse() and parseDocument() build the tree with ElementTree, which parses
+# in C. The tree is wrapped in light objects that offer the parts of the
+# xml.dom.minidom interface that VizStack uses - nodeName, nodeType,
+# childNodes, firstChild, nodeValue, documentElement & getElementsByTagName.
+# So code written for minidom works with these as well.
+#
+# The helper functions below accept these nodes as well as minidom nodes,
+# and take a faster path with the former.
+#
+
+class Text(object):
+	"""
+	Text inside an element.
+	"""
+	__slots__ = ['nodeValue']
+	ELEMENT_NODE = xml.dom.Node.ELEMENT_NODE
+	TEXT_NODE = xml.dom.Node.TEXT_NODE
+	nodeType = xml.dom.Node.TEXT_NODE
+	nodeName = "#text"
+	childNodes = ()
+	firstChild = None
+
+	def __init__(self, value):
+		self.nodeValue = value
+
+class Element(object):
+	"""
+	An element of a parsed document. Wraps an ElementTree element.
+	"""
+	__slots__ = ['elem']
+	ELEMENT_NODE = xml.dom.Node.ELEMENT_NODE
+	TEXT_NODE = xml.dom.Node.TEXT_NODE
+	nodeType = xml.dom.Node.ELEMENT_NODE
+	nodeValue = None
+
+	def __init__(self, elem):
+		self.elem = elem
+
+	def __getNodeName(self):
+		return self.elem.tag
+	nodeName = property(__getNodeName)
+	tagName = nodeName
+
+	def __getChildNodes(self):
+		elem = self.elem
+		ret = []
+		if elem.text is not None:
+			ret.append(Text(elem.text))
+		for child in elem:
+			ret.append(Element(child))
+			if child.tail is not None:
+				ret.append(Text(child.tail))
+		return ret
+	childNodes = property(__getChildNodes)
+
+	def __getFirstChild(self):
+		elem = self.elem
+		if elem.text is not None:
+			return Text(elem.text)
+		if len(elem)>0:
+			return Element(elem[0])
+		return None
+	firstChild = property(__getFirstChild)
+
+	def getElementsByTagName(self, name):
+		"""
+		Returns all descendants(not including this element) with the given name
+		"""
+		elem = self.elem
+		return [Element(e) for e in elem.iter(name) if e is not elem]
+
+	def getAttribute(self, name):
+		return self.elem.get(name, "")
+
+	def toxml(self):
+		return ElementTree.tostring(self.elem)
+
+class Document(object):
+	"""
+	A parsed document.
+	"""
+	__slots__ = ['documentElement']
+	ELEMENT_NODE = xml.dom.Node.ELEMENT_NODE
+	TEXT_NODE = xml.dom.Node.TEXT_NODE
+	nodeType = xml.dom.Node.DOCUMENT_NODE
+	nodeName = "#document"
+	nodeValue = None
+
+	def __init__(self, root):
+		self.documentElement = Element(root)
+
+	def __getChildNodes(self):
+		return [self.documentElement]
+	childNodes = property(__getChildNodes)
+
+	def __getFirstChild(self):
+		return self.documentElement
+	firstChild = property(__getFirstChild)
+
+	def getElementsByTagName(self, name):
+		"""
+		Returns all elements with the given name, including the document element.
+		"""
+		return [Element(e) for e in self.documentElement.elem.iter(name)]
+
+	def toxml(self):
+		return self.documentElement.toxml()
+
+def __buildTree(msg):
+	"""
+	Parse the string msg, returning the root ElementTree element.
+
+	ElementTree names elements in a namespace as {uri}name. minidom(and
+	hence all our code) uses the name as it appears in the document. Our
+	config files use a default namespace, so we fix up the names when the
+	document declares any namespaces.
+	"""
+	if msg.find('xmlns')==-1:
+		return ElementTree.fromstring(msg)
+
+	prefixes = {}
+	parser = ElementTree.iterparse(StringIO(msg), events=('start-ns',))
+	for event, (prefix, uri) in parser:
+		if not prefixes.has_key(uri):
+			prefixes[uri] = prefix
+	root = parser.root
+	for elem in root.iter():
+		tag = elem.tag
+		if tag[0]=='{':
+			uri, name = tag[1:].split('}', 1)
+			prefix = prefixes.get(uri, '')
+			if len(prefix)>0:
+				elem.tag = '%s:%s'%(prefix, name)
+			else:
+				elem.tag = name
+	return root
+
+def parse(source):
+	"""
+	Parse an XML file. source is a file name or a file object.
+	Returns a Document. Raises xml.parsers.expat.ExpatError if the file
+	is not well formed, as minidom.parse would.
+	"""
+	if isinstance(source, basestring):
+		f = open(source)
+		try:
+			msg = f.read()
+		finally:
+			f.close()
+	else:
+		msg = source.read()
+	return parseDocument(msg)
+
+def parseDocument(msg):
+	"""
+	Parse an XML string. Returns a Document. Raises xml.parsers.expat.ExpatError
+	if the string is not well formed, as minidom.parseString would.
+	"""
+	try:
+		return Document(__buildTree(msg))
+	except SyntaxError, e: # ElementTree.ParseError is a SyntaxError
+		raise xml.parsers.expat.ExpatError(str(e))
 
 def getChildNode(node, name):
 	"""
@@ -25,6 +198,11 @@ def getChildNode(node, name):
 	This will typically be used if the node has exactly one node of the
 	given name.
 	"""
+	if isinstance(node, Element):
+		for child in node.elem:
+			if child.tag == name:
+				return Element(child)
+		return None
 	if node.childNodes is None:
 		return None
 	for n in node.childNodes:
@@ -36,6 +214,8 @@ def getChildNodes(node, name):
 	"""
 	Returns all child nodes of the passed node with the given node name.
 	"""
+	if isinstance(node, Element):
+		return [Element(child) for child in node.elem if child.tag == name]
 	ret = []
 	if node.childNodes is None:
 		return ret
@@ -48,6 +228,8 @@ def getAllChildNodes(node):
 	"""
 	Return all ELEMENT_NODE children of a node
 	"""
+	if isinstance(node, Element):
+		return [Element(child) for child in node.elem]
 	ret = []
 	if node.childNodes is None:
 		return ret
@@ -59,8 +241,12 @@ def getAllChildNodes(node):
 def getValue(node):
 	# FIXME: find a way out of unicode-inconsistency.
 	# ideally we want to support unicode.
+	if isinstance(node, Element):
+		value = node.elem.text
+		if value is None:
+			raise AttributeError, "Element '%s' has no value"%(node.elem.tag)
+		return value.encode('iso-8859-1')
 	return node.firstChild.nodeValue.encode('iso-8859-1')
 
 def parseString(msg):
-	doc = xml.dom.minidom.parseString(msg)
-	return doc.documentElement
+	return parseDocument(msg).documentElement
@@ -0,0 +1,602 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Building blocks for the event driven main loop of the SSM.
+
+The SSM serves every client from a single thread. Sockets are registered
+once with a Poller, which uses epoll where available (Linux) and falls back
+to poll/select otherwise. The cost of a wakeup is then proportional to the
+number of sockets which are ready, not to the number of connected clients.
+
+Client sockets are non-blocking, and are wrapped in a MessageChannel. A
+MessageChannel assembles incoming messages as data trickles in, and queues
+outgoing messages, so one slow client can't hold up the others.
+
+Deadlines are kept in a TimerQueue, so the loop can sleep exactly till the
+earliest one.
+
+Calls which may block for a long time (e.g. running the scheduler's
+commands) are run on a WorkerPool. Their completion is reported back to
+the event loop thread through a descriptor that the loop watches.
+"""
+
+import select
+import socket
+import errno
+import heapq
+import os
+import fcntl
+import threading
+import Queue
+import sys
+import logging
+import traceback
+import vsapi
+
+# Event masks. These have the same values for select.poll and select.epoll
+# on Linux, so they can be passed through without translation.
+READ = 0x001
+WRITE = 0x004
+ERROR = 0x008
+HANGUP = 0x010
+
+class Poller:
+	"""
+	Readiness notification for a set of file descriptors.
+
+	File descriptors are registered once, and stay registered till they
+	are unregistered. poll() returns a list of (fd, eventMask) for the
+	ready descriptors only.
+	"""
+	def __init__(self):
+		self.__events = {} # fd -> event mask that we are interested in
+		if hasattr(select, 'epoll'):
+			self.__kind = 'epoll'
+			self.__impl = select.epoll()
+		elif hasattr(select, 'poll'):
+			self.__kind = 'poll'
+			self.__impl = select.poll()
+		else:
+			self.__kind = 'select'
+			self.__impl = None
+
+	def getKind(self):
+		"""
+		Return the name of the underlying mechanism - one of epoll, poll or select
+		"""
+		return self.__kind
+
+	def register(self, fd, events=READ):
+		if self.__events.has_key(fd):
+			raise ValueError, "File descriptor %d is already registered"%(fd)
+		self.__events[fd] = events
+		if self.__impl is not None:
+			self.__impl.register(fd, events)
+
+	def modify(self, fd, events):
+		if self.__events[fd] == events:
+			return
+		self.__events[fd] = events
+		if self.__impl is not None:
+			self.__impl.modify(fd, events)
+
+	def unregister(self, fd):
+		"""
+		Stop watching fd. This needs to be called _before_ the file descriptor is
+		closed; epoll forgets about closed descriptors on its own, but poll does not.
+		"""
+		try:
+			self.__events.pop(fd)
+		except KeyError:
+			return
+		if self.__impl is not None:
+			try:
+				self.__impl.unregister(fd)
+			except (IOError, OSError, KeyError):
+				pass
+
+	def isRegistered(self, fd):
+		return self.__events.has_key(fd)
+
+	def __len__(self):
+		return len(self.__events)
+
+	def poll(self, timeout=None):
+		"""
+		Wait for events. timeout is in seconds; None means wait forever.
+		Returns a list of (fd, eventMask). An interrupted wait returns an
+		empty list.
+		"""
+		try:
+			if self.__kind == 'epoll':
+				if timeout is None:
+					timeout = -1
+				return self.__impl.poll(timeout)
+			elif self.__kind == 'poll':
+				if timeout is not None:
+					timeout = int(timeout*1000)
+				return self.__impl.poll(timeout)
+			else:
+				return self.__select(timeout)
+		except (select.error, IOError, OSError), e:
+			if e.args[0] == errno.EINTR:
+				return []
+			raise
+
+	def __select(self, timeout):
+		rlist = []
+		wlist = []
+		for fd in self.__events:
+			if self.__events[fd] & READ:
+				rlist.append(fd)
+			if self.__events[fd] & WRITE:
+				wlist.append(fd)
+		rr, wr, er = select.select(rlist, wlist, [], timeout)
+		ready = {}
+		for fd in rr:
+			ready[fd] = READ
+		for fd in wr:
+			ready[fd] = ready.get(fd, 0) | WRITE
+		return ready.items()
+
+	def close(self):
+		if self.__kind == 'epoll':
+			self.__impl.close()
+		self.__impl = None
+		self.__events = {}
+
+# Errors which indicate that a non-blocking operation could not proceed
+# right away.
+_wouldBlock = [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]
+
+class MessageChannel:
+	"""
+	Non-blocking, buffered message framing over a connected socket.
+
+	Messages are framed as described in vsapi. Incoming messages may use
+	either v1 or v2 framing. Outgoing messages use v1 framing, unless
+	setFraming() says that the other end understands v2.
+
+	readMessages() returns all the messages that have been completely
+	received so far; a partially received message stays in the receive
+	buffer till the rest of it arrives. queueMessage() adds a message to
+	the send buffer, and flush() sends as much of the send buffer as the
+	socket will accept.
+	"""
+
+	# Maximum amount of data read from a socket in one readMessages() call.
+	# Leftover data is picked up on the next readiness notification, so
+	# a client that sends a lot of data can't starve the others.
+	readBudget = 256*1024
+	recvSize = 64*1024
+
+	# Queued pieces smaller than this are combined into a single send
+	coalesceSize = 64*1024
+
+	# If this much data is waiting to be sent, then we stop reading from
+	# the client till it catches up.
+	highWaterMark = 1024*1024
+
+	# Largest message we accept. Protects against runaway clients.
+	maxMessageLength = 64*1024*1024
+
+	def __init__(self, sock):
+		sock.setblocking(0)
+		self.__sock = sock
+		self.__recvChunks = [] # received data, not yet split into messages
+		self.__recvLen = 0
+		self.__recvNeeded = 0 # length of the incomplete message at the head of the received data, if known
+		self.__sendQueue = [] # messages(or parts thereof) waiting to be sent
+		self.__sendOffset = 0 # how much of the first item in __sendQueue has been sent
+		self.__pendingBytes = 0
+		self.__shutdownPending = False
+		self.__framing = vsapi.FRAMING_V1
+
+	def setFraming(self, framing):
+		"""
+		Set the framing used for outgoing messages - vsapi.FRAMING_V1 or
+		vsapi.FRAMING_V2
+		"""
+		if framing not in [vsapi.FRAMING_V1, vsapi.FRAMING_V2]:
+			raise ValueError, "Unknown framing %s"%(framing)
+		self.__framing = framing
+
+	def getFraming(self):
+		return self.__framing
+
+	def saveState(self):
+		"""
+		Return the state of the channel - the framing, data received but not
+		returned as messages yet, data queued but not sent yet, and whether
+		a shutdown is pending. The state can be restored on a channel for
+		the same connection using restoreState(), e.g. in another process.
+		"""
+		recvData = ''.join(self.__recvChunks)
+		sendData = ''.join(self.__sendQueue)[self.__sendOffset:]
+		return [self.__framing, recvData, sendData, self.__shutdownPending]
+
+	def restoreState(self, state):
+		framing, recvData, sendData, shutdownPending = state
+		self.setFraming(framing)
+		self.__recvChunks = []
+		if len(recvData)>0:
+			self.__recvChunks.append(recvData)
+		self.__recvLen = len(recvData)
+		self.__recvNeeded = 0
+		self.__sendQueue = []
+		if len(sendData)>0:
+			self.__sendQueue.append(sendData)
+		self.__sendOffset = 0
+		self.__pendingBytes = len(sendData)
+		self.__shutdownPending = shutdownPending
+
+	def getSocket(self):
+		return self.__sock
+
+	def readMessages(self):
+		"""
+		Read whatever data is available on the socket, and return a list of the
+		complete messages received. Raises VizError with NOT_CONNECTED if the
+		other end disconnected, and with BAD_PROTOCOL or SOCKET_ERROR on errors.
+
+		Messages that were completely received before a disconnect are returned;
+		the disconnect is reported on the next call.
+		"""
+		received = 0
+		disconnected = False
+		while received < self.readBudget:
+			try:
+				data = self.__sock.recv(self.recvSize)
+			except socket.error, e:
+				if e.args[0] in _wouldBlock:
+					break
+				raise vsapi.VizError(vsapi.VizError.SOCKET_ERROR, str(e))
+			if len(data)==0:
+				disconnected = True
+				break
+			self.__recvChunks.append(data)
+			self.__recvLen += len(data)
+			received += len(data)
+
+		# Don't bother joining the received data till the message at the
+		# head is complete. Large messages arrive in many pieces.
+		messages = []
+		if (self.__recvLen>0) and (self.__recvLen >= self.__recvNeeded):
+			messages = self.__parseMessages()
+
+		if disconnected and (len(messages)==0):
+			if self.__recvLen>0:
+				raise vsapi.VizError(vsapi.VizError.BAD_PROTOCOL, "Incomplete message. Socket disconnected after %d bytes"%(self.__recvLen))
+			raise vsapi.VizError(vsapi.VizError.NOT_CONNECTED, "Socket Disconnected")
+		return messages
+
+	def __parseMessages(self):
+		messages = []
+		buf = ''.join(self.__recvChunks)
+		pos = 0
+		self.__recvNeeded = 0
+		while pos < len(buf):
+			header = vsapi.decodeFrameHeader(buffer(buf, pos, vsapi.FRAME_V2_HEADER_LENGTH))
+			if header is None:
+				break
+			headerLen, dataLen = header
+			if dataLen > self.maxMessageLength:
+				raise vsapi.VizError(vsapi.VizError.BAD_PROTOCOL, "Message length = %d exceeds the maximum allowed(%d)"%(dataLen, self.maxMessageLength))
+			if len(buf)-pos < headerLen+dataLen:
+				self.__recvNeeded = headerLen+dataLen
+				break
+			messages.append(buf[pos+headerLen:pos+headerLen+dataLen])
+			pos = pos+headerLen+dataLen
+		if pos < len(buf):
+			self.__recvChunks = [buf[pos:]]
+		else:
+			self.__recvChunks = []
+		self.__recvLen = len(buf)-pos
+		return messages
+
+	def queueMessage(self, message):
+		"""
+		Add a message to the send buffer. The message is sent out by flush().
+
+		message may be a string, or a list of strings which make up the
+		message. Large messages are best passed as a list; the parts are
+		sent out one after the other, without joining them into a single
+		string.
+		"""
+		if isinstance(message, list):
+			parts = filter(lambda x: len(x)>0, message)
+		else:
+			parts = [message]
+		dataLen = sum(map(len, parts))
+		header = vsapi.encodeFrameHeader(dataLen, self.__framing)
+		self.__sendQueue.append(header)
+		self.__sendQueue += parts
+		self.__pendingBytes += len(header)+dataLen
+
+	def flush(self):
+		"""
+		Send as much of the send buffer as possible, without blocking.
+		Returns True if everything has been sent.
+		"""
+		while len(self.__sendQueue)>0:
+			data = self.__sendQueue[0]
+			# Coalesce small pieces (e.g. headers and short messages)
+			# into one send
+			if (len(self.__sendQueue)>1) and (len(data)-self.__sendOffset < self.coalesceSize):
+				nItems = 1
+				totalLen = len(data)-self.__sendOffset
+				while (nItems < len(self.__sendQueue)) and (totalLen+len(self.__sendQueue[nItems]) <= self.coalesceSize):
+					totalLen += len(self.__sendQueue[nItems])
+					nItems += 1
+				if nItems>1:
+					data = data[self.__sendOffset:] + ''.join(self.__sendQueue[1:nItems])
+					self.__sendQueue[0:nItems] = [data]
+					self.__sendOffset = 0
+			try:
+				if self.__sendOffset>0:
+					sent = self.__sock.send(buffer(data, self.__sendOffset))
+				else:
+					sent = self.__sock.send(data)
+			except socket.error, e:
+				if e.args[0] in _wouldBlock:
+					return False
+				raise vsapi.VizError(vsapi.VizError.SOCKET_ERROR, str(e))
+			self.__sendOffset += sent
+			self.__pendingBytes -= sent
+			if self.__sendOffset == len(data):
+				self.__sendQueue.pop(0)
+				self.__sendOffset = 0
+			else:
+				return False
+
+		if self.__shutdownPending:
+			self.__shutdownPending = False
+			try:
+				self.__sock.shutdown(socket.SHUT_WR)
+			except socket.error, e:
+				pass
+		return True
+
+	def shutdownWrite(self):
+		"""
+		Close our end for writing, so that the other end gets an EOF. This
+		happens after all the queued messages are sent.
+		"""
+		self.__shutdownPending = True
+		try:
+			self.flush()
+		except vsapi.VizError, e:
+			pass # the disconnect will be noticed on the next read
+
+	def hasPendingOutput(self):
+		return len(self.__sendQueue)>0
+
+	def getPendingBytes(self):
+		return self.__pendingBytes
+
+	def isCongested(self):
+		"""
+		Returns True if the client isn't consuming what we send it fast enough.
+		"""
+		return self.__pendingBytes >= self.highWaterMark
+
+	def getEventMask(self):
+		"""
+		Returns the events that we need to watch the socket for. We stop
+		reading from a congested client; when it has caught up with our
+		output, we start reading again.
+		"""
+		if self.isCongested():
+			return WRITE
+		if self.hasPendingOutput():
+			return READ|WRITE
+		return READ
+
+class TimerQueue:
+	"""
+	A set of (deadline, item) pairs, ordered by deadline.
+
+	Kept as a min-heap. Cancelled entries are left in the heap and skipped
+	when they reach the top, which keeps cancel() cheap.
+	"""
+	def __init__(self):
+		self.__heap = []
+		self.__seq = 0 # keeps items with the same deadline in FIFO order
+		self.__active = 0
+
+	def add(self, deadline, item):
+		"""
+		Add item to fire at time deadline. Returns a handle that can be passed
+		to cancel().
+		"""
+		self.__seq += 1
+		entry = [deadline, self.__seq, item, True]
+		heapq.heappush(self.__heap, entry)
+		self.__active += 1
+		return entry
+
+	def cancel(self, entry):
+		if entry[3]:
+			entry[3] = False
+			entry[2] = None
+			self.__active -= 1
+
+	def __discardCancelled(self):
+		while (len(self.__heap)>0) and (not self.__heap[0][3]):
+			heapq.heappop(self.__heap)
+
+	def nextDeadline(self):
+		"""
+		Returns the earliest deadline, or None if there are no timers.
+		"""
+		self.__discardCancelled()
+		if len(self.__heap)==0:
+			return None
+		return self.__heap[0][0]
+
+	def popExpired(self, curTime):
+		"""
+		Remove and return the items whose deadline is at or before curTime,
+		earliest first.
+		"""
+		expired = []
+		self.__discardCancelled()
+		while (len(self.__heap)>0) and (self.__heap[0][0] <= curTime):
+			entry = heapq.heappop(self.__heap)
+			entry[3] = False
+			self.__active -= 1
+			expired.append(entry[2])
+			self.__discardCancelled()
+		return expired
+
+	def getTimeout(self, curTime):
+		"""
+		Returns how long to wait (in seconds) for the earliest deadline, or None
+		if there are no timers.
+		"""
+		deadline = self.nextDeadline()
+		if deadline is None:
+			return None
+		return max(0.0, deadline - curTime)
+
+	def __len__(self):
+		return self.__active
+
+class WorkerPool:
+	"""
+	Runs blocking calls on a set of threads.
+
+	submit() queues a call. When the call finishes, the descriptor returned
+	by getNotifyFd() becomes readable. The event loop then calls
+	runCompletions(), which runs the completion callbacks of the finished
+	calls - in the event loop's thread. So the completion callbacks can
+	touch state owned by the event loop without any locking.
+
+	A completion callback which raises an exception is logged to logger,
+	and doesn't stop the completions after it from running.
+	"""
+	def __init__(self, nThreads=4, logger=None):
+		if nThreads<1:
+			raise ValueError, "Need at least one worker thread"
+		if logger is None:
+			logger = logging.getLogger("eventloop")
+		self.__logger = logger
+		self.__requests = Queue.Queue()
+		self.__completed = []
+		self.__completedLock = threading.Lock()
+		self.__outstanding = 0
+		self.__notifyRead, self.__notifyWrite = os.pipe()
+		for fd in [self.__notifyRead, self.__notifyWrite]:
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+			fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+		self.__threads = []
+		for i in range(nThreads):
+			t = threading.Thread(target=self.__worker)
+			t.setDaemon(True) # don't hold up exit
+			t.start()
+			self.__threads.append(t)
+
+	def getNotifyFd(self):
+		return self.__notifyRead
+
+	def submit(self, func, args, onComplete):
+		"""
+		Run func(*args) on a worker thread. When it is done, onComplete(result, error)
+		is called from runCompletions(). error is None if func returned normally;
+		else it is the exception that func raised, and result is None.
+		"""
+		self.__outstanding += 1
+		self.__requests.put([func, args, onComplete])
+
+	def getOutstanding(self):
+		"""
+		Number of calls whose completions haven't run yet.
+		"""
+		return self.__outstanding
+
+	def __worker(self):
+		while 1:
+			request = self.__requests.get()
+			if request is None:
+				return
+			func, args, onComplete = request
+			result = None
+			error = None
+			try:
+				result = func(*args)
+			except:
+				error = sys.exc_info()[1]
+			self.__completedLock.acquire()
+			self.__completed.append([onComplete, result, error])
+			self.__completedLock.release()
+			try:
+				os.write(self.__notifyWrite, 'x')
+			except OSError, e:
+				pass # pipe is full; the reader will wake up anyway
+
+	def runCompletions(self):
+		"""
+		Run the completion callbacks of all finished calls. Returns a list of the
+		values returned by the callbacks. A callback which fails is logged, and
+		contributes None to the list.
+		"""
+		try:
+			while len(os.read(self.__notifyRead, 4096))>0:
+				pass
+		except OSError, e:
+			pass
+		self.__completedLock.acquire()
+		completed = self.__completed
+		self.__completed = []
+		self.__completedLock.release()
+
+		ret = []
+		for onComplete, result, error in completed:
+			self.__outstanding -= 1
+			try:
+				ret.append(onComplete(result, error))
+			except:
+				self.__logger.error("Completion callback %s failed"%(repr(onComplete)))
+				for line in traceback.format_exc().split('\n'):
+					self.__logger.error(line)
+				ret.append(None)
+		return ret
+
+	def waitForAll(self):
+		"""
+		Wait till all submitted calls finish, running their completions.
+		Returns the values returned by the completions.
+		"""
+		ret = []
+		while self.__outstanding>0:
+			select.select([self.__notifyRead], [], [])
+			ret += self.runCompletions()
+		return ret
+
+	def close(self):
+		"""
+		Stop the worker threads, after the queued calls are done.
+		"""
+		for t in self.__threads:
+			self.__requests.put(None)
+		for t in self.__threads:
+			t.join()
+		self.__threads = []
+		os.close(self.__notifyRead)
+		os.close(self.__notifyWrite)
@@ -0,0 +1,163 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+An append-only journal with snapshots.
+
+The SSM records every change to its state in a journal, so that the state
+can be rebuilt if the SSM is restarted. Records are opaque strings to us;
+the SSM uses XML.
+
+To keep the journal (and the time to replay it) small, the SSM writes a
+snapshot of its whole state once in a while. Records older than the
+latest snapshot are not needed after that, and the journal is truncated.
+
+Two files are used - the journal itself, and the snapshot, which has the
+same name with ".snapshot" appended. Every record is stored as
+
+  <sequence number> <length>\\n<data>\\n
+
+Sequence numbers increase by one for every record. The snapshot is stored
+the same way, with the sequence number of the last record it includes.
+If we die after a snapshot is written, but before the journal is
+truncated, then the records already in the snapshot are skipped on load.
+A record that was being written when we died is incomplete; it is
+ignored, and removed from the journal.
+"""
+
+import os
+
+class Journal:
+	def __init__(self, fileName, snapshotInterval=1000, sync=True):
+		"""
+		fileName is the path of the journal. A snapshot is suggested (see
+		needsSnapshot) after every snapshotInterval records. If sync is True,
+		every record is flushed to disk before append() returns.
+		"""
+		self.fileName = fileName
+		self.snapshotFileName = fileName + ".snapshot"
+		self.snapshotInterval = snapshotInterval
+		self.sync = sync
+		self.lastSeq = 0
+		self.recordsSinceSnapshot = 0
+		self.f = None
+
+	def __readRecords(self, fileName):
+		"""
+		Read all complete records in a file. Returns a list of [seq, data],
+		and the length of the file upto the last complete record.
+		"""
+		try:
+			f = open(fileName, 'rb')
+		except IOError:
+			return [[], 0]
+		content = f.read()
+		f.close()
+
+		records = []
+		pos = 0
+		while pos < len(content):
+			headerEnd = content.find('\n', pos)
+			if headerEnd == -1:
+				break
+			try:
+				seq, length = map(int, content[pos:headerEnd].split(' '))
+			except ValueError:
+				break
+			dataEnd = headerEnd+1+length
+			if (length<0) or (dataEnd >= len(content)) or (content[dataEnd] != '\n'):
+				break
+			records.append([seq, content[headerEnd+1:dataEnd]])
+			pos = dataEnd+1
+		return [records, pos]
+
+	def __sync(self, f):
+		f.flush()
+		if self.sync:
+			os.fsync(f.fileno())
+
+	def load(self):
+		"""
+		Read the journal & the snapshot. Returns the snapshot (None if there
+		is none), and a list of the records that came after the snapshot.
+
+		The journal is open for appending after this.
+		"""
+		snapshot = None
+		snapshotSeq = 0
+		snapshotRecords, validLength = self.__readRecords(self.snapshotFileName)
+		if len(snapshotRecords)>0:
+			snapshotSeq, snapshot = snapshotRecords[0]
+
+		records, validLength = self.__readRecords(self.fileName)
+		self.lastSeq = snapshotSeq
+		newRecords = []
+		for seq, data in records:
+			if seq <= snapshotSeq:
+				continue
+			newRecords.append(data)
+			self.lastSeq = seq
+		self.recordsSinceSnapshot = len(newRecords)
+
+		# Drop any incomplete record at the end, so that we append after
+		# the last good one
+		if os.path.exists(self.fileName):
+			self.f = open(self.fileName, 'r+b')
+			self.f.truncate(validLength)
+			self.f.seek(validLength)
+		else:
+			self.f = open(self.fileName, 'wb')
+		return [snapshot, newRecords]
+
+	def append(self, data):
+		"""
+		Add a record at the end of the journal.
+		"""
+		self.lastSeq += 1
+		self.f.write("%d %d\n%s\n"%(self.lastSeq, len(data), data))
+		self.__sync(self.f)
+		self.recordsSinceSnapshot += 1
+
+	def needsSnapshot(self):
+		"""
+		Returns True if enough records have been added since the last
+		snapshot that a new one should be written.
+		"""
+		return self.recordsSinceSnapshot >= self.snapshotInterval
+
+	def writeSnapshot(self, data):
+		"""
+		Replace the snapshot with data, which must include the changes of all
+		records appended so far. The journal is emptied.
+		"""
+		tempFileName = self.snapshotFileName + ".tmp"
+		f = open(tempFileName, 'wb')
+		f.write("%d %d\n%s\n"%(self.lastSeq, len(data), data))
+		self.__sync(f)
+		f.close()
+		os.rename(tempFileName, self.snapshotFileName)
+
+		self.f.seek(0)
+		self.f.truncate()
+		self.__sync(self.f)
+		self.recordsSinceSnapshot = 0
+
+	def close(self):
+		if self.f is not None:
+			self.f.close()
+			self.f = None
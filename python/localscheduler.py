@@ -146,10 +146,20 @@ class LocalScheduler(scheduler.Scheduler):
 			raise ValueError, "I need one or more nodes to manage, you gave me none!"
 		if params != "":
 			raise ValueError, "Params must be empty for local runner. Incorrect value '%s'"%(params)
+		self.params = params
 
 	def getNodeNames(self):
 		return self.nodeList
 
+	def getParams(self):
+		return self.params
+
+	def setNodeNames(self, nodeList):
+		"""
+		Change the nodes we manage. Existing allocations are not affected.
+		"""
+		self.nodeList = nodeList
+
 	def allocate(self, uid, gid, nodeList):
 		for nodeName in nodeList:
 			if nodeName not in self.nodeList:
@@ -161,6 +171,20 @@ class LocalScheduler(scheduler.Scheduler):
 	def getUnusableNodes(self):
 		return []
 
+	def recoverAllocation(self, launcherNode, nodeList, checkExists=True):
+		"""
+		Take over an allocation made earlier, possibly by an SSM which has
+		since been restarted. We don't keep any state for allocations, so
+		this always succeeds.
+		"""
+		for nodeName in nodeList:
+			if nodeName not in self.nodeList:
+				raise ValueError, "Node '%s' is not managed by this scheduler"%(nodeName)
+		alloc = LocalReservation(self)
+		alloc.deserializeFromXML(launcherNode)
+		self.allocations.append(alloc)
+		return alloc
+
 	def deallocate(self, allocObj):
 		for idx in range(len(self.allocations)):
 			if allocObj is self.allocations[idx]:
@@ -25,6 +25,10 @@ import sys
 import weakref
 import os
 import copy
+import threading
+import heapq
+import array
+import collections
 from pprint import pprint
 
 def uniqList(list):
@@ -43,21 +47,154 @@ def createSchedulerType(schedType, nodeList, params):
 
 	raise ValueError, "Unknown scheduler type '%s'"%(schedType)
 
+class NodeHealthCache:
+	"""
+	Caches the unusable nodes reported by one scheduler.
+
+	Finding the node states can be expensive (SLURM runs sinfo), so we don't
+	want to do this for every allocation. The cached view is considered good
+	for 'ttl' seconds. If refreshInBackground is set, a thread refreshes the
+	view every 'ttl' seconds, and readers never wait for the scheduler.
+	Otherwise, the first read after the view expires refreshes it.
+
+	invalidate() forces a refresh - use this when something (e.g. a failed
+	allocation) indicates that the view may be out of date.
+
+	A ttl of 0 disables caching, i.e. every read asks the scheduler.
+	"""
+	def __init__(self, sched, ttl, refreshInBackground=True):
+		self.sched = sched
+		self.ttl = ttl
+		self.unusable = None # node name => None. Replaced as a whole on refresh.
+		self.lastRefresh = None
+		self.lastError = None
+		self.generation = 0 # incremented on every invalidate()
+		self.stale = False
+		self.stopped = False
+		self.lock = threading.Lock()
+		self.wakeup = threading.Event()
+		self.thread = None
+		if refreshInBackground and ttl>0:
+			self.thread = threading.Thread(target=self.__refreshLoop)
+			self.thread.setDaemon(True)
+			self.thread.start()
+
+	def __refreshLoop(self):
+		while not self.stopped:
+			try:
+				self.refresh()
+			except Exception, e:
+				# keep using the last view; we'll try again in a while
+				pass
+			self.wakeup.wait(self.ttl)
+			self.wakeup.clear()
+
+	def refresh(self):
+		"""
+		Get the unusable nodes from the scheduler and update the view. Errors
+		from the scheduler are raised; the old view is retained in that case.
+		"""
+		self.lock.acquire()
+		startGeneration = self.generation
+		self.lock.release()
+
+		try:
+			nodeList = self.sched.getUnusableNodes()
+		except Exception, e:
+			self.lastError = e
+			raise
+
+		newView = {}
+		for nodeName in nodeList:
+			newView[nodeName] = None
+
+		self.lock.acquire()
+		self.unusable = newView
+		self.lastRefresh = time.time()
+		self.lastError = None
+		# an invalidate() while we were asking the scheduler means that our
+		# answer may already be out of date
+		if self.generation == startGeneration:
+			self.stale = False
+		self.lock.release()
+
+	def invalidate(self):
+		"""
+		Mark the view as out of date. This may be called from any thread.
+		"""
+		self.lock.acquire()
+		self.generation += 1
+		self.stale = True
+		self.lock.release()
+		if self.thread is not None:
+			self.wakeup.set()
+
+	def getUnusableNodes(self):
+		"""
+		Returns the current view, as a dictionary keyed by node name.
+		The returned dictionary is never modified, so callers may hold on to
+		it for the duration of an operation.
+		"""
+		view = self.unusable
+		if view is None:
+			needRefresh = True
+		elif self.thread is not None:
+			needRefresh = False
+		elif self.stale or (time.time()-self.lastRefresh >= self.ttl):
+			needRefresh = True
+		else:
+			needRefresh = False
+
+		if needRefresh:
+			self.refresh()
+			view = self.unusable
+		return view
+
+	def isUnusable(self, nodeName):
+		return self.getUnusableNodes().has_key(nodeName)
+
+	def close(self):
+		"""
+		Stop the background refresher, if any.
+		"""
+		if self.thread is None:
+			return
+		self.stopped = True
+		self.wakeup.set()
+		self.thread.join()
+		self.thread = None
+
 class Allocation:
 	def __clearAll(self):
 		self.allocatedResources = None
 		self.launcherList = None
 		self.user = None
 
-	def __init__(self, launcherList, allocatedResources, user):
+	def __init__(self, launcherList, allocatedResources, user, allocId=None, launcherNodes=None):
 		"""
 		launcher => the real allocation from the scheduler. This encapsulates all resources included in
 		the allocation.
 		allocatedResources => the resources allocated for this.
+		allocId => the ID given to this allocation by the metascheduler.
+		launcherNodes => the names of the nodes allocated from the scheduler, for each launcher.
 		"""
 		self.launcherList = launcherList
+		self.launcherNodes = launcherNodes
 		self.allocatedResources = allocatedResources
 		self.user = user
+		self.allocId = allocId
+
+	def getID(self):
+		return self.allocId
+
+	def getLaunchers(self):
+		"""
+		Returns a list of [launcher, node names] for the scheduler allocations
+		that are part of this allocation.
+		"""
+		if self.launcherList is None:
+			return []
+		return map(lambda x,y: [x,y], self.launcherList, self.launcherNodes)
 
 	def getUser(self):
 		return self.user
@@ -93,9 +230,211 @@ class Allocation:
 		"""
 		return self.allocatedResources
 
+class PendingAllocation:
+	"""
+	An allocation whose resources have been picked, but for which the
+	scheduler(s) have not been called yet. The resources are marked as
+	used in the meantime.
+	"""
+	def __init__(self, finalResources, userInfo, schedRequests, needSchedulable):
+		self.finalResources = finalResources
+		self.userInfo = userInfo
+		self.schedRequests = schedRequests # list of [scheduler, nodes to allocate from it]
+		self.needSchedulable = needSchedulable
+		self.launcherList = []
+		self.node2launcher = {}
+
+	def needsScheduler(self):
+		"""
+		Returns True if runSchedulers() has any work to do.
+		"""
+		return len(self.schedRequests)>0
+
+class UndoLog:
+	"""
+	Records the allocation state of resources before they are changed, so
+	that the changes can be undone. This is much cheaper than working on
+	copies of the resources.
+
+	Call record() before changing a resource. rollback() undoes changes,
+	latest first, till the log is as long as it was when mark() returned.
+	"""
+	def __init__(self):
+		self.entries = []
+
+	def record(self, res):
+		self.entries.append([res, res.getAllocationState()])
+
+	def mark(self):
+		return len(self.entries)
+
+	def rollback(self, mark=0):
+		while len(self.entries)>mark:
+			res, state = self.entries.pop()
+			res.setAllocationState(state)
+
+class ResourceStateTable:
+	"""
+	Allocation state of the resources, kept in arrays indexed by resource
+	ID. For each resource we keep the number of owners, the share limit,
+	whether it is allocated shared, the allocation weight (bias + index)
+	and the class ID.
+
+	Checking if a resource is free, or scanning all resources for the
+	free ones, looks at these arrays instead of at the resource objects.
+	The objects still keep the list of owners; update() must be called
+	after the allocation state of a resource changes.
+	"""
+	def __init__(self):
+		self.ownerCount = array.array('i')
+		self.shareLimit = array.array('i')
+		self.shared = array.array('b')
+		self.weight = array.array('i')
+		self.classId = array.array('i')
+
+	def __len__(self):
+		return len(self.ownerCount)
+
+	def update(self, resId, res, classId):
+		"""
+		Copy the allocation state of res into the row for resId.
+		"""
+		grow = resId+1-len(self.ownerCount)
+		if grow>0:
+			self.ownerCount.extend([0]*grow)
+			self.shareLimit.extend([1]*grow)
+			self.shared.extend([0]*grow)
+			self.weight.extend([0]*grow)
+			self.classId.extend([-1]*grow)
+		self.ownerCount[resId] = len(res.getOwners())
+		self.shareLimit[resId] = res.getShareLimit()
+		self.shared[resId] = res.isShared()
+		self.weight[resId] = res.getAllocationWeight()
+		self.classId[resId] = classId
+
+	def remove(self, resId):
+		"""
+		Mark the row for resId as not managed by us.
+		"""
+		self.ownerCount[resId] = 0
+		self.shared[resId] = 0
+		self.classId[resId] = -1
+
+	def isFree(self, resId):
+		"""
+		Same as VizResource.isFree()
+		"""
+		if self.shared[resId]:
+			return self.ownerCount[resId] < self.shareLimit[resId]
+		return self.ownerCount[resId] == 0
+
+	def isShared(self, resId):
+		return self.shared[resId] != 0
+
+	def isSharable(self, resId):
+		return self.shareLimit[resId] > 1
+
+	def getFreeIds(self, classId=None):
+		"""
+		Return the IDs of all free resources, optionally only those of
+		one class.
+		"""
+		ownerCount = self.ownerCount
+		shareLimit = self.shareLimit
+		shared = self.shared
+		classIds = self.classId
+		ret = []
+		for resId in xrange(len(ownerCount)):
+			if classId is None:
+				# rows which were never filled in aren't managed by us
+				if classIds[resId] < 0:
+					continue
+			elif classIds[resId] != classId:
+				continue
+			if shared[resId]:
+				if ownerCount[resId] < shareLimit[resId]:
+					ret.append(resId)
+			elif ownerCount[resId] == 0:
+				ret.append(resId)
+		return ret
+
+class NodeRanking:
+	"""
+	Keeps the nodes of an availability list (a list of [node name, free
+	resources]) ordered the way the allocation algorithm tries them -
+	  - lower node weight (bias) first
+	  - then, lower total weight of the free resources
+	  - then, lower node index
+	The free resources of a node are kept sorted by weight, lowest first.
+
+	Only the node whose resources get used changes its position. So we keep
+	a heap instead of sorting all the nodes for every requirement.
+
+	Use inOrder() to go through the nodes, and update() after that.
+	"""
+	def __init__(self, availResources, nodeMap):
+		self.nodeMap = nodeMap
+		self.heap = []
+		self.tried = []
+		for nodeAvail in availResources:
+			self.heap.append(self.__makeEntry(nodeAvail))
+		heapq.heapify(self.heap)
+
+	def __makeEntry(self, nodeAvail):
+		nodeName = nodeAvail[0]
+		nodeResources = nodeAvail[1]
+		# decorate with the weights, so that we compute them just once
+		decorated = []
+		totalWeight = 0
+		for i in range(len(nodeResources)):
+			wt = nodeResources[i].getAllocationWeight()
+			totalWeight += wt
+			decorated.append((wt, i, nodeResources[i]))
+		decorated.sort()
+		nodeResources[:] = map(lambda x: x[2], decorated)
+
+		node = self.nodeMap[nodeName]
+		# node name makes the order predictable, even if all else is the same
+		return (node.getAllocationWeight(), totalWeight, node.getIndex(), nodeName, nodeAvail)
+
+	def inOrder(self):
+		"""
+		Generator which returns the items of the availability list, best first.
+		"""
+		while len(self.heap)>0:
+			entry = heapq.heappop(self.heap)
+			self.tried.append(entry)
+			yield entry[4]
+
+	def update(self, usedNodeAvail=None):
+		"""
+		Put back the nodes returned by inOrder(). If the resources of a node
+		were used, pass its item as usedNodeAvail, so that it gets ranked again.
+		"""
+		for entry in self.tried:
+			if entry[4] is usedNodeAvail:
+				entry = self.__makeEntry(usedNodeAvail)
+			heapq.heappush(self.heap, entry)
+		self.tried = []
+
 class Metascheduler:
-	def __init__(self, allNodes, schedList):
-		self.allocations = []
+	def __init__(self, allNodes, schedList, healthTTL=30, resourceIds=None, freedHistory=0):
+		"""
+		resourceIds is the vsapi.ResourceIdMap to use for identifying resources.
+		All resources of allNodes get added to it. A new one is created if this
+		is not passed.
+
+		freedHistory is the number of recently freed allocations to remember,
+		for diagnostics. See getFreedAllocations().
+		"""
+		# Active allocations, by allocation ID. Allocations are removed
+		# from here when they are deallocated.
+		self.allocations = {}
+		self.lastAllocId = 0
+		self.freedAllocations = collections.deque(maxlen=freedHistory)
+		if resourceIds is None:
+			resourceIds = vsapi.ResourceIdMap()
+		self.resourceIds = resourceIds
 
 		vizResourceList = []
 		nodeWeightWhenFree = {}
@@ -105,20 +444,276 @@ class Metascheduler:
 			vizResourceList = vizResourceList + node.getResources()
 			nodeMap[node.getHostName()] = node
 
-		# we keep a hash table to let us easily get to the object by name
+		# we keep a hash table to let us easily get to the object by its ID
 		# we keep references to the original objects. The allocation
 		# state is thus kept in one set of objects, which are in maintained
 		# in the caller of the metascheduler
 		infoTable = {}
 		for res in vizResourceList:
-			infoTable[res.hashKey()] = res
-			nodeWeightWhenFree[res.getHostName()] += res.getAllocationWeight()
+			infoTable[resourceIds.add(res)] = res
+
+		# The allocation state of all the resources, by ID
+		self.resourceState = ResourceStateTable()
+		for resId in infoTable:
+			res = infoTable[resId]
+			self.resourceState.update(resId, res, resourceIds.getClassId(res.resClass))
+			nodeWeightWhenFree[res.getHostName()] += self.resourceState.weight[resId]
 
 		self.infoTable = infoTable
+		# Resources which are not in the configuration anymore, but were in
+		# use when the configuration changed. These aren't allocated again,
+		# and are removed once free. See updateNodes()
+		self.retiring = {}
 		self.schedList = schedList
 		self.nodeMap = nodeMap
 		self.nodeWeightWhenFree = nodeWeightWhenFree
 
+		# Index of the free resources, kept up to date as resources get
+		# allocated and freed. This lets an allocation look at only the
+		# free resources instead of all of them.
+		# node name => resource class ID => resource ID => resource
+		# Nodes without any free resources are not present.
+		self.freeIndex = {}
+		for resId in self.resourceState.getFreeIds():
+			self.__addToFreeIndex(resId)
+
+		# node name => count of changes to the allocation state of
+		# the resources of the node. See getNodeVersion()
+		self.nodeVersion = {}
+
+		# node health is cached per scheduler. We also remember which
+		# scheduler manages each node, so that a node can be checked
+		# without going through all the schedulers
+		self.healthTTL = healthTTL
+		self.nodeHealth = {}
+		self.nodeScheduler = {}
+		for sched in schedList:
+			self.nodeHealth[sched] = NodeHealthCache(sched, healthTTL)
+			for nodeName in sched.getNodeNames():
+				self.nodeScheduler[nodeName] = sched
+
+	def __addToFreeIndex(self, resKey):
+		nodeName = self.infoTable[resKey].getHostName()
+		resType = self.resourceState.classId[resKey]
+		try:
+			byType = self.freeIndex[nodeName]
+		except KeyError:
+			byType = self.freeIndex[nodeName] = {}
+		try:
+			byType[resType][resKey] = self.infoTable[resKey]
+		except KeyError:
+			byType[resType] = { resKey : self.infoTable[resKey] }
+
+	def __removeFromFreeIndex(self, nodeName, resType, resKey):
+		try:
+			byType = self.freeIndex[nodeName]
+			byType[resType].pop(resKey)
+		except KeyError:
+			return
+		if len(byType[resType])==0:
+			byType.pop(resType)
+			if len(byType)==0:
+				self.freeIndex.pop(nodeName)
+
+	def __updateState(self, resKey):
+		"""
+		Update the state table and the free index after the allocation
+		state of a resource has changed.
+		"""
+		res = self.infoTable[resKey]
+		nodeName = res.getHostName()
+		self.nodeVersion[nodeName] = self.nodeVersion.get(nodeName, 0)+1
+		state = self.resourceState
+		state.update(resKey, res, state.classId[resKey])
+		if self.retiring.has_key(resKey):
+			if len(res.getOwners())==0:
+				self.__removeResource(resKey)
+			else:
+				self.__removeFromFreeIndex(nodeName, state.classId[resKey], resKey)
+		elif state.isFree(resKey):
+			self.__addToFreeIndex(resKey)
+		else:
+			self.__removeFromFreeIndex(nodeName, state.classId[resKey], resKey)
+
+	def __addResource(self, resKey, res):
+		"""
+		Start managing res, which has the ID resKey. This replaces the
+		resource we had with that ID, if any.
+		"""
+		self.resourceIds.replace(resKey, res)
+		self.infoTable[resKey] = res
+		self.retiring.pop(resKey, None)
+		self.resourceState.update(resKey, res, self.resourceIds.getClassId(res.resClass))
+		self.__updateState(resKey)
+
+	def __removeResource(self, resKey):
+		"""
+		Stop managing a resource.
+		"""
+		res = self.infoTable.pop(resKey)
+		self.retiring.pop(resKey, None)
+		nodeName = res.getHostName()
+		self.nodeVersion[nodeName] = self.nodeVersion.get(nodeName, 0)+1
+		self.__removeFromFreeIndex(nodeName, self.resourceState.classId[resKey], resKey)
+		self.resourceState.remove(resKey)
+
+	def __sameConfig(self, ours, res):
+		"""
+		Returns True if our resource has the same configuration as res, which
+		is fresh from the configuration files. What changes as resources
+		are used - the allocation state, and the configuration of X servers -
+		is not compared.
+		"""
+		ours = ours.clone()
+		ours.setAllocationState(res.getAllocationState())
+		if isinstance(ours, vsapi.Server):
+			ours.clearConfig()
+		elif isinstance(ours, vsapi.GPU):
+			ours.getSharedServer().clearConfig()
+		return ours.serializeToXML() == res.serializeToXML()
+
+	def updateNodes(self, allNodes, schedList):
+		"""
+		Switch to a new node configuration, without disturbing the active
+		allocations. allNodes and schedList are as for the constructor,
+		typically from a fresh load of the configuration.
+
+		Resources are matched to ours by their class, host name and index.
+		  - new resources are added.
+		  - resources whose configuration has changed are replaced, if they
+		    are free. For resources in use, the change is deferred; update
+		    again once they are free to get it.
+		  - resources that are not in the new configuration are removed, if
+		    they are free. Resources in use are not allocated any more, and
+		    are removed once they are freed.
+		The resources of the nodes in allNodes are replaced by ours where we
+		keep ours, so that the nodes always refer to the objects which carry
+		the allocation state.
+
+		If one of our schedulers is of the same kind, and has the same
+		parameters, as one in schedList, then we keep ours, and let it
+		manage the nodes of the new one. Scheduler allocations are tied to
+		our schedulers, so this keeps them intact.
+
+		Returns a dictionary with the hash keys of the resources that were
+		'added', 'updated', 'removed', that are 'retiring' (to be removed
+		once free), and those for which the update was 'deferred'.
+		"""
+		ret = { 'added' : [], 'updated' : [], 'removed' : [], 'retiring' : [], 'deferred' : [] }
+
+		inConfig = {}
+		nodeMap = {}
+		for node in allNodes:
+			nodeMap[node.getHostName()] = node
+			nodeResources = []
+			for res in node.getResources():
+				resKey = self.resourceIds.add(res)
+				inConfig[resKey] = None
+				ours = self.infoTable.get(resKey)
+				if ours is None:
+					self.__addResource(resKey, res)
+					ret['added'].append(res.hashKey())
+				elif (len(ours.getOwners())==0) and (not self.__sameConfig(ours, res)):
+					self.__addResource(resKey, res)
+					ret['updated'].append(res.hashKey())
+				else:
+					if not self.__sameConfig(ours, res):
+						ret['deferred'].append(res.hashKey())
+					# back in the configuration
+					if self.retiring.has_key(resKey):
+						self.retiring.pop(resKey)
+						self.__updateState(resKey)
+					res = ours
+				nodeResources.append(res)
+			node.setResources(nodeResources)
+
+		for resKey in self.infoTable.keys():
+			if inConfig.has_key(resKey):
+				continue
+			res = self.infoTable[resKey]
+			if len(res.getOwners())==0:
+				self.__removeResource(resKey)
+				ret['removed'].append(res.hashKey())
+			else:
+				if not self.retiring.has_key(resKey):
+					self.retiring[resKey] = None
+					self.__updateState(resKey)
+				ret['retiring'].append(res.hashKey())
+
+		# Whole nodes are matched only if all their resources are free.
+		# Retiring resources don't count.
+		nodeWeightWhenFree = {}
+		for nodeName in nodeMap:
+			nodeWeightWhenFree[nodeName] = 0
+		for resKey, res in self.infoTable.iteritems():
+			nodeName = res.getHostName()
+			if nodeWeightWhenFree.has_key(nodeName) and (not self.retiring.has_key(resKey)):
+				nodeWeightWhenFree[nodeName] += self.resourceState.weight[resKey]
+		self.nodeMap = nodeMap
+		self.nodeWeightWhenFree = nodeWeightWhenFree
+
+		newSchedList = []
+		for newSched in schedList:
+			for sched in self.schedList:
+				if (sched.__class__ is newSched.__class__) and (sched.getParams() == newSched.getParams()) and (sched not in newSchedList):
+					sched.setNodeNames(newSched.getNodeNames())
+					self.nodeHealth[sched].invalidate()
+					newSchedList.append(sched)
+					break
+			else:
+				self.nodeHealth[newSched] = NodeHealthCache(newSched, self.healthTTL)
+				newSchedList.append(newSched)
+		for sched in self.schedList:
+			if sched not in newSchedList:
+				self.nodeHealth.pop(sched).close()
+		nodeScheduler = {}
+		for sched in newSchedList:
+			for nodeName in sched.getNodeNames():
+				nodeScheduler[nodeName] = sched
+		self.schedList = newSchedList
+		self.nodeScheduler = nodeScheduler
+
+		return ret
+
+	def getManagedResources(self):
+		"""
+		Return a list of the resources we manage. This includes the
+		retiring ones.
+		"""
+		return self.infoTable.values()
+
+	def getNodeVersion(self, nodeName):
+		"""
+		Returns a number which changes whenever the allocation state of
+		any resource on the node changes. Callers can use this to find
+		if something they derived from the node is out of date.
+		"""
+		return self.nodeVersion.get(nodeName, 0)
+
+	def close(self):
+		"""
+		Stop the threads which refresh node health.
+		"""
+		for cache in self.nodeHealth.values():
+			cache.close()
+
+	def __getUnusableNodes(self):
+		"""
+		Returns a function which tells if a node is unusable at this time.
+		The answer is based on a snapshot of the node health of all
+		schedulers, taken when this is called.
+		"""
+		views = {}
+		for sched in self.schedList:
+			views[sched] = self.nodeHealth[sched].getUnusableNodes()
+		nodeScheduler = self.nodeScheduler
+		def isUnusable(nodeName):
+			try:
+				return views[nodeScheduler[nodeName]].has_key(nodeName)
+			except KeyError:
+				return False
+		return isUnusable
+
 	"""
 	Allocate the list of requested resources. 
 	Nodes are picked only from the includeNodeList. If includeNodeList is empty,
@@ -127,6 +722,25 @@ class Metascheduler:
 	The requested resources must be VizResource objects, or inherited classes
 	"""
 	def allocate(self, requestedResources, userInfo, includeNodeList):
+		pending = self.beginAllocate(requestedResources, userInfo, includeNodeList)
+		try:
+			self.runSchedulers(pending)
+		except:
+			self.abortAllocate(pending)
+			raise
+		return self.completeAllocate(pending)
+
+	"""
+	Allocation happens in three steps, so that the scheduler calls (which
+	may block) can be done outside the SSM's main loop
+
+	  beginAllocate()  - picks the resources, and marks them as used. Returns
+	                     a PendingAllocation.
+	  runSchedulers()  - gets the allocation from the scheduler(s).
+	  completeAllocate() - returns the final Allocation object. If runSchedulers()
+	                     failed, abortAllocate() frees the resources instead.
+	"""
+	def beginAllocate(self, requestedResources, userInfo, includeNodeList):
 		# validate input argument
 		if not isinstance(requestedResources, list):
 			raise ValueError, "Bad value: allocate only deals with lists"
@@ -223,7 +837,9 @@ class Metascheduler:
 				if isinstance(res, vsapi.VizNode):
 					continue
 				if res.isCompletelyResolvable():
-					hk = res.hashKey()
+					hk = self.resourceIds.getId(res)
+					if hk is None:
+						raise vsapi.VizError(vsapi.VizError.BAD_RESOURCE, "Pre-allocation: I dont manage the resource : %s. So can't allocate that"%(res.hashKey()))
 					if not fixedResources.has_key(hk):
 						fixedResources[hk]={'count':1, 'ref':res, 'share_count':0}
 					else:
@@ -245,14 +861,12 @@ class Metascheduler:
 			msg = ""
 			for res in resourcesUsedMultipleTimes:
 				if fixedResources[res]['count']!=fixedResources[res]['share_count']:
-					msg += "%s used %d times %d times shared,"%(res, fixedResources[res]['count'], fixedResources[res]['share_count'])
+					msg += "%s used %d times %d times shared,"%(fixedResources[res]['ref'].hashKey(), fixedResources[res]['count'], fixedResources[res]['share_count'])
 			if len(msg)>0:
-				raise ValueError, "Invalid resource request. One or more resources have been requested more than once OR has been requested both shared and unshared, %s. Reason: %s"%(res, msg)
+				raise ValueError, "Invalid resource request. One or more resources have been requested more than once OR has been requested both shared and unshared, %s. Reason: %s"%(fixedResources[res]['ref'].hashKey(), msg)
 		errorMessage = ""
 
-		unusableNodes = []
-		for sched in self.schedList:
-			unusableNodes += sched.getUnusableNodes()
+		isUnusable = self.__getUnusableNodes()
 
 		#
 		# Verify that all completely resolvable resources that are requested are indeed free
@@ -260,54 +874,200 @@ class Metascheduler:
 		#
 		for resKey in fixedResources:
 			if not self.infoTable.has_key(resKey):
-				raise vsapi.VizError(vsapi.VizError.BAD_RESOURCE, "Pre-allocation: I dont manage the resource : %s. So can't allocate that"%(resKey))
+				raise vsapi.VizError(vsapi.VizError.BAD_RESOURCE, "Pre-allocation: I dont manage the resource : %s. So can't allocate that"%(fixedResources[resKey]['ref'].hashKey()))
+			if self.retiring.has_key(resKey):
+				raise vsapi.VizError(vsapi.VizError.RESOURCE_UNAVAILABLE, "%s is being removed from the configuration. It can't be allocated."%(self.infoTable[resKey].hashKey()))
 			# if the resource is on a node which is not usable, then we can't satisfy this request.
-			if self.infoTable[resKey].getHostName() in unusableNodes:
-				raise vsapi.VizError(vsapi.VizError.RESOURCE_UNAVAILABLE, "%s is not available at this time."%(resKey))
+			if isUnusable(self.infoTable[resKey].getHostName()):
+				raise vsapi.VizError(vsapi.VizError.RESOURCE_UNAVAILABLE, "%s is not available at this time."%(self.infoTable[resKey].hashKey()))
 
-			if not self.infoTable[resKey].isFree():
-				raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Resource %s is already being used. It can't be allocated for you at this time."%(resKey))
+			if not self.resourceState.isFree(resKey):
+				raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Resource %s is already being used. It can't be allocated for you at this time."%(self.infoTable[resKey].hashKey()))
 
 			if not self.infoTable[resKey].typeSearchMatch(fixedResources[resKey]['ref']):
-				raise vsapi.VizError(vsapi.VizError.USER_ERROR, "Requested %s has a different type compared to the available resource. So this requirement cannot be fulfilled"%(resKey))
+				raise vsapi.VizError(vsapi.VizError.USER_ERROR, "Requested %s has a different type compared to the available resource. So this requirement cannot be fulfilled"%(self.infoTable[resKey].hashKey()))
 
 			# if the resource is on a node which is not in the search list, then we can't satisfy this request.
 			if (len(includeNodeList)>0) and (self.infoTable[resKey].getHostName() not in includeNodeList):
-				raise vsapi.VizError(vsapi.VizError.RESOURCE_UNAVAILABLE, "%s is not in the include list to choose from. So the request can't be satisfied."%(resKey))
+				raise vsapi.VizError(vsapi.VizError.RESOURCE_UNAVAILABLE, "%s is not in the include list to choose from. So the request can't be satisfied."%(self.infoTable[resKey].hashKey()))
 
 			# XXX: The next two checks can be enforced by using "canAllocate()"
 			# However, that will reduce the verbosity of the error messages
 
 			# check if user is asking for exclusive access on a resource which is already shared, then we have to fail
-			if fixedResources[resKey]['ref'].isExclusive() and self.infoTable[resKey].isShared():
-				raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Resource %s has already been allocated for shared access. It can't be allocated for you in exclusive mode at this time."%(resKey))
+			if fixedResources[resKey]['ref'].isExclusive() and self.resourceState.isShared(resKey):
+				raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Resource %s has already been allocated for shared access. It can't be allocated for you in exclusive mode at this time."%(self.infoTable[resKey].hashKey()))
 
 			# check if user is asking for shared access on a resource which is already exclusively allocated, then we have to fail
-			if fixedResources[resKey]['ref'].isShared() and (not self.infoTable[resKey].isSharable()):
-				raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Resource %s is not sharable and hence cannot be allocated for shared access."%(resKey))
+			if fixedResources[resKey]['ref'].isShared() and (not self.resourceState.isSharable(resKey)):
+				raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Resource %s is not sharable and hence cannot be allocated for shared access."%(self.infoTable[resKey].hashKey()))
 	
 		# FIXME: we could check if this request can ever be satisfied. Implement this later
 		
+		# Match the request against the free resources. The matching works
+		# directly on our resource objects, recording what it changes in an
+		# undo log. All of that is undone here; the resources that were
+		# picked are really allocated below.
+		undoLog = UndoLog()
+		try:
+			allocatedResources = self.__matchResources(expandedResourceList, resReqByDOF, userInfo, includeNodeList, isUnusable, undoLog)
+		finally:
+			undoLog.rollback()
+
+
+		# Mark the resource
+		for innerList in allocatedResources:
+			if not isinstance(innerList, list):
+				innerList = [innerList]
+			for res in innerList:
+				if not res.isCompletelyResolvable():
+					raise ValueError, "Programming Error. You allocated %s which is not completely resolvable"%(res)
+
+				searchKey = self.resourceIds.getId(res)
+				if not self.infoTable.has_key(searchKey):
+					raise vsapi.VizError(vsapi.VizError.BAD_RESOURCE, "I dont manage the resource : %s. So can't allocate that"%(res.hashKey()))
+	
+				if not self.resourceState.isFree(searchKey):
+					raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Programming Error - allocated resource (%s) is not free ? This is not supposed to happen! Allocator bug most likely"%(res.hashKey()))
+
+				# Append this to the node list only if it is schedulable.
+				if res.isSchedulable():
+					nodesToAlloc[res.getHostName()] = None
+
+		# convert dictionary to list
+	   	nodesToAlloc = nodesToAlloc.keys()
+
+		# these nodes may be managed by one or more schedulers
+		# so we'll have to partition this. The schedulers are called
+		# later, in runSchedulers()
+		schedRequests = []
+		for sched in self.schedList:
+			thisSchedNodes = sched.getNodeNames()
+			matchNodes = []
+			for nodeName in nodesToAlloc:
+				if nodeName in thisSchedNodes:
+					matchNodes.append(nodeName)
+			# call the scheduler only if there is a need to allocate any
+			# scheduled resources
+			if len(matchNodes)>0:
+				schedRequests.append([sched, matchNodes])
+
+		# resources that need to be hooked up to the scheduler allocation
+		# once we have it
+		needSchedulable = []
+
+		# This is where we put back what we allocated into
+		# something that corresponds to the original request
+		#
+		# The key thing here is to convert lists back to resource groups
+		finalResources = []
+		for itemIndex in range(len(requestedResources)):
+			if isinstance(requestedResources[itemIndex], list):
+				wasAggregate = False
+				wasList = True
+				resListList = [ allocatedResources[indexOfExpandedInFinal[itemIndex]] ] # list of VizResources
+			elif isinstance(requestedResources[itemIndex], vsapi.VizNode): # and (len(requestedResources[itemIndex].getResources())==0): # Whole node alloc
+				wasAggregate = True
+				wasList = False
+				resListList = [ allocatedResources[indexOfExpandedInFinal[itemIndex]] ]
+			elif isinstance(requestedResources[itemIndex], vsapi.VizResourceAggregate):
+				wasAggregate = True
+				wasList = False
+				resListList = map(lambda x:allocatedResources[x], indexOfExpandedInFinal[itemIndex]) # list of lists OR VizResources
+			else:
+				wasAggregate = False
+				wasList = False
+				resList = allocatedResources[itemIndex]
+				resListList = [ allocatedResources[indexOfExpandedInFinal[itemIndex]] ] # single VizResource
+
+			subAlloc = []
+			for innerList in resListList:
+				subSubAlloc = []
+				if not isinstance(innerList, list):
+					innerList = [innerList]
+				for ob in innerList:
+					subSubSubAlloc = []
+					if isinstance(ob, list):
+						resList = ob
+					else:
+						resList = [ob]
+
+					for res in resList:
+						# mark this resource as being in use. It stays
+						# in use (pending) while the schedulers are called
+						searchKey = self.resourceIds.getId(res)
+						self.infoTable[searchKey].doAllocate(res, userInfo['uid'])
+						self.__updateState(searchKey)
+
+						# make a copy of the original object corresponding to this resource
+						# XXX: this will make the object have "instantaneous" shared info that
+						# is not dynamically allocated
+						newRes = copy.deepcopy(self.infoTable[searchKey])
+
+						# Create a schedulable only if the new item is a schedulable one
+						if newRes.isSchedulable():
+							needSchedulable.append(newRes)
+	
+						subSubSubAlloc.append(newRes)
+
+					if not isinstance(ob, list):
+						subSubSubAlloc = subSubSubAlloc[0]
+					subSubAlloc.append(subSubSubAlloc)
+				subAlloc.append(subSubAlloc)
+
+			if wasList:
+				finalResources.append(subAlloc[0])
+			elif wasAggregate:
+				allocItem = copy.deepcopy(requestedResources[itemIndex]) #duplicate the aggregate group object
+				allocItem.setResources(subAlloc)
+				finalResources.append(allocItem)
+			else:
+				finalResources.append(subAlloc[0][0])
+
+		return PendingAllocation(finalResources, userInfo, schedRequests, needSchedulable)
+
+	def __matchResources(self, expandedResourceList, resReqByDOF, userInfo, includeNodeList, isUnusable, undoLog):
+		"""
+		The core of the allocation algorithm. Returns the resources allocated for each
+		item in expandedResourceList. All changes to our resource objects are recorded
+		in undoLog.
+		"""
 		#
 		# Create a hash of free resources. We'll allocate out of these
 		# hash is indexed by host name
 		#
+		# Requirements with an index (DOF=1) or without a hostname (DOF=3)
+		# may be satisfied from any node. Otherwise, only the nodes named in
+		# the request need to be considered.
+		#
+		if (len(resReqByDOF[1])>0) or (len(resReqByDOF[3])>0):
+			candidateNodes = self.freeIndex.keys()
+		else:
+			candidateNodes = []
+		for dof in resReqByDOF:
+			for reqDesc in resReqByDOF[dof]:
+				resToAlloc = reqDesc['requirement']
+				if isinstance(resToAlloc, list):
+					for res in resToAlloc:
+						if res.getHostName() is not None:
+							candidateNodes.append(res.getHostName())
+
 		freeResources = {}
-		for resKey in self.infoTable:
-			ob = self.infoTable[resKey]
-			obNodeName = ob.getHostName()
-			# Skip resources on unusable nodes
-			if obNodeName in unusableNodes:
+		for obNodeName in candidateNodes:
+			if freeResources.has_key(obNodeName) or (not self.nodeMap.has_key(obNodeName)):
+				continue
+			# Skip unusable nodes
+			if isUnusable(obNodeName):
 				continue
-			# Skip resources not in the include list
+			# Skip nodes not in the include list
 			if (len(includeNodeList)>0) and (obNodeName not in includeNodeList):
 				continue
-			if not freeResources.has_key(obNodeName):
-				freeResources[obNodeName] = {}
-			if self.infoTable[resKey].isFree():
-				# Create a copy of the free resources. If we fail allocation,
-				# then our internal table will still be consistent!
-				freeResources[obNodeName][resKey] = copy.deepcopy(ob)
+			# We work with references to our resource objects. Any changes
+			# made to them must be recorded in undoLog.
+			freeResources[obNodeName] = {}
+			if self.freeIndex.has_key(obNodeName):
+				for resByKey in self.freeIndex[obNodeName].values():
+					freeResources[obNodeName].update(resByKey)
 
 		# create an empty list for all allocations.
 		# this has 1 spot for every requirement
@@ -331,18 +1091,20 @@ class Metascheduler:
 				if isinstance(resToAlloc, list):
 					for res in resToAlloc:
 						if res.getAllocationDOF()==0:
-							resKey = res.hashKey()
+							resKey = self.resourceIds.getId(res)
 							resHost = res.getHostName()
 							# Allocate out of the existing item
+							undoLog.record(freeResources[resHost][resKey])
 							freeResources[resHost][resKey].doAllocate(res, userInfo['uid'])
 							if not freeResources[resHost][resKey].isFree():
 								freeResources[resHost].pop(resKey)
 				else:
 					res = resToAlloc
 					if res.getAllocationDOF()==0:
-						resKey = res.hashKey()
+						resKey = self.resourceIds.getId(res)
 						resHost = res.getHostName()
 						# Allocate out of the existing item
+						undoLog.record(freeResources[resHost][resKey])
 						freeResources[resHost][resKey].doAllocate(res, userInfo['uid'])
 						if not freeResources[resHost][resKey].isFree():
 							freeResources[resHost].pop(resKey)
@@ -368,7 +1130,7 @@ class Metascheduler:
 		#  - Get all VizResource lists for DOF = 1. These resources have only indices
 		#    Sort them by number of resources in each list, with the maximum 
 		#    coming first. This is the "requirement list"
-		#  - Create another list of available resources per node, copying freeResources
+		#  - Create another list of available resources per node, from freeResources
 		#    This is the "availability list", and will have max number of items 
 		#    equal to number of nodes
 		#  - Create a per node list of DOF=2 requirements
@@ -376,7 +1138,7 @@ class Metascheduler:
 		# Step 2
 		#
 		#  - For each requirement in "requirement list":
-		#    - Sort availability list, least resources on top
+		#    - Go through the availability list, least resources first (NodeRanking)
 		#    - For each node in "availability list"
 		#      - If this requirement can be matched by resources on this node
 		#        - Allocate this if this does not cause any DOF=2 (hostname) requirements 
@@ -397,7 +1159,7 @@ class Metascheduler:
 		#
 		#  - Create a requirement list for DOF=3, sort maximal first
 		#  - For each DOF=3 requirement,
-		#    - Sort availability list to order minimal resources on top.
+		#    - Go through the availability list, minimal resources first (NodeRanking)
 		#    - for each availability
 		#      - check if requirement matches availability
 		#        - if yes, allocate em and break. Update availability list
@@ -437,27 +1199,33 @@ class Metascheduler:
 		# Step 2
 		#
 
-		for reqDesc in reqDescList:
-			# our greedy strategy - sort resources so that minimal number of resources
-			# are on top
-			self.__sortAvailResources(availResources)
+		# our greedy strategy - try nodes with minimal number of resources first
+		if len(reqDescList)>0:
+			ranking = NodeRanking(availResources, self.nodeMap)
 
+		for reqDesc in reqDescList:
 			didSatisfy = False
 			resRequired = reqDesc['requirement']
 			resFinalSelected, resToBeAllocated, resTBAIndexMap = self.__classifyRes(reqDesc['requirement'])
-			for nodeAvail in availResources:
+			for nodeAvail in ranking.inOrder():
 				nodeName = nodeAvail[0]
 				nodeFreeRes = nodeAvail[1]
 				# Note: adding the nodeName to all these reqs makes all reqs fully resolved
 				# they're all DOF=1 (index is specified). Adding hostname makes them DOF=0
 				reqWithThisHostName = self.__copyWithThisNodeName(resToBeAllocated, nodeName)
-				allocThese, remainingAvail = self.__resourceMatchDOF0(reqWithThisHostName, nodeFreeRes, userInfo['uid'])
+				nodeMark = undoLog.mark()
+				allocThese, remainingAvail = self.__resourceMatchDOF0(reqWithThisHostName, nodeFreeRes, userInfo['uid'], undoLog)
 				if allocThese is None:
 					continue
 
 				if dof2ReqsByNode.has_key(nodeName):
-					satisfied, remaining = self.__resourceMatchDOF2(dof2ReqsByNode[nodeName], remainingAvail, userInfo['uid'])
+					# This is only a check - the DOF=2 requirements are
+					# really allocated later.
+					checkMark = undoLog.mark()
+					satisfied, remaining = self.__resourceMatchDOF2(dof2ReqsByNode[nodeName], remainingAvail, userInfo['uid'], undoLog)
+					undoLog.rollback(checkMark)
 					if satisfied is None:
+						undoLog.rollback(nodeMark)
 						continue
 
 				# we've satisfied this requirement here
@@ -475,7 +1243,8 @@ class Metascheduler:
 
 			# if we don't have a match, then we're done
 			if didSatisfy == False:
-				raise vsapi.VizError(vsapi.VizError.USER_ERROR, "Not enough resources to satisfy the request")
+				raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Not enough resources to satisfy the request")
+			ranking.update(nodeAvail)
 		
 			# put the allocated resources in their final place
 			allocatedResources[reqDesc['reqIndex']] = resFinalSelected
@@ -516,10 +1285,11 @@ class Metascheduler:
 			# be picked up first
 			nodeFreeRes.sort(lambda x,y:x.getAllocationWeight()-y.getAllocationWeight())
 		
-			allocThese, remainingAvail = self.__resourceMatchDOF2(resToBeAllocated, nodeFreeRes, userInfo['uid'])
+			allocThese, remainingAvail = self.__resourceMatchDOF2(resToBeAllocated, nodeFreeRes, userInfo['uid'], undoLog)
 			if allocThese is None:
-				# This shouldn't happen at all. If it does, it's a bug in our algorithm
-				raise vsapi.VizError(vsapi.VizError.INTERNAL_ERROR, "Couldn't allocate a DOF=2 requirement. Please check your resource list")
+				# The node doesn't have enough free resources of the kinds asked for.
+				# They may be freed up later, like in the DOF=1 case
+				raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Not enough free resources on node '%s' to satisfy the request"%(nodeName))
 
 			# Got the resources...
 
@@ -549,22 +1319,22 @@ class Metascheduler:
 		# sort with maximal number of resources per requirement coming first
 		self.__sortReqList(reqDescList)
 
-		for reqDesc in reqDescList:
-			# our greedy strategy - sort resources so that minimal number of resources
-			# are on top
-			self.__sortAvailResources(availResources)
+		# our greedy strategy - try nodes with minimal number of resources first
+		if len(reqDescList)>0:
+			ranking = NodeRanking(availResources, self.nodeMap)
 
+		for reqDesc in reqDescList:
 			didSatisfy = False
 			resRequired = reqDesc['requirement']
 			if not isinstance(resRequired, vsapi.VizNode): # List of resource
 				resFinalSelected, resToBeAllocated, resTBAIndexMap = self.__classifyRes(reqDesc['requirement'])
 					
-				for nodeAvail in availResources:
+				for nodeAvail in ranking.inOrder():
 					nodeName = nodeAvail[0]
 					nodeFreeRes = nodeAvail[1]
 					# Note: adding the nodeName to all these reqs converts these DOF=3 requests turn into DOF=2
 					reqWithThisHostName = self.__copyWithThisNodeName(resToBeAllocated, nodeName)
-					allocThese, remainingAvail = self.__resourceMatchDOF2(reqWithThisHostName, nodeFreeRes, userInfo['uid'])
+					allocThese, remainingAvail = self.__resourceMatchDOF2(reqWithThisHostName, nodeFreeRes, userInfo['uid'], undoLog)
 					if allocThese is None:
 						continue
 
@@ -582,7 +1352,7 @@ class Metascheduler:
 					break
 			else:
 				# Whole node needs to be matched
-				for nodeAvail in availResources:
+				for nodeAvail in ranking.inOrder():
 					nodeName = nodeAvail[0]
 					nodeFreeRes = nodeAvail[1]
 					availResourceWeight = sum(map(lambda x: x.getAllocationWeight(), nodeFreeRes))
@@ -630,7 +1400,8 @@ class Metascheduler:
 					
 			if didSatisfy == False:
 				# we can't satisfy the user request
-				raise vsapi.VizError(vsapi.VizError.USER_ERROR, "Not able to satisfy the request with the available resources (DOF=3)")
+				raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Not able to satisfy the request with the available resources (DOF=3)")
+			ranking.update(nodeAvail)
 
 			# put the allocated resources in their final place
 			allocatedResources[reqDesc['reqIndex']] = resFinalSelected
@@ -652,117 +1423,145 @@ class Metascheduler:
 		#pprint(availResources)
 		#print '---------------------------------------------'
 
-		# Mark the resource
-		for innerList in allocatedResources:
-			if not isinstance(innerList, list):
-				innerList = [innerList]
-			for res in innerList:
-				if not res.isCompletelyResolvable():
-					raise ValueError, "Programming Error. You allocated %s which is not completely resolvable"%(res)
-
-				searchKey = res.hashKey()
-				if not self.infoTable.has_key(searchKey):
-					raise vsapi.VizError(vsapi.VizError.BAD_RESOURCE, "I dont manage the resource : %s. So can't allocate that"%(searchKey))
-	
-				if not self.infoTable[searchKey].isFree():
-					raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Programming Error - allocated resource (%s) is not free ? This is not supposed to happen! Allocator bug most likely"%(searchKey))
+		return allocatedResources
 
-				# Append this to the node list only if it is schedulable.
-				if res.isSchedulable():
-					nodesToAlloc[res.getHostName()] = None
-
-		# convert dictionary to list
-	   	nodesToAlloc = nodesToAlloc.keys()
-
-		# these nodes may be managed by one or more schedulers
-		# so we'll have to partition this 
-		node2launcher = {}
+	def runSchedulers(self, pending):
+		"""
+		Get the allocation(s) from the scheduler(s) for a pending allocation.
+		This can take a while (e.g. SLURM's salloc), and does not touch our
+		resource table, so it may be called from a thread other than the one
+		which does the rest of the allocation.
+
+		On failure, any scheduler allocations made are undone, and the
+		error is raised. Call abortAllocate() after that. The failure may
+		be due to a node going down, so the node health of the failing
+		scheduler is refreshed.
+		"""
 		launcherList = []
-		for sched in self.schedList:
-			thisSchedNodes = sched.getNodeNames()
-			matchNodes = []
-			for nodeName in nodesToAlloc:
-				if nodeName in thisSchedNodes:
-					matchNodes.append(nodeName)
-			# call the scheduler only if there is a need to allocate any
-			# scheduled resources
-			if len(matchNodes)>0:
-				thisLauncher = sched.allocate(userInfo['uid'], userInfo['gid'], matchNodes)
+		node2launcher = {}
+		try:
+			for sched, matchNodes in pending.schedRequests:
+				try:
+					thisLauncher = sched.allocate(pending.userInfo['uid'], pending.userInfo['gid'], matchNodes)
+				except:
+					# the scheduler may have been dropped by updateNodes()
+					healthCache = self.nodeHealth.get(sched)
+					if healthCache is not None:
+						healthCache.invalidate()
+					raise
 				launcherList.append(thisLauncher)
 				for nodeName in matchNodes:
 					node2launcher[nodeName] = thisLauncher
+		except:
+			for thisLauncher in launcherList:
+				try:
+					thisLauncher.deallocate()
+				except Exception, e:
+					pass
+			raise
+		pending.launcherList = launcherList
+		pending.node2launcher = node2launcher
 
-		# This is where we put back what we allocated into
-		# something that corresponds to the original request
-		#
-		# The key thing here is to convert lists back to resource groups
-		finalResources = []
-		for itemIndex in range(len(requestedResources)):
-			if isinstance(requestedResources[itemIndex], list):
-				wasAggregate = False
-				wasList = True
-				resListList = [ allocatedResources[indexOfExpandedInFinal[itemIndex]] ] # list of VizResources
-			elif isinstance(requestedResources[itemIndex], vsapi.VizNode): # and (len(requestedResources[itemIndex].getResources())==0): # Whole node alloc
-				wasAggregate = True
-				wasList = False
-				resListList = [ allocatedResources[indexOfExpandedInFinal[itemIndex]] ]
-			elif isinstance(requestedResources[itemIndex], vsapi.VizResourceAggregate):
-				wasAggregate = True
-				wasList = False
-				resListList = map(lambda x:allocatedResources[x], indexOfExpandedInFinal[itemIndex]) # list of lists OR VizResources
-			else:
-				wasAggregate = False
-				wasList = False
-				resList = allocatedResources[itemIndex]
-				resListList = [ allocatedResources[indexOfExpandedInFinal[itemIndex]] ] # single VizResource
-
-			subAlloc = []
-			for innerList in resListList:
-				subSubAlloc = []
-				if not isinstance(innerList, list):
-					innerList = [innerList]
-				for ob in innerList:
-					subSubSubAlloc = []
-					if isinstance(ob, list):
-						resList = ob
-					else:
-						resList = [ob]
-
-					for res in resList:
-						# mark this resource as being in use
-						searchKey = res.hashKey()
-						self.infoTable[searchKey].doAllocate(res, userInfo['uid'])
-
-						# make a copy of the original object corresponding to this resource
-						# XXX: this will make the object have "instantaneous" shared info that
-						# is not dynamically allocated
-						newRes = copy.deepcopy(self.infoTable[searchKey])
-
-						# Create a schedulable only if the new item is a schedulable one
-						if newRes.isSchedulable():
-							newRes.setSchedulable(vsapi.Schedulable(node2launcher[newRes.getHostName()], newRes.getHostName()))
-	
-						subSubSubAlloc.append(newRes)
-
-					if not isinstance(ob, list):
-						subSubSubAlloc = subSubSubAlloc[0]
-					subSubAlloc.append(subSubSubAlloc)
-				subAlloc.append(subSubAlloc)
+	def completeAllocate(self, pending):
+		"""
+		Finish an allocation after runSchedulers() succeeds. Returns the
+		Allocation object.
+		"""
+		for newRes in pending.needSchedulable:
+			newRes.setSchedulable(vsapi.Schedulable(pending.node2launcher[newRes.getHostName()], newRes.getHostName()))
 
-			if wasList:
-				finalResources.append(subAlloc[0])
-			elif wasAggregate:
-				allocItem = copy.deepcopy(requestedResources[itemIndex]) #duplicate the aggregate group object
-				allocItem.setResources(subAlloc)
-				finalResources.append(allocItem)
-			else:
-				finalResources.append(subAlloc[0][0])
+		self.lastAllocId += 1
+		launcherNodes = map(lambda x: x[1], pending.schedRequests)
+		newAlloc = Allocation(pending.launcherList, pending.finalResources, pending.userInfo['uid'], self.lastAllocId, launcherNodes)
 
-		newAlloc = Allocation(launcherList, finalResources, userInfo['uid'])
+		self.allocations[newAlloc.getID()] = newAlloc
+		return newAlloc
 
-		self.allocations.append(newAlloc)
+	def recoverLaunchers(self, launcherInfo, checkExists=True):
+		"""
+		Take over scheduler allocations made earlier, e.g. by an SSM which
+		has since been restarted. launcherInfo is a list of [XML node of the
+		launcher, node names], one for each scheduler allocation. If
+		checkExists is False, then the schedulers aren't asked to check
+		whether the allocations still exist.
+
+		Returns the list of launchers. If any of the scheduler allocations
+		does not exist anymore, then the rest are freed, and None is returned.
+		"""
+		launcherList = []
+		for launcherNode, nodeList in launcherInfo:
+			try:
+				sched = self.nodeScheduler[nodeList[0]]
+				thisLauncher = sched.recoverAllocation(launcherNode, nodeList, checkExists)
+			except:
+				thisLauncher = None
+				for launcher in launcherList:
+					launcher.deallocate()
+				raise
+			if thisLauncher is None:
+				for launcher in launcherList:
+					launcher.deallocate()
+				return None
+			launcherList.append(thisLauncher)
+		return launcherList
+
+	def restoreAllocation(self, allocatedResources, userInfo, launcherInfo, checkExists=True):
+		"""
+		Re-create an allocation made earlier, e.g. by an SSM which has since
+		been restarted. allocatedResources are the resources of the allocation,
+		as returned by getResources() on the original allocation. launcherInfo
+		and checkExists are as for recoverLaunchers().
+
+		The resources are marked as used, and the scheduler allocations are
+		taken over. Returns the new Allocation, or None if a scheduler
+		allocation does not exist anymore; nothing is allocated in that case.
+		Raises VizError if a resource is not free.
+		"""
+		undoLog = UndoLog()
+		usedIds = []
+		try:
+			for res in self.__flattenResources(allocatedResources):
+				resKey = self.resourceIds.getId(res)
+				if (not self.infoTable.has_key(resKey)) or self.retiring.has_key(resKey):
+					raise vsapi.VizError(vsapi.VizError.BAD_RESOURCE, "I dont manage the resource : %s. So can't allocate that"%(res.hashKey()))
+				if not self.infoTable[resKey].canAllocate(res):
+					raise vsapi.VizError(vsapi.VizError.RESOURCE_BUSY, "Resource %s is already being used."%(res.hashKey()))
+				undoLog.record(self.infoTable[resKey])
+				self.infoTable[resKey].doAllocate(res, userInfo['uid'])
+				usedIds.append(resKey)
+		except:
+			undoLog.rollback()
+			raise
+
+		launcherList = self.recoverLaunchers(launcherInfo, checkExists)
+		if launcherList is None:
+			undoLog.rollback()
+			return None
+
+		for resKey in usedIds:
+			self.__updateState(resKey)
+
+		# Hook up the resources to the scheduler allocations
+		node2launcher = {}
+		for thisLauncher, info in zip(launcherList, launcherInfo):
+			for nodeName in info[1]:
+				node2launcher[nodeName] = thisLauncher
+		for res in self.__flattenResources(allocatedResources):
+			if res.isSchedulable():
+				res.setSchedulable(vsapi.Schedulable(node2launcher[res.getHostName()], res.getHostName()))
+
+		self.lastAllocId += 1
+		newAlloc = Allocation(launcherList, allocatedResources, userInfo['uid'], self.lastAllocId, map(lambda x: x[1], launcherInfo))
+		self.allocations[newAlloc.getID()] = newAlloc
 		return newAlloc
 
+	def abortAllocate(self, pending):
+		"""
+		Return the resources held by a pending allocation to the free pool.
+		Used if runSchedulers() fails.
+		"""
+		self.__freeResources(pending.finalResources, pending.userInfo['uid'])
+
 	def __classifyRes(self, resRequired):
 		resFinalSelected = []
 		resToBeAllocated = []
@@ -787,26 +1586,29 @@ class Metascheduler:
 			out.append(newRes)
 		return out
 
-	def __resourceMatchDOF2(self, reqList, availList, userInfo):
+	def __resourceMatchDOF2(self, reqList, availList, userInfo, undoLog):
 		"""
 		Match a list of VizResources (reqList) to available resources on a node(avail).
 		The hostnames of all resources in reqList must match the hostname of availList.
 		NOTE: One or more items in reqList may have index specified.
+		On failure, the available resources are left as they were.
 		"""
+		startMark = undoLog.mark()
 
 		# separate the DOF=0 from the DOF=2
 		resFinalAllocated, resToBeMatched, resTBMIndexMap = self.__classifyRes(reqList)
 
 		# match DOF=0
 		dof0only = filter(lambda x: x is not None,resFinalAllocated)
-		dof0match, remaining = self.__resourceMatchDOF0(dof0only, availList, userInfo)
+		dof0match, remaining = self.__resourceMatchDOF0(dof0only, availList, userInfo, undoLog)
 
 		# if we can't match the DOF=0, then we've failed
 		if dof0match == None:
 			return [None, None]
 
-		# NOTE: remaining is already a copy of availList, not a reference, so any
-		# failures in the rest of the function will not impact the original list
+		# NOTE: remaining is already a copy of availList, not a reference, so
+		# the original list is not impacted by the rest of the function. Changes
+		# to the resources are undone on failure.
 
 		# NOTE: dof0match will be the same as dof0only on success
 		#
@@ -841,6 +1643,7 @@ class Metascheduler:
 				if isinstance(res, resClass):
 					ar = availRes[resClass.rootNodeName]
 					if len(ar)==0:
+						undoLog.rollback(startMark)
 						return [None, None] # Not possible to match request with available resources
 
 					# look in the available resources of this type
@@ -851,6 +1654,7 @@ class Metascheduler:
 							match = res
 							res.setHostName(possibleMatch.getHostName())
 							res.setIndex(possibleMatch.getIndex())
+							undoLog.record(possibleMatch)
 							possibleMatch.doAllocate(res, userInfo)
 							# post allocation, if the object is not free then remove it from the
 							# free list
@@ -858,6 +1662,7 @@ class Metascheduler:
 								ar.pop(mi)
 							break
 					if match is None: # Not possible to match request with available resources
+						undoLog.rollback(startMark)
 						return [None, None]
 						
 			if match is None:
@@ -878,7 +1683,7 @@ class Metascheduler:
 
 		return [resFinalAllocated, allFree]
 
-	def __resourceMatchDOF0(self, reqList, availList, userInfo):
+	def __resourceMatchDOF0(self, reqList, availList, userInfo, undoLog):
 		"""
 		Match a list of VizResource requirements (req) to available resources on a node(avail).
 		All resources are fully specified. So this is just a dual loop
@@ -886,9 +1691,10 @@ class Metascheduler:
 		else returns [None, availList]
 		"""
 		matched = []
-		# make a complete copy of the available objects. In case
-		# of failures, we will just return the original list
-		remaining = copy.deepcopy(availList) 
+		# work on a copy of the list. In case of failures, we undo
+		# the changes to the resources and return the original list
+		startMark = undoLog.mark()
+		remaining = copy.copy(availList)
 		for req in reqList:
 			foundIt = False
 			for avail in remaining:
@@ -896,6 +1702,7 @@ class Metascheduler:
 					req.setHostName(avail.getHostName())
 					req.setIndex(avail.getIndex())
 					matched.append(req)
+					undoLog.record(avail)
 					avail.doAllocate(req, userInfo)
 					# remove from availability list only if it is not free as a result of allocation
 					if not avail.isFree(): 
@@ -904,53 +1711,11 @@ class Metascheduler:
 					break
 			# If one item fails matching, then it's failure overall
 			if foundIt == False:
+				undoLog.rollback(startMark)
 				return [None, availList]
 
 		return [matched, remaining]
 
-	def __sortAvailResources(self, resList):
-		# each element of list is [name, <list of resources>]
-		# sort with minimal number of resources coming first
-		nodeWeight2 = {}
-		for nodeEntry in resList:
-			nodeName = nodeEntry[0]
-			nodeResources = nodeEntry[1]
-			resWeight = {}
-			totalWeight = 0
-			# compute weight of each resource and the total weight of
-			# this node's resources
-			for res in nodeResources:
-				wt = res.getAllocationWeight()
-				resWeight[res.hashKey()] = wt
-				totalWeight += wt
-				#print "Res '%s' weight %d"%(res.hashKey(), wt)
-			# Sort resources of this node in order
-			nodeResources.sort(lambda x,y : resWeight[x.hashKey()]-resWeight[y.hashKey()])
-			nodeWeight2[nodeName] = totalWeight
-
-		def sortFunc(x,y):
-			nodeName1 = x[0]
-			nodeName2 = y[0]
-			node1 = self.nodeMap[nodeName1]
-			node2 = self.nodeMap[nodeName2]
-			# Return the node with the lower weight first
-			wt1 = node1.getAllocationWeight()-node2.getAllocationWeight()
-			if wt1 != 0:
-				return wt1
-
-			# Return the node whose resources have a lower weight next
-			wt2 = nodeWeight2[nodeName1]-nodeWeight2[nodeName2]
-			if wt2 != 0:
-				return wt2
-
-			# Return the node with lower index if all else fails. This
-			# gives a consistent & predictable order of allocation.
-			return node1.getIndex()-node2.getIndex()
-			
-		# Sort nodes with lower weights coming first
-		resList.sort(sortFunc)
-
-
 	def __sortReqList(self, reqDescList):
 		# each element of list is dictionary { 'reqIndex':n, 'requirement' : list of VizResource objects }
 		# sort with maximum requirements coming first
@@ -969,18 +1734,70 @@ class Metascheduler:
 	Also calls the allocation objects deallocate method.
 	"""
 	def deallocate(self, allocObj):
-		foundAlloc = None
-		for i in range(len(self.allocations)):
-			if self.allocations[i] is allocObj:
-				foundAlloc = allocObj
+		pendingFree = self.beginDeallocate(allocObj)
+		allocObj.deallocate()
+		self.completeDeallocate(pendingFree)
 
-		if foundAlloc is None:
-			raise KeyError, "The requested allocation with id=%d does not exist"%(allocObj.getID())
+	"""
+	Like allocation, deallocation can be done in steps
+
+	  beginDeallocate() - validates the allocation, removes it from the active
+	                      allocations, and returns what completeDeallocate()
+	                      needs. allocObj.deallocate() clears this from allocObj.
+	  allocObj.deallocate() - frees up the scheduler allocation. This may block.
+	  completeDeallocate() - marks the resources as free. Till this is called,
+	                      the resources are held by the allocation.
+	"""
+	def beginDeallocate(self, allocObj):
+		if self.allocations.get(allocObj.getID()) is not allocObj:
+			raise KeyError, "The requested allocation with id=%s does not exist"%(allocObj.getID())
+
+		# Once we start freeing an allocation, it is not active anymore.
+		self.allocations.pop(allocObj.getID())
+
+		return [allocObj.getResources(), allocObj.getUser(), allocObj.getID()]
+
+	def completeDeallocate(self, pendingFree):
+		resources, user, allocId = pendingFree
+		freedIds = self.__freeResources(resources, user)
+		if self.freedAllocations.maxlen>0:
+			self.freedAllocations.append({
+				'id' : allocId,
+				'user' : user,
+				'resources' : freedIds,
+				'freeTime' : time.time()
+			})
 
-		# if we came till here, then all is fine.
+	def getAllocation(self, allocId):
+		"""
+		Return the active allocation with the given ID, or None if there
+		is no such allocation.
+		"""
+		return self.allocations.get(allocId)
 
-		# get resources that were allocated, and mark them as free
-		allocatedResources = allocObj.getResources()
+	def getAllocations(self):
+		"""
+		Return a list of all active allocations.
+		"""
+		return self.allocations.values()
+
+	def getFreedAllocations(self):
+		"""
+		Return information about the most recently freed allocations, oldest
+		first. Each item is a dictionary with the allocation 'id', the 'user',
+		the IDs of the 'resources' it had, and the 'freeTime'.
+
+		At most freedHistory allocations (passed to the constructor) are
+		remembered. We don't keep the Allocation objects themselves, so the
+		memory used by this is bounded.
+		"""
+		return list(self.freedAllocations)
+
+	def __flattenResources(self, allocatedResources):
+		"""
+		Return a list of the resources in an allocation.
+		"""
+		ret = []
 		for item in allocatedResources:
 			if isinstance(item, list):
 				realResList = item
@@ -991,13 +1808,21 @@ class Metascheduler:
 
 			for itemRes in realResList:
 				if isinstance(itemRes,list):
-					resList = itemRes
+					ret += itemRes
 				else:
-					resList = [itemRes]
-				for res in resList:
-					# update availability of this resource
-					searchKey = res.hashKey()
-					self.infoTable[searchKey].deallocate(res, allocObj.getUser())
+					ret.append(itemRes)
+		return ret
 
-		# deallocate the object - this frees up the scheduler, etc
-		allocObj.deallocate()
+	def __freeResources(self, allocatedResources, user):
+		"""
+		Mark the given (allocated) resources as free in our table.
+		Returns the IDs of the resources.
+		"""
+		freedIds = []
+		for res in self.__flattenResources(allocatedResources):
+			# update availability of this resource
+			searchKey = self.resourceIds.getId(res)
+			self.infoTable[searchKey].deallocate(res, user)
+			self.__updateState(searchKey)
+			freedIds.append(searchKey)
+		return freedIds
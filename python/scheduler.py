@@ -70,6 +70,28 @@ class Scheduler:
     def deallocate(self):
         return success
     """
+    Takes over an allocation made earlier, possibly by an SSM which has since
+    been restarted. Returns the launcher object, or None if the allocation
+    does not exist anymore. If checkExists is False, then the allocation is
+    known to exist (e.g. it is handed over by a running SSM), and the
+    scheduler need not check that.
+    """
+    def recoverAllocation(self, launcherNode, node_list, checkExists=True):
+        return self.launcher
+    """
+    Returns the parameters this scheduler was created with.
+    """
+    def getParams(self):
+        return self.params
+    """
+    Changes the nodes managed by this scheduler, e.g. when the node
+    configuration is reloaded. Existing allocations are not affected.
+    The nodes are not validated; create a new scheduler with them for
+    that.
+    """
+    def setNodeNames(self, node_list):
+        self.nodeList = node_list
+    """
     Returns True if a particular node is up. or else returns False.
     """
     # Node state can be UP or DOWN
@@ -47,6 +47,7 @@ class SLURMScheduler(scheduler.Scheduler):
         else:
             self.partition = []
 
+        self.params = params
         self.nodeList = nodeList
 
         # check if SLURM considers these to be valid node(s)
@@ -61,6 +62,17 @@ class SLURMScheduler(scheduler.Scheduler):
     def getNodeNames(self):
         return self.nodeList
 
+    def getParams(self):
+        return self.params
+
+    def setNodeNames(self, nodeList):
+        """
+        Change the nodes we manage. Existing allocations are not affected.
+        The nodes are not checked with SLURM; create a new SLURMScheduler
+        with them for that.
+        """
+        self.nodeList = nodeList
+
     def __del__(self):
         # if some jobs allocated by us are still running, then kill em
         # all mercilessly !
@@ -105,11 +117,13 @@ class SLURMScheduler(scheduler.Scheduler):
         if schedId == None:
             raise ValueError, "Invalid allocation id"%(schedId)
         
-        self.launcher = slurmlauncher.SLURMLauncher(schedId, res_list, self)
+        # NOTE: use a local variable here. The SSM may call us from more than
+        # one thread at a time.
+        thisLauncher = slurmlauncher.SLURMLauncher(schedId, res_list, self)
         # Remember that we made this allocation.
         # This will come in handy during scheduler cleanup.
-	self.allocationInfo[schedId] = self.launcher
-        return self.launcher
+	self.allocationInfo[schedId] = thisLauncher
+        return thisLauncher
 
     def deallocate(self, allocObj):
         if allocObj.__class__ is not slurmlauncher.SLURMLauncher:
@@ -121,6 +135,34 @@ class SLURMScheduler(scheduler.Scheduler):
         # we're no longer tracking this...
         self.allocationInfo.pop(schedId)
 
+    def recoverAllocation(self, launcherNode, nodeList, checkExists=True):
+        """
+        Take over a job allocated earlier, possibly by an SSM which has since
+        been restarted. launcherNode is the XML of the SLURMLauncher, and
+        nodeList is the list of nodes in the job. If checkExists is False,
+        then we trust that the job is still running, and don't run squeue.
+
+        Returns the launcher, or None if the job does not exist anymore.
+        """
+        oldLauncher = slurmlauncher.SLURMLauncher()
+        oldLauncher.deserializeFromXML(launcherNode)
+        schedId = oldLauncher.getSchedId()
+        for nodeName in nodeList:
+            if nodeName not in self.nodeList:
+                raise ValueError, "Node '%s' is not managed by this SLURM instance"%(nodeName)
+        if checkExists:
+            try:
+                p = subprocess.Popen(["squeue", "-h", "-j", str(schedId), "-o", "%T"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+            except OSError, e:
+                raise SLURMError(repr(e))
+            jobState = p.communicate()[0].strip()
+            # squeue fails for jobs which it doesn't know about anymore
+            if (p.returncode != 0) or (jobState not in ["RUNNING", "CONFIGURING"]):
+                return None
+        thisLauncher = slurmlauncher.SLURMLauncher(schedId, nodeList, self)
+        self.allocationInfo[schedId] = thisLauncher
+        return thisLauncher
+
     def expandHosts(self, slurmOutput):
         if not ('[' in slurmOutput):
             return [slurmOutput]
@@ -22,14 +22,16 @@ VizStack Job API
 """
 
 import socket
+import struct
 import os
 import subprocess
 from copy import deepcopy
-from xml.dom import minidom
+import xml.parsers.expat
 import xml
 from pprint import pprint
 import re
 import domutil
+import threading
 import slurmlauncher
 import localscheduler
 import sshscheduler
@@ -240,11 +242,73 @@ class VizError(Exception):
 # SLI           0      "discrete"
 # SLI           0      "quadroplex"
 
-class VizResource:
+#
+# Resource objects use __slots__ instead of a per-object __dict__. The SSM
+# keeps many copies of every resource, so this makes a difference to the
+# memory it uses. The functions below let these objects be copied and
+# pickled.
+#
+g_slotNames = {}
+
+def getSlotNames(cls):
+	"""
+	Return the names of all slots of a class, including those of its base classes.
+	"""
+	try:
+		return g_slotNames[cls]
+	except KeyError:
+		pass
+	names = []
+	for baseClass in reversed(cls.__mro__):
+		for name in baseClass.__dict__.get('__slots__', ()):
+			if name not in names:
+				names.append(name)
+	g_slotNames[cls] = names
+	return names
+
+def getSlotState(ob):
+	"""
+	Return the attributes of ob as a dictionary. Slots which haven't been
+	set are left out.
+	"""
+	state = dict(getattr(ob, '__dict__', {}))
+	for name in getSlotNames(ob.__class__):
+		try:
+			state[name] = getattr(ob, name)
+		except AttributeError:
+			pass
+	return state
+
+def setSlotState(ob, state):
+	"""
+	Restore the attributes of ob from a dictionary returned by getSlotState.
+	"""
+	for name, value in state.iteritems():
+		setattr(ob, name, value)
+
+def copySlots(ob):
+	"""
+	Return a shallow copy of ob.
+	"""
+	newOb = ob.__class__.__new__(ob.__class__)
+	if hasattr(ob, '__dict__'):
+		newOb.__dict__.update(ob.__dict__)
+	for name in getSlotNames(ob.__class__):
+		try:
+			setattr(newOb, name, getattr(ob, name))
+		except AttributeError:
+			pass
+	return newOb
+
+class VizResource(object):
 	"""
 	Base class that represents visualization resources.
 	Note that the methods of this base class may be overridden in the derived classes.
+
+	Derived classes need to list the attributes they add in __slots__.
 	"""
+	__slots__ = ('resClass', 'resIndex', 'hostName', 'resType', 'owners', 'shared', 'maxShareCount', 'allocationBias')
+
 	def __init__(self, resIndex=None, hostName=None, resClass=None, resType=None):
 		"""
 		Initialize with a class name, resouce index and hostname and type.
@@ -405,6 +469,20 @@ class VizResource:
 		if len(self.owners)==0:
 			self.shared = False
 
+	def getAllocationState(self):
+		"""
+		Return the state changed by doAllocate() and deallocate(). The
+		state can be restored later using setAllocationState().
+		"""
+		return [copy.copy(self.owners), self.shared]
+
+	def setAllocationState(self, state):
+		"""
+		Restore state returned by getAllocationState().
+		"""
+		self.owners = copy.copy(state[0])
+		self.shared = state[1]
+
 	def getType(self):
 		"""
 		Return the type of this resource
@@ -613,10 +691,128 @@ class VizResource:
 		if node is not None:
 			self.allocationBias = int(domutil.getValue(node))
 
+	def clone(self):
+		"""
+		Return a copy of this resource. Changes made to the copy do not affect
+		this resource, and vice-versa.
+		"""
+		return self.__deepcopy__({})
+
+	def __getstate__(self):
+		return getSlotState(self)
+
+	def __setstate__(self, state):
+		setSlotState(self, state)
+
+	def __copy__(self):
+		return copySlots(self)
+
+	def __deepcopy__(self, memo):
+		"""
+		Called by copy.deepcopy. Resources are copied a lot during allocation,
+		so we don't let deepcopy walk the object. Attributes are copied by
+		reference, and the mutable ones are then copied by _copyMembers.
+		"""
+		newRes = copySlots(self)
+		memo[id(self)] = newRes
+		newRes.owners = self.owners[:]
+		self._copyMembers(newRes, memo)
+		return newRes
+
+	def _copyMembers(self, newRes, memo):
+		"""
+		Copy the mutable members of this resource into newRes, which starts out
+		sharing all members with this resource. This implementation deep copies
+		every member. Derived classes override this to copy only what needs to
+		be copied.
+		"""
+		for name, value in getSlotState(self).iteritems():
+			setattr(newRes, name, deepcopy(value, memo))
+
+class ResourceIdMap:
+	"""
+	Gives a dense integer ID to each resource managed by the SSM.
+
+	hashKey() formats a string every time it is called. Code that looks
+	up resources very often (the allocator, the SSM) identifies them by
+	these IDs instead. The ID of a resource is found from its class, host
+	name and index. Class names and host names are interned to small
+	integers for this.
+
+	hashKey() is still what goes on the wire and in the logs.
+	"""
+	def __init__(self):
+		self.resources = [] # ID => resource
+		self.classIds = {} # class name => small integer
+		self.hostIds = {} # host name => small integer
+		self.byKey = {} # (class ID, host ID, index) => ID
+
+	def __intern(self, table, name):
+		try:
+			return table[name]
+		except KeyError:
+			newId = len(table)
+			table[name] = newId
+			return newId
+
+	def add(self, res):
+		"""
+		Give an ID to a resource. If a resource referring to the same thing
+		was added earlier, then its ID is returned.
+		"""
+		if not res.isCompletelyResolvable():
+			raise ValueError, "Only completely resolvable resources can have an ID. Got %s"%(res)
+		key = (self.__intern(self.classIds, res.resClass), self.__intern(self.hostIds, res.hostName), res.resIndex)
+		try:
+			return self.byKey[key]
+		except KeyError:
+			pass
+		resId = len(self.resources)
+		self.resources.append(res)
+		self.byKey[key] = resId
+		return resId
+
+	def getId(self, res):
+		"""
+		Return the ID of the resource that res refers to. Returns None if
+		that resource is not known to us.
+		"""
+		try:
+			return self.byKey[(self.classIds[res.resClass], self.hostIds[res.hostName], res.resIndex)]
+		except KeyError:
+			return None
+
+	def getResource(self, resId):
+		"""
+		Return the resource with the given ID. This is the object that was
+		passed to add().
+		"""
+		return self.resources[resId]
+
+	def replace(self, resId, res):
+		"""
+		Make res the resource returned by getResource() for an ID. res must
+		refer to the same resource as the one it replaces.
+		"""
+		if self.getId(res) != resId:
+			raise ValueError, "%s does not have the ID %d"%(res, resId)
+		self.resources[resId] = res
+
+	def getClassId(self, resClass):
+		"""
+		Return the small integer corresponding to a resource class name.
+		"""
+		return self.__intern(self.classIds, resClass)
+
+	def __len__(self):
+		return len(self.resources)
+
 class Keyboard(VizResource):
 	"""
 	Keyboard resource class.
 	"""
+	__slots__ = ('physAddr', 'driver', 'options')
+
 	rootNodeName = "keyboard"
 
 	def __clearAll(self):
@@ -627,6 +823,9 @@ class Keyboard(VizResource):
 		self.driver = None
 		self.options = []
 
+	def _copyMembers(self, newRes, memo):
+		newRes.options = self.options[:]
+
 	def __init__(self, resIndex=None, hostName=None,keyboardType=None, physAddr=None):
 		VizResource.__init__(self)
 
@@ -697,6 +896,8 @@ class Mouse(VizResource):
 	"""
 	Mouse resource class.
 	"""
+	__slots__ = ('physAddr', 'driver', 'options')
+
 	rootNodeName = "mouse"
 
 	def __clearAll(self):
@@ -707,6 +908,9 @@ class Mouse(VizResource):
 		self.driver = None
 		self.options = []
 
+	def _copyMembers(self, newRes, memo):
+		newRes.options = self.options[:]
+
 	def __init__(self, resIndex=None, hostName=None,mouseType=None, physAddr=None):
 		VizResource.__init__(self)
 		self.resClass = "Mouse"
@@ -788,6 +992,8 @@ class VizResourceAggregate(VizResource):
 	Calling some functions on the aggregates is considered an Error -
 	e.g., getAllocationDOF()
 	"""
+	__slots__ = ()
+
 	def getResources(self):
 		"""
 		Get the list of resources that are included in this resource aggregate.
@@ -808,6 +1014,8 @@ class VizResourceAggregate(VizResource):
 		raise "getAllocationDOF must not be called for this class"
 
 class DisplayDevice(VizResource):
+	__slots__ = ('bezel', 'default_mode', 'dimensions', 'edid', 'edidBytes', 'edid_name', 'hsync_max', 'hsync_min', 'input', 'modes', 'vrefresh_max', 'vrefresh_min')
+
 	rootNodeName = "display"
 
 	def __str__(self):
@@ -1229,6 +1437,7 @@ class GPU(VizResource):
 	"""
 	GPU resource class
 	"""
+	__slots__ = ('busID', 'scanout', 'schedulable', 'useScanOut', 'allowNoScanOut', 'allowStereo', 'vendor', 'scanoutCaps', 'max_width', 'max_height', 'ra', 'sharedServer', 'sharedServerIndex')
 
 	rootNodeName = "gpu"
 
@@ -1262,6 +1471,20 @@ class GPU(VizResource):
 		self.sharedServer.setShared(True)
 		self.sharedServerIndex = None
 
+	def _copyMembers(self, newRes, memo):
+		newRes.scanout = {}
+		for portIndex, sc in self.scanout.iteritems():
+			newRes.scanout[portIndex] = sc.copy()
+		if self.scanoutCaps is not None:
+			newRes.scanoutCaps = {}
+			for portIndex, caps in self.scanoutCaps.iteritems():
+				newRes.scanoutCaps[portIndex] = caps[:]
+		newRes.sharedServer = deepcopy(self.sharedServer, memo)
+		# Launchers keep track of copies made of them, so the schedulable
+		# goes through deepcopy. The copy uses the same connection to the
+		# SSM (self.ra) as we do.
+		newRes.schedulable = deepcopy(self.schedulable, memo)
+
 	def __str__(self):
 		return self.__repr__()
 
@@ -1338,6 +1561,16 @@ class GPU(VizResource):
 		VizResource.setShareLimit(self, shareCount)
 		self.sharedServer.setShareLimit(shareCount)
 
+	def getAllocationState(self):
+		"""
+		Allocation changes the owners of our shared X server too.
+		"""
+		return [VizResource.getAllocationState(self), self.sharedServer.getAllocationState()]
+
+	def setAllocationState(self, state):
+		VizResource.setAllocationState(self, state[0])
+		self.sharedServer.setAllocationState(state[1])
+
 	def getSharedServer(self):
 		return self.sharedServer
 
@@ -1913,6 +2146,7 @@ class GPU(VizResource):
 		return totalWeight
 
 class SLI(VizResource):
+	__slots__ = ('gpu0', 'gpu1', 'mode')
 
 	rootNodeName = "sli"
 	validModes = [ "auto", "SFR", "AFR", "AA", "mosaic" ]
@@ -1925,6 +2159,9 @@ class SLI(VizResource):
 		self.gpu1 = None
 		self.mode = None
 
+	def _copyMembers(self, newRes, memo):
+		pass
+
 	def __init__(self, resIndex=None, hostName = None, sliType=None, gpu0=None, gpu1=None):
 		VizResource.__init__(self)
 		self.resClass = "SLI"
@@ -2041,10 +2278,11 @@ class SLI(VizResource):
 		if sliModeNode is not None:
 			self.setMode(domutil.getValue(sliModeNode))
 
-class Screen:
+class Screen(object):
 	"""
 	Screen class enapsulates a single screen of an X server - i.e. a framebuffer.
 	"""
+	__slots__ = ('screenNumber', 'server', 'gpus', 'properties', 'isXineramaScreen', 'gpuCombiner')
 
 	rootNodeName = "framebuffer"
 	stereoModes = { 
@@ -2068,13 +2306,41 @@ class Screen:
 		self.isXineramaScreen = False
 		self.gpuCombiner = None
 
+	def clone(self):
+		"""
+		Return a copy of this screen, along with the GPUs in it.
+		"""
+		return self.__deepcopy__({})
+
+	def __getstate__(self):
+		return getSlotState(self)
+
+	def __setstate__(self, state):
+		setSlotState(self, state)
+
+	def __copy__(self):
+		return copySlots(self)
+
+	def __deepcopy__(self, memo):
+		newScreen = copySlots(self)
+		memo[id(self)] = newScreen
+		newScreen.server = deepcopy(self.server, memo)
+		newScreen.gpus = map(lambda x: deepcopy(x, memo), self.gpus)
+		newScreen.gpuCombiner = deepcopy(self.gpuCombiner, memo)
+		newScreen.properties = {}
+		for name, value in self.properties.iteritems():
+			if isinstance(value, list):
+				value = value[:]
+			newScreen.properties[name] = value
+		return newScreen
+
 	def __str__(self):
 		return '<Screen %d>'%(self.screenNumber)
 
 	def __init__(self, screenNumber=None, server=None):
 		self.__clearAll()
 
-		if (server is not None) and (type(server) is not Server):
+		if (server is not None) and (not isinstance(server, Server)):
 			raise VizError(VizError.INCORRECT_VALUE, "Improper object passed as a server")
 		if (type(screenNumber) is not int) and (screenNumber is not None):
 			raise VizError(VizError.INCORRECT_VALUE, "Screen number must be an integer or None")
@@ -2434,6 +2700,7 @@ class Server(VizResource):
 	"""
 	Server class encapsulates a single X server
 	"""
+	__slots__ = ('modules', 'keyboard', 'mouse', 'screens', 'combineFBs', 'x_extension_section_option', 'serverArgs')
 
 	rootNodeName = "server"
 	all_x_extension_section_options = ['Composite']
@@ -2455,6 +2722,16 @@ class Server(VizResource):
 		self.x_extension_section_option = {}
 		self.serverArgs = {}
 
+	def _copyMembers(self, newRes, memo):
+		newRes.modules = self.modules[:]
+		newRes.serverArgs = self.serverArgs.copy()
+		newRes.x_extension_section_option = self.x_extension_section_option.copy()
+		newRes.keyboard = deepcopy(self.keyboard, memo)
+		newRes.mouse = deepcopy(self.mouse, memo)
+		newRes.screens = {}
+		for screenNumber, screen in self.screens.iteritems():
+			newRes.screens[screenNumber] = deepcopy(screen, memo)
+
 	def setConfig(self, srv):
 		self.modules = srv.modules
 		self.keyboard = srv.keyboard
@@ -2846,6 +3123,8 @@ class ResourceGroup(VizResourceAggregate):
 	The ResourceGroup class. Provides a generalized way to setup and use a group of resources.
 	This is accomplished by the resType(actually a handler) and 'handler_params'
 	"""
+	__slots__ = ('name', 'description', 'handler_params', 'resources', 'validateAgainst', 'handlerObj')
+
 	rootNodeName = "resourceGroup"
 
 	def __clearAll(self):
@@ -2858,6 +3137,21 @@ class ResourceGroup(VizResourceAggregate):
 		self.validateAgainst = None
 		self.description = None # A string which describes the resource group
 
+	def _copyMembers(self, newRes, memo):
+		# The templates we were validated against are only read from. The
+		# copy (and the copy of the handler) refers to the same ones.
+		if self.validateAgainst is not None:
+			memo[id(self.validateAgainst)] = self.validateAgainst
+		newRes.resources = []
+		for item in self.resources:
+			if isinstance(item, list):
+				item = map(lambda x: deepcopy(x, memo), item)
+			else:
+				item = deepcopy(item, memo)
+			newRes.resources.append(item)
+		newRes.handler_params = deepcopy(self.handler_params, memo)
+		newRes.handlerObj = deepcopy(self.handlerObj, memo)
+
 	def getDescription(self):
 		"""
 		Get the description of the resource group. This is a string
@@ -4137,46 +4431,177 @@ class Allocation:
 
 		self.__emptyXprocs()
 
-def sendMessageOnSocket(sock, message):
-	dataLen = '%d'%(len(message))
-	dataLen = dataLen + ' '*(5-len(dataLen)) # NOTE: the '5' is a dependency from vs-ssm.py
+#
+# Framing of messages exchanged with the SSM.
+#
+# v1 : the length of the message as 5 ASCII characters (space padded),
+#      followed by the message. This limits messages to 99999 bytes.
+#      The C++ tools(vs-X, etc) use this.
+# v2 : FRAME_V2_MARKER, followed by the length of the message as a 64 bit
+#      unsigned integer in network byte order, followed by the message.
+#
+# The first byte of a frame tells the two apart, so a receiver accepts
+# either. A client announces that it understands v2 in its identity message
+# (<framing>2</framing>); the SSM sends v2 frames only to such clients.
+#
+FRAMING_V1 = 1
+FRAMING_V2 = 2
+FRAME_V1_HEADER_LENGTH = 5
+FRAME_V1_MAX_LENGTH = 99999
+FRAME_V2_MARKER = '\x02'
+FRAME_V2_HEADER_LENGTH = 1+struct.calcsize('!Q')
+
+def encodeFrameHeader(dataLen, framing=None):
+	"""
+	Return the header for a message of length dataLen. If framing is None,
+	then v1 framing is used for messages that fit in it, and v2 for others.
+	"""
+	if framing is None:
+		if dataLen <= FRAME_V1_MAX_LENGTH:
+			framing = FRAMING_V1
+		else:
+			framing = FRAMING_V2
+	if framing == FRAMING_V2:
+		return FRAME_V2_MARKER + struct.pack('!Q', dataLen)
+	if dataLen > FRAME_V1_MAX_LENGTH:
+		raise VizError(VizError.BAD_PROTOCOL, "Message of length %d is too large to be sent with v1 framing"%(dataLen))
+	dataLenStr = '%d'%(dataLen)
+	return dataLenStr + ' '*(FRAME_V1_HEADER_LENGTH-len(dataLenStr))
+
+def decodeFrameHeader(data):
+	"""
+	Decode the frame header at the start of data. Returns [headerLength, dataLength],
+	or None if data doesn't have the complete header yet.
+	"""
+	if len(data)==0:
+		return None
+	if data[0] == FRAME_V2_MARKER:
+		if len(data)<FRAME_V2_HEADER_LENGTH:
+			return None
+		dataLen = struct.unpack('!Q', data[1:FRAME_V2_HEADER_LENGTH])[0]
+		if dataLen==0:
+			raise VizError(VizError.BAD_PROTOCOL, "Message length = %d is invalid"%(dataLen))
+		return [FRAME_V2_HEADER_LENGTH, dataLen]
+
+	if len(data)<FRAME_V1_HEADER_LENGTH:
+		return None
+	dataLenStr = data[:FRAME_V1_HEADER_LENGTH]
+	try:
+		dataLen = int(dataLenStr)
+	except ValueError, e:
+		raise VizError(VizError.BAD_PROTOCOL, "Message length = %s is invalid"%(dataLenStr))
+	if dataLen<=0:
+		raise VizError(VizError.BAD_PROTOCOL, "Message length = %d is invalid"%(dataLen))
+	return [FRAME_V1_HEADER_LENGTH, dataLen]
+
+# Messages upto this size are copied behind their header, and sent with
+# a single send. Larger ones are sent as is, after the header.
+SEND_COPY_LIMIT = 64*1024
 
-	sock.send(dataLen)
-	sock.send(message)
+def setNoDelay(sock):
+	"""
+	Disable Nagle's algorithm on a TCP socket. Our messages are requests and
+	responses; holding back a small segment till the previous one is ACKed
+	only adds latency. Other sockets are left alone.
+	"""
+	if sock.family in [socket.AF_INET, socket.AF_INET6]:
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def sendMessageOnSocket(sock, message, framing=None):
+	header = encodeFrameHeader(len(message), framing)
+	# A header sent by itself goes out as a tiny segment. If the peer delays
+	# its ACK, the message behind it waits.
+	if len(message) <= SEND_COPY_LIMIT:
+		sock.sendall(header+message)
+	else:
+		sock.sendall(header)
+		sock.sendall(message)
+
+def __recvExactly(sock, nBytes):
+	chunks = []
+	nReceived = 0
+	while nReceived < nBytes:
+		data = sock.recv(min(nBytes-nReceived, 1024*1024))
+		if len(data)==0:
+			break
+		chunks.append(data)
+		nReceived += len(data)
+	return ''.join(chunks)
 
 def readMessageFromSocket(sock):
 	try:
-		dataLenStr = sock.recv(5)
-		if len(dataLenStr)==0:
+		header = __recvExactly(sock, FRAME_V1_HEADER_LENGTH)
+		if len(header)==0:
 			raise VizError(VizError.NOT_CONNECTED, "Socket Disconnected")
-		if len(dataLenStr)!=5:
-			raise VizError(VizError.BAD_PROTOCOL, "Message length should be indicated in 5 bytes, not '%s'"%(dataLenStr))
+		if len(header)!=FRAME_V1_HEADER_LENGTH:
+			raise VizError(VizError.BAD_PROTOCOL, "Message length should be indicated in 5 bytes, not '%s'"%(header))
+		if header[0] == FRAME_V2_MARKER:
+			header = header + __recvExactly(sock, FRAME_V2_HEADER_LENGTH-FRAME_V1_HEADER_LENGTH)
+			if len(header)!=FRAME_V2_HEADER_LENGTH:
+				raise VizError(VizError.BAD_PROTOCOL, "Incomplete message header")
 
-		try:
-			dataLen = int(dataLenStr)
-			if dataLen<=0:
-				raise VizError(VizError.BAD_PROTOCOL, "Message length = %d is invalid"%(dataLen))
-		except ValueError, e:
-			raise VizError(VizError.BAD_PROTOCOL, "Message length = %s is invalid"%(dataLenStr))
-		
-		# FIXME: is the below loop necessary ? it's a blocking socket afterall, right ?
-		payload =''
-		while len(payload)<dataLen:
-			data = sock.recv(dataLen-len(payload))
-			if len(data)==0:
-				break
-			payload = payload + data
+		headerLen, dataLen = decodeFrameHeader(header)
+
+		payload = __recvExactly(sock, dataLen)
 
 		if len(payload)!=dataLen:
-			raise VizError(VizError.BAD_PROTOCOL, "Incomplete message. Expected message of length %s, got message of lenght %d"%(dataLenStr, len(payload)))
+			raise VizError(VizError.BAD_PROTOCOL, "Incomplete message. Expected message of length %d, got message of lenght %d"%(dataLen, len(payload)))
 	except socket.error, e:
 		raise VizError(VizError.SOCKET_ERROR, str(e))
 
 	return payload
 
+def parseResponse(msg):
+	"""
+	Parse a response message from the SSM. Returns [statusCode, statusMessage, dom]
+	where dom is the XML tree representing the response.
+	"""
+	dom = None
+	try:
+		dom = domutil.parseDocument(msg)
+	except xml.parsers.expat.ExpatError, e:
+		# bad return XML point to deep problems
+		raise VizError(VizError.INTERNAL_ERROR, "Improperly formed return XML from SSM.\n XML Error : %s \nReturned XML:%s\n"%(str(e),msg))
+	doc = dom.documentElement
+	responseNode = domutil.getChildNode(doc, "response")
+	if responseNode is None:
+		raise VizError(VizError.BAD_PROTOCOL, "Incorrect XML response from SSM - missing response node")
+	statusNode = domutil.getChildNode(responseNode, "status")
+	if statusNode is None:
+		raise VizError(VizError.BAD_PROTOCOL, "Incorrect XML response from SSM - missing status node")
+	statusValue = domutil.getValue(statusNode)
+	if len(statusValue)==0:
+		raise VizError(VizError.BAD_PROTOCOL, "Incorrect XML response from SSM - status is empty")
+	try:
+		statusCode = int(statusValue)
+	except ValueError, e:
+		raise VizError(VizError.BAD_PROTOCOL, "Incorrect XML response from SSM - bad status value. Reason %s"%(str(e)))
+	messageNode = domutil.getChildNode(responseNode, "message")
+	if messageNode is None:
+		statusMessage = ""
+	else:
+		statusMessage = domutil.getValue(messageNode)
+
+	return [statusCode, statusMessage, dom]
+
+def tagRequest(request, requestId):
+	"""
+	Return the XML of a request (e.g. "<allocate>...</allocate>"), with
+	requestId added to it as the "id" attribute. The SSM tags the response
+	with the same ID, as the "id" attribute of <ssm>.
+	"""
+	match = re.match(r'\s*<[a-z_]+', request)
+	if match is None:
+		raise ValueError, "Bad request '%s'"%(request)
+	return '%s id="%d"%s'%(request[:match.end()], requestId, request[match.end():])
+
+# An SSM which supports request IDs sends this to clients which ask for
+# them when they connect, before any response. Older SSMs send nothing.
+SSM_HANDSHAKE_REPLY = "<ssm><client><requestIds>1</requestIds></client></ssm>"
+
 def getMasterParameters(filepath = masterConfigFile):
 	try:
-		dom = minidom.parse(filepath)
+		dom = domutil.parse(filepath)
 	except xml.parsers.expat.ExpatError, e:
 		raise ValueError, str(e)
 	rootNode = dom.documentElement
@@ -4224,202 +4649,110 @@ def getMasterParameters(filepath = masterConfigFile):
 		
 	return [master, masterPort, masterAuth]
 
-class ResourceAccess:
+def connectToSSM(host, port, masterAuth, cleanupOnDisconnect, requestIds=False):
 	"""
-	The main class for gaining access to resources.
+	Connect to the SSM, and identify ourselves. A host of "localhost" means
+	the Unix domain socket of the SSM on this node. Returns the socket.
 
-	Usage of this class is needed for allocation/cleanup and interacting with resources.
+	If requestIds is True, then we ask whether the SSM supports request IDs.
+	If it does, then the first message it sends is SSM_HANDSHAKE_REPLY.
 	"""
+	options = ''
+	if requestIds:
+		options = '<requestIds>1</requestIds>'
+	payload = '<client><cleanupOnDisconnect>%d</cleanupOnDisconnect><framing>%d</framing>%s</client>'%(cleanupOnDisconnect, FRAMING_V2, options)
 
-	def __fini__(self):
-		# Finish handler for disconnecting from SSM.
-		# Not necessary at all - given that the socket will automatically disconnect
-		# anyway !
-		self.__endConnection()
+	# Connect using the right socket type, depending on the host
+	try:
+		if host == "localhost":
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			sock.connect(SSM_UNIX_SOCKET_ADDRESS)
+		else:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.connect((host,int(port)))
+	except socket.error, e:
+		raise VizError(VizError.NOT_CONNECTED, "Failed to connect to SSM. Please ensure that it is running. Reason: %s"%(str(e)))
+	setNoDelay(sock)
 
-	def __init__(self, cleanupOnDisconnect=True):
-		"""
-		If cleanupOnDisconnect is True, then all allocations made on this connection
-		are freed up when the connection to the SSM is either closed OR lost. The cleanup
-		is done on the SSM side.
+	if host != "localhost":
+		# If we use TCP sockets, then we'll have to authenticate
+		payload = encode_message_with_auth(masterAuth, payload)
 
-		This flag is provided as a convenience to user scripts.  
+	# Cleanup if sending the message failed
+	try:
+		sendMessageOnSocket(sock, payload)
+	except Exception, e:
+		try:
+			closeSocket(sock)
+		except socket.error, e2:
+			pass
+		raise e
 
-		Resource cleanup in user scripts tends to become complicated, especially 
-		when scripts are either terminated or fail (could be during development or due to
-		runtime conditions). This flag helps in such cases. By shifting 
-		the burden of the cleanup to the server side, we guarantee proper cleanup 
-		on script termination. This way, user scripts do not lead to an unusable system.
-		"""
-		self.sock = None
-		if cleanupOnDisconnect is None:
-			raise ValueError, "Bad value for cleanupOnDisconnect"
-		if not isinstance(cleanupOnDisconnect, bool):
-			raise ValueError, "cleanupOnDisconnect must be a boolean"
+	return sock
 
-		self.cleanupOnDisconnect = cleanupOnDisconnect
+class SSMProtocol:
+	"""
+	Builds the requests to the SSM, and decodes its responses.
 
-		[self.masterHost, self.masterPort, self.masterAuth] = getMasterParameters()
-		self.start()
+	Each _xxxRequest function validates its arguments, and returns
+	[request, decoder]. request is the XML of the request, without the
+	<ssm> envelope. decoder is a function that takes the response to it
+	([statusCode, statusMessage, dom]), and returns the result - or raises
+	a VizError if the request failed.
 
-	def start(self, host=None, port=None):
+	This is shared by ResourceAccess and vsasync.AsyncResourceAccess, which
+	differ only in how the requests are sent.
+	"""
+
+	def _getTemplateSource(self):
 		"""
-		Connect to the SSM. Practically, every useful client will need to do this.
+		Return what the X servers of allocated resource groups are
+		validated against - a ResourceAccess, or a list of templates
 		"""
-		if host is None:
-			host = self.masterHost
-		if port is None:
-			port = self.masterPort
-
-		payload = '<client><cleanupOnDisconnect>%d</cleanupOnDisconnect></client>'%(self.cleanupOnDisconnect)
-
-		# Connect using the right socket type, depending on the host
-		try:
-			if host == "localhost":
-				sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-				sock.connect(SSM_UNIX_SOCKET_ADDRESS)
-			else:
-				sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				sock.connect((host,int(port)))
-		except socket.error, e:
-			raise VizError(VizError.NOT_CONNECTED, "Failed to connect to SSM. Please ensure that it is running. Reason: %s"%(str(e)))
-
-		if host != "localhost":
-			# If we use TCP sockets, then we'll have to authenticate
-			payload = encode_message_with_auth(self.masterAuth, payload)
-
-		self.sock = sock
-
-		# Cleanup if sending the message failed
-		try:
-			sendMessageOnSocket(sock, payload)
-		except Exception, e:
-			self.__endConnection()
-			raise e
-
-	def __endConnection(self):
-		if self.sock is not None:
-			try:
-				closeSocket(self.sock)
-			except socket.error, e:
-				pass
-		self.sock = None
+		raise NotImplementedError, "_getTemplateSource has to be implemented"
 
-	def stop(self):
+	def _getValidator(self):
 		"""
-		Disconnect from the SSM
+		Return the ResourceAccess that allocated GPUs use for validation,
+		or None
 		"""
-		self.__endConnection()
+		raise NotImplementedError, "_getValidator has to be implemented"
 
-	def __sendAndRecvMessage(self, message):
+	def _checkStatus(self, response, errorCode=VizError.USER_ERROR):
 		"""
 		Internal use function.
 
-		Send message and receive response from the SSM, all in one step.
-		Returns [statusCode, statusMessage, dom] where dom is the XML tree representing the response
-		All errors are handled. Including this function has made the code so readable !
-		"""
-		try:
-			sendMessageOnSocket(self.sock, message)
-			msg = readMessageFromSocket(self.sock)
-			dom = None
-			try:
-				dom = xml.dom.minidom.parseString(msg)
-			except xml.parsers.expat.ExpatError, e:
-				# bad return XML point to deep problems
-				raise VizError(VizError.INTERNAL_ERROR, "Improperly formed return XML from SSM.\n XML Error : %s \nReturned XML:%s\n"%(str(e),msg))
-			doc = dom.documentElement
-			responseNode = domutil.getChildNode(doc, "response")
-			if responseNode is None:
-				raise VizError(VizError.BAD_PROTOCOL, "Incorrect XML response from SSM - missing response node")
-			statusNode = domutil.getChildNode(responseNode, "status")
-			if statusNode is None:
-				raise VizError(VizError.BAD_PROTOCOL, "Incorrect XML response from SSM - missing status node")
-			statusValue = domutil.getValue(statusNode)
-			if len(statusValue)==0:
-				raise VizError(VizError.BAD_PROTOCOL, "Incorrect XML response from SSM - status is empty")
-			try:
-				statusCode = int(statusValue)
-			except ValueError, e:
-				raise VizError(VizError.BAD_PROTOCOL, "Incorrect XML response from SSM - bad status value. Reason %s"%(str(e)))
-			messageNode = domutil.getChildNode(responseNode, "message")
-			if messageNode is None:
-				statusMessage = ""
-			else:
-				statusMessage = domutil.getValue(messageNode)
-		except VizError, e:
-			print "************** DISCONNECTING CLIENT ******************" 
-			self.__endConnection()
-			print "VizError :  %s"%(repr(e))
-			raise 
-
-		return [statusCode, statusMessage, dom]
-	def attach(self, allocId):
+		Raise a VizError if response indicates a failure.
 		"""
-		attach(allocId)
-
-		Attach to an  existing allocation. Only the user to whom the allocation belongs
-		(or root) can attach to the allocation.
-
-		Return value :
-
-		On successful allocation, an allocation object is returned that contains all the resources
-		allocated to this allocation ID.
+		statusCode, statusMessage, dom = response
+		if statusCode!=0:
+			raise VizError(errorCode, statusMessage)
 
-		On failure, a VizError exception is thrown.
-		"""
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+	def _noResult(self, response):
+		self._checkStatus(response)
 
+	def _attachRequest(self, allocId):
 		if not isinstance(allocId, int):
 			raise TypeError, "You need to pass an integer as allocId"
 
 		if allocId<0:
 			raise ValueError, "allocId needs to be positive"
 
-		message = "<ssm><attach><allocId>%d</allocId></attach></ssm>"%(allocId)
-
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
-
-		if statusCode!=0:
-			raise VizError(VizError.USER_ERROR, statusMessage)
-
-		return self.__decodeAllocation(dom)
+		return ["<attach><allocId>%d</allocId></attach>"%(allocId), self._decodeAllocation]
 	
-	def allocate(self, reqResList, chooseNodeList=[], appName=None):
-		"""
-		allocate(reqResList, chooseNodeList)
-		
-		Allocate resources. reqResList is a list of resource requirements, with each element being a required
-		resource.
+	def _allocateRequest(self, reqResList, chooseNodeList=[], appName=None, waitTimeout=None, priority=0):
+		if waitTimeout is not None:
+			if (type(waitTimeout) is not int) or (waitTimeout<0):
+				raise ValueError, "waitTimeout needs to be a non-negative integer (secs)"
+		if type(priority) is not int:
+			raise ValueError, "priority needs to be an integer"
 
-		An appName can be given to an allocation. This can help users identify an allocation more
-		naturally.
-
-		Resources are chosen from chooseNodeList. If chooseNodeList is empty, then all nodes are 
-		candidates.
-
-		The viz resources that may be allocated by this call are
-		  - X servers
-		  - GPUs
-		  - Input devices : Keyboard, mice
-		  - Resource Groups - these are aggregates of the above resources. If you pass an object with resources inside it, then the SSM will allocate the resources you need & ignore the name.  If no resources are specified but you pass a resource group name known to the SSM, then the SSM will allocate that. 
-		  - VizNodes. You may allocate complete nodes by passing just the nodename. You may allocate resources inside nodes by adding them to nodes. If a name s not specified for the node, then it is assumed that the best fit node will be chosen.
-		
-		Returned Value : 
-		
-		On successful allocation, an allocation object is returned. This allocation object encapsulates the allocated resource as  list.
-		Each element of this list corresponds to the requirement in the same position in the reqResList.
-		On failure, a VizError exception is thrown.
-		"""
 		if appName is None:
 			appName = sys.argv[0]
 			# remove any path prefix
 			exeName = appName.rfind('/')
 			if exeName != -1:
 				appName = appName[exeName+1:]
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
 
 		if not isinstance(chooseNodeList, list):
 			raise TypeError, "You need to pass a list for possible nodes to choose from"
@@ -4430,7 +4763,7 @@ class ResourceAccess:
 			else:
 				nodeSpec += "<search_node>%s</search_node>"%(nodeName)
 
-		message = """<ssm><allocate>"""
+		message = """<allocate>"""
 		if appName is not None:
 			message += "<appName>%s</appName>"%(appName)
 		for req in reqResList:
@@ -4454,16 +4787,19 @@ class ResourceAccess:
 			message = message+ "</resdesc>"
 
 		message += nodeSpec
-		message = message + "</allocate></ssm>"
-
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
+		if waitTimeout is not None:
+			message += "<wait><timeout>%d</timeout><priority>%d</priority></wait>"%(waitTimeout, priority)
+		message = message + "</allocate>"
 
-		if statusCode!=0:
-			raise VizError(VizError.USER_ERROR, statusMessage)
+		return [message, self._decodeAllocation]
 
-		return self.__decodeAllocation(dom)
+	def _decodeAllocation(self, response):
+		# status 2 means that we timed out waiting for the resources
+		if response[0]==2:
+			self._checkStatus(response, VizError.RESOURCE_BUSY)
+		self._checkStatus(response)
+		dom = response[2]
 
-	def __decodeAllocation(self, dom):
 		# If we came here, then the allocation was successful
 		# create an Allocation object by deserializing the allocation
 		allocationNode = dom.getElementsByTagName("allocation")[0]
@@ -4494,7 +4830,7 @@ class ResourceAccess:
 				#
 				if isinstance(decodedObj, ResourceGroup):
 					# FIXME: If something fails here, then do we know who is to blame. The caller !?
-					decodedObj.setupXServers(self)
+					decodedObj.setupXServers(self._getTemplateSource())
 				innerRes = decodedObj
 			allocRes.append(innerRes)
 
@@ -4506,30 +4842,22 @@ class ResourceAccess:
 		# FIXME: is this the earliest time we can do this ??
 		allocGPUs = extractObjects(GPU, allocRes)
 		for gpu in allocGPUs:
-			gpu.setResourceAccess(self)
+			gpu.setResourceAccess(self._getValidator())
 
 		# Nothing succeeds like success !
 		return allocObj
 
-	def getAllocationList(self, allocId=None):
-		"""
-		"""
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+	def _getAllocationListRequest(self, allocId=None):
 		if allocId is None:
 			allocStr = ""
 		else:
 			allocStr = "<allocId>%d</allocId>"%(allocId)
 
-		message = """
-		<ssm>
-			<query_allocation>%s</query_allocation>
-		</ssm>
-		"""%(allocStr)
+		return ["<query_allocation>%s</query_allocation>"%(allocStr), self._decodeAllocationList]
 
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
-		if statusCode!=0:
-			raise VizError(VizError.USER_ERROR, statusMessage)
+	def _decodeAllocationList(self, response):
+		self._checkStatus(response)
+		dom = response[2]
 
 		returnedMatches = [] 
 		rvNode = dom.getElementsByTagName("return_value")[0] # FIXME: replace this with "ssm/response/return_value"
@@ -4559,26 +4887,19 @@ class ResourceAccess:
 
 		return returnedMatches
 
-	def queryResources(self, what=None):
-		"""
-		"""
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+	def _queryResourcesRequest(self, what=None):
 		query = ""
 		if what is not None:
 			if not isinstance(what, VizResource):
 				raise TypeError, "Expecting a VizResource"
 			else:
 				query = what.serializeToXML()
-		message = """
-		<ssm>
-			<query_resource>%s</query_resource>
-		</ssm>
-		"""%(query)
 
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
-		if statusCode!=0:
-			raise VizError(VizError.USER_ERROR, statusMessage)
+		return ["<query_resource>%s</query_resource>"%(query), self._decodeResources]
+
+	def _decodeResources(self, response):
+		self._checkStatus(response)
+		dom = response[2]
 
 		returnedMatches = [] 
 		rvNode = dom.getElementsByTagName("return_value")[0] # FIXME: replace this with "ssm/response/return_value"
@@ -4591,23 +4912,15 @@ class ResourceAccess:
 
 		return returnedMatches
 
-	def getServerConfig(self, searchServer):
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+	def _getServerConfigRequest(self, searchServer):
 		if not isinstance(searchServer,Server):
 			raise ValueError, "I expect the searchServer to be a Server"
 
-		message = """
-		<ssm>
-			<get_serverconfig>
-			%s
-			</get_serverconfig>
-		</ssm>
-		"""%(searchServer.serializeToXML())
-
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
-		if statusCode!=0:
-			raise VizError(VizError.USER_ERROR, statusMessage)
+		return ["<get_serverconfig>%s</get_serverconfig>"%(searchServer.serializeToXML()), self._decodeServerConfig]
+
+	def _decodeServerConfig(self, response):
+		self._checkStatus(response)
+		dom = response[2]
 
 		rvNode = dom.getElementsByTagName("return_value")[0] # FIXME: replace this with "ssm/response/return_value"
 		srvNode = domutil.getChildNode(rvNode, Server.rootNodeName)
@@ -4615,10 +4928,7 @@ class ResourceAccess:
 
 		return decodedObj
 
-	def getTemplates(self, searchOb=None):
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
-
+	def _getTemplatesRequest(self, searchOb=None):
 		if searchOb is None:
 			searchExpr = ""
 		elif isinstance(searchOb, GPU) or isinstance(searchOb, DisplayDevice):
@@ -4626,11 +4936,11 @@ class ResourceAccess:
 		else:
 			raise ValueError, "Expected GPU or DisplayDevice or None as search object"
 		
-		message = "<ssm><get_templates>%s</get_templates></ssm>"%(searchExpr)
+		return ["<get_templates>%s</get_templates>"%(searchExpr), self._decodeTemplates]
 
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
-		if statusCode!=0:
-			raise VizError(VizError.USER_ERROR, statusMessage)
+	def _decodeTemplates(self, response):
+		self._checkStatus(response)
+		dom = response[2]
 
 		rvNode = dom.getElementsByTagName("return_value")[0] # FIXME: replace this with "ssm/response/return_value"
 		allTemplateNodes = domutil.getAllChildNodes(rvNode)
@@ -4644,46 +4954,7 @@ class ResourceAccess:
 
 		return retObs
 
-	def createGPU(self, resIndex=None, hostName=None, model=None):
-		"""
-		Create a GPU. Using this function may provide better validation compared to other methods.
-
-		FIXME: should we enhance this to fail if there are no instances of
-		the specified GPU model ?
-		"""
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
-		gpuTemplate = GPU(resIndex, hostName, model)
-
-		# If a complete address is specified, then we'll get all the details NOW !
-		if gpuTemplate.isCompletelyResolvable():
-			gpuTemplate = self.queryResources(gpuTemplate)
-		elif model is not None:
-			gpuTemplate = self.getTemplates(gpuTemplate)[0]
-
-		gpuTemplate.setResourceAccess(self) # Let the GPU do validation using us later
-
-		return gpuTemplate
-
-	def createDisplayDevice(self, displayDeviceType):
-		"""
-		Create a Display device of given type. This function will fail
-		if this kind of display device is not defined in the system.
-		"""
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
-
-		if not isinstance(displayDeviceType, str):
-			raise TypeError, "Expected type of display device as a string"
-		if len(displayDeviceType)==0:
-			raise ValueError, "You've passed an empty string. Pass a display device type"
-
-		return self.getTemplates(DisplayDevice(displayDeviceType))[0]
-		
-
-	def updateServerConfig(self, allocId, serverList):
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+	def _updateServerConfigRequest(self, allocId, serverList):
 		if type(allocId) is not int:
 			raise ValueError, "Allocation ID needs to be an integer"
 		if type(serverList) is not list:
@@ -4697,28 +4968,15 @@ class ResourceAccess:
 			newServerConfig = newServerConfig + s.serializeToXML()
 
 		message = """
-		<ssm>
 			<update_serverconfig>
 				<allocId>%d</allocId>
 				%s
 			</update_serverconfig>
-		</ssm>
 		"""%(allocId, newServerConfig)
 
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
-		if statusCode!=0:
-			raise VizError(VizError.USER_ERROR, statusMessage)
-
-		# Success !
-		return
+		return [message, self._noResult]
 
-	def waitXState(self, allocObj, state, timeout=X_WAIT_TIMEOUT, serverList=None):
-		"""
-		Wait till specified serves on an allocation reach required 'state'.
-		Timeout is specified in seconds. Pass None for an infinite timeout.
-		"""
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+	def _waitXStateRequest(self, allocObj, state, timeout=X_WAIT_TIMEOUT, serverList=None):
 		if not isinstance(allocObj, Allocation):
 			raise ValueError, "You need to pass an Allocation object to deallocate"
 
@@ -4741,26 +4999,17 @@ class ResourceAccess:
 		else:
 			timeoutStr = ""
 		message = """
-		<ssm>
 			<wait_x_state>
 				<allocId>%d</allocId>
 				<newState>%d</newState>
 				%s
 				%s
 			</wait_x_state>
-		</ssm>
 		"""%(allocObj.getId(), state, timeoutStr, waitServers)
 
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
-		if statusCode!=0:
-			raise VizError(VizError.USER_ERROR, statusMessage)
-
-		# Success !
-		return
+		return [message, self._noResult]
 
-	def stopXServers(self, allocObj, serverList=None):
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+	def _stopXServersRequest(self, allocObj, serverList=None):
 		if not isinstance(allocObj, Allocation):
 			raise ValueError, "You need to pass an Allocation object to deallocate"
 
@@ -4774,27 +5023,15 @@ class ResourceAccess:
 				stopServers = stopServers + s.serializeToXML()
 
 		message = """
-		<ssm>
 			<stop_x_server>
 				<allocId>%d</allocId>
 				%s
 			</stop_x_server>
-		</ssm>
 		"""%(allocObj.getId(), stopServers)
 
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
-		if statusCode!=0:
-			raise VizError(VizError.USER_ERROR, statusMessage)
-
-		# Success !
-		return
+		return [message, self._noResult]
 
-	def deallocate(self, allocation):
-		"""
-		Free up an allocation. You may pass in an allocation object, or an allocation ID
-		"""
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+	def _deallocateRequest(self, allocation):
 		if isinstance(allocation, Allocation):
 			# get the ID corresponding to this allocation
 			resId = allocation.getId()
@@ -4803,14 +5040,382 @@ class ResourceAccess:
 		else:
 			raise TypeError, "You need to pass an Allocation object or an allocation ID to deallocate"
 
-		message = "<ssm><deallocate><allocId>%d</allocId></deallocate></ssm>"%(resId)
+		return ["<deallocate><allocId>%d</allocId></deallocate>"%(resId), self._noResult]
 
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
-		if statusCode!=0:
-			raise VizError(VizError.USER_ERROR, statusMessage)
+class ResourceAccess(SSMProtocol):
+	"""
+	The main class for gaining access to resources.
 
-		# Success !
-		return
+	Usage of this class is needed for allocation/cleanup and interacting with resources.
+
+	Many threads may use an object of this class at the same time. If the
+	SSM supports request IDs (it tells us so when we connect), then each
+	request carries one, and the SSM tags the response with it; so the
+	calls share the connection, and a call which waits (e.g. waitXState)
+	doesn't hold up the others. With older SSMs, and till we know which
+	kind we have, the calls go one at a time.
+	"""
+
+	def __fini__(self):
+		# Finish handler for disconnecting from SSM.
+		# Not necessary at all - given that the socket will automatically disconnect
+		# anyway !
+		self.__endConnection()
+
+	def __init__(self, cleanupOnDisconnect=True):
+		"""
+		If cleanupOnDisconnect is True, then all allocations made on this connection
+		are freed up when the connection to the SSM is either closed OR lost. The cleanup
+		is done on the SSM side.
+
+		This flag is provided as a convenience to user scripts.  
+
+		Resource cleanup in user scripts tends to become complicated, especially 
+		when scripts are either terminated or fail (could be during development or due to
+		runtime conditions). This flag helps in such cases. By shifting 
+		the burden of the cleanup to the server side, we guarantee proper cleanup 
+		on script termination. This way, user scripts do not lead to an unusable system.
+		"""
+		self.sock = None
+		self.lock = threading.Condition() # protects the state below
+		self.sendLock = threading.Lock() # held while a message is sent
+		self.exchangeLock = threading.Lock() # held for a whole call, if requests can't be tagged
+		self.requestIds = None # does the SSM support request IDs ? None till we know
+		self.nextRequestId = 1
+		self.untagged = [] # IDs of the requests sent without a tag, in order. Their responses come in the same order
+		self.responses = {} # request ID -> response, for responses which have been received
+		self.reading = False # is some thread receiving from the socket ?
+		self.error = None # why the connection was lost
+		if cleanupOnDisconnect is None:
+			raise ValueError, "Bad value for cleanupOnDisconnect"
+		if not isinstance(cleanupOnDisconnect, bool):
+			raise ValueError, "cleanupOnDisconnect must be a boolean"
+
+		self.cleanupOnDisconnect = cleanupOnDisconnect
+
+		[self.masterHost, self.masterPort, self.masterAuth] = getMasterParameters()
+		self.start()
+
+	def start(self, host=None, port=None):
+		"""
+		Connect to the SSM. Practically, every useful client will need to do this.
+		"""
+		if host is None:
+			host = self.masterHost
+		if port is None:
+			port = self.masterPort
+
+		sock = connectToSSM(host, port, self.masterAuth, self.cleanupOnDisconnect, True)
+
+		self.lock.acquire()
+		self.sock = sock
+		self.requestIds = None
+		self.untagged = []
+		self.responses = {}
+		self.error = None
+		self.lock.release()
+
+	def _getTemplateSource(self):
+		return self
+
+	def _getValidator(self):
+		return self
+
+	def __endConnection(self):
+		if self.sock is not None:
+			try:
+				closeSocket(self.sock)
+			except socket.error, e:
+				pass
+		self.sock = None
+
+	def stop(self):
+		"""
+		Disconnect from the SSM
+		"""
+		self.__endConnection()
+
+	def __exchange(self, messages, tagged=True):
+		"""
+		Internal use function.
+
+		Send requests to the SSM in one message, and receive their responses.
+		Returns the responses in the order of the requests. A response is
+		[statusCode, statusMessage, dom] where dom is the XML tree representing
+		the response.
+
+		If tagged is True, then each request carries a request ID, and the
+		SSM acts on it independently of the others. Otherwise, the SSM acts on
+		the requests in order.
+
+		Requests are tagged only if the SSM supports request IDs. Else, they
+		go untagged, and only one call talks to the SSM at a time.
+		"""
+		if self.requestIds:
+			return self.__sendRequests(messages, tagged)
+		self.exchangeLock.acquire()
+		try:
+			return self.__sendRequests(messages, False)
+		finally:
+			self.exchangeLock.release()
+
+	def __sendRequests(self, messages, tagged):
+		"""
+		Internal use function. See __exchange.
+		"""
+		self.sendLock.acquire()
+		try:
+			self.lock.acquire()
+			try:
+				if self.sock is None:
+					raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+				sock = self.sock
+				requestIds = range(self.nextRequestId, self.nextRequestId+len(messages))
+				self.nextRequestId += len(messages)
+				if tagged:
+					messages = map(tagRequest, messages, requestIds)
+				else:
+					self.untagged.extend(requestIds)
+			finally:
+				self.lock.release()
+
+			try:
+				sendMessageOnSocket(sock, "<ssm>%s</ssm>"%(''.join(messages)))
+			except VizError, e:
+				self.__connectionLost(e)
+				raise
+		finally:
+			self.sendLock.release()
+
+		return map(self.__waitForResponse, requestIds)
+
+	def __waitForResponse(self, requestId):
+		"""
+		Internal use function.
+
+		Wait for the response to a request. One of the waiting threads
+		receives from the socket at a time, and hands over the responses
+		to the threads they are meant for.
+		"""
+		self.lock.acquire()
+		try:
+			while not self.responses.has_key(requestId):
+				if self.error is not None:
+					raise self.error
+				if self.reading:
+					self.lock.wait()
+					continue
+
+				self.reading = True
+				sock = self.sock
+				self.lock.release()
+				try:
+					try:
+						msg = readMessageFromSocket(sock)
+						if msg == SSM_HANDSHAKE_REPLY:
+							response = None
+						else:
+							response = parseResponse(msg)
+						error = None
+					except VizError, e:
+						error = e
+				finally:
+					self.lock.acquire()
+					self.reading = False
+					self.lock.notifyAll()
+
+				if (error is None) and (response is None):
+					if self.requestIds is None:
+						self.requestIds = True
+						continue
+					error = VizError(VizError.BAD_PROTOCOL, "Got a second handshake from the SSM")
+				if error is None:
+					# No handshake before the first response means
+					# that the SSM doesn't support request IDs
+					if self.requestIds is None:
+						self.requestIds = False
+					responseId = response[2].documentElement.getAttribute("id")
+					if len(responseId)>0:
+						self.responses[int(responseId)] = response
+						continue
+					if len(self.untagged)>0:
+						self.responses[self.untagged.pop(0)] = response
+						continue
+					error = VizError(VizError.BAD_PROTOCOL, "Got a response from the SSM, without a request")
+				self.lock.release()
+				try:
+					self.__connectionLost(error)
+				finally:
+					self.lock.acquire()
+				raise error
+
+			return self.responses.pop(requestId)
+		finally:
+			self.lock.release()
+
+	def __connectionLost(self, error):
+		"""
+		Internal use function.
+
+		Disconnect from the SSM after an error, and let the threads waiting
+		for responses know.
+		"""
+		print "************** DISCONNECTING CLIENT ******************" 
+		self.__endConnection()
+		print "VizError :  %s"%(repr(error))
+		self.lock.acquire()
+		if self.error is None:
+			self.error = error
+		self.lock.notifyAll()
+		self.lock.release()
+
+	def __doRequest(self, request):
+		"""
+		Internal use function.
+
+		Send a request made by one of the _xxxRequest functions, and return
+		the decoded response.
+		"""
+		message, decoder = request
+		return decoder(self.__exchange([message])[0])
+
+	def _doBatch(self, requests):
+		"""
+		Internal use function. Use batch() instead.
+
+		Send all the requests in one message, and return their responses,
+		in order. The SSM acts on them in order, too.
+		"""
+		return self.__exchange(map(lambda x: x[0], requests), False)
+
+	def batch(self):
+		"""
+		Return a RequestBatch, which sends many requests to the SSM in one go.
+		"""
+		return RequestBatch(self)
+
+	def attach(self, allocId):
+		"""
+		attach(allocId)
+
+		Attach to an  existing allocation. Only the user to whom the allocation belongs
+		(or root) can attach to the allocation.
+
+		Return value :
+
+		On successful allocation, an allocation object is returned that contains all the resources
+		allocated to this allocation ID.
+
+		On failure, a VizError exception is thrown.
+		"""
+		return self.__doRequest(self._attachRequest(allocId))
+
+	def allocate(self, reqResList, chooseNodeList=[], appName=None, waitTimeout=None, priority=0):
+		"""
+		allocate(reqResList, chooseNodeList, appName, waitTimeout, priority)
+		
+		Allocate resources. reqResList is a list of resource requirements, with each element being a required
+		resource.
+
+		An appName can be given to an allocation. This can help users identify an allocation more
+		naturally.
+
+		Resources are chosen from chooseNodeList. If chooseNodeList is empty, then all nodes are 
+		candidates.
+
+		The viz resources that may be allocated by this call are
+		  - X servers
+		  - GPUs
+		  - Input devices : Keyboard, mice
+		  - Resource Groups - these are aggregates of the above resources. If you pass an object with resources inside it, then the SSM will allocate the resources you need & ignore the name.  If no resources are specified but you pass a resource group name known to the SSM, then the SSM will allocate that. 
+		  - VizNodes. You may allocate complete nodes by passing just the nodename. You may allocate resources inside nodes by adding them to nodes. If a name s not specified for the node, then it is assumed that the best fit node will be chosen.
+
+		If the resources are busy, then the allocation fails right away. Pass waitTimeout (in seconds) to
+		wait for them to be freed instead; the SSM allocates them when other allocations free them up.
+		Waiting allocations are served in the order of their priority (higher first; only root may use a
+		priority above 0). Among allocations with the same priority, users holding fewer allocations go
+		first, and each user's allocations are served in the order they were requested. Allocations
+		which fail for reasons other than busy resources fail right away, even with waitTimeout.
+		
+		Returned Value : 
+		
+		On successful allocation, an allocation object is returned. This allocation object encapsulates the allocated resource as  list.
+		Each element of this list corresponds to the requirement in the same position in the reqResList.
+		On failure, a VizError exception is thrown.
+		"""
+		return self.__doRequest(self._allocateRequest(reqResList, chooseNodeList, appName, waitTimeout, priority))
+
+	def getAllocationList(self, allocId=None):
+		"""
+		"""
+		return self.__doRequest(self._getAllocationListRequest(allocId))
+
+	def queryResources(self, what=None):
+		"""
+		"""
+		return self.__doRequest(self._queryResourcesRequest(what))
+
+	def getServerConfig(self, searchServer):
+		return self.__doRequest(self._getServerConfigRequest(searchServer))
+
+	def getTemplates(self, searchOb=None):
+		return self.__doRequest(self._getTemplatesRequest(searchOb))
+
+	def createGPU(self, resIndex=None, hostName=None, model=None):
+		"""
+		Create a GPU. Using this function may provide better validation compared to other methods.
+
+		FIXME: should we enhance this to fail if there are no instances of
+		the specified GPU model ?
+		"""
+		if self.sock is None:
+			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+		gpuTemplate = GPU(resIndex, hostName, model)
+
+		# If a complete address is specified, then we'll get all the details NOW !
+		if gpuTemplate.isCompletelyResolvable():
+			gpuTemplate = self.queryResources(gpuTemplate)
+		elif model is not None:
+			gpuTemplate = self.getTemplates(gpuTemplate)[0]
+
+		gpuTemplate.setResourceAccess(self) # Let the GPU do validation using us later
+
+		return gpuTemplate
+
+	def createDisplayDevice(self, displayDeviceType):
+		"""
+		Create a Display device of given type. This function will fail
+		if this kind of display device is not defined in the system.
+		"""
+		if self.sock is None:
+			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+
+		if not isinstance(displayDeviceType, str):
+			raise TypeError, "Expected type of display device as a string"
+		if len(displayDeviceType)==0:
+			raise ValueError, "You've passed an empty string. Pass a display device type"
+
+		return self.getTemplates(DisplayDevice(displayDeviceType))[0]
+		
+
+	def updateServerConfig(self, allocId, serverList):
+		return self.__doRequest(self._updateServerConfigRequest(allocId, serverList))
+
+	def waitXState(self, allocObj, state, timeout=X_WAIT_TIMEOUT, serverList=None):
+		"""
+		Wait till specified serves on an allocation reach required 'state'.
+		Timeout is specified in seconds. Pass None for an infinite timeout.
+		"""
+		return self.__doRequest(self._waitXStateRequest(allocObj, state, timeout, serverList))
+
+	def stopXServers(self, allocObj, serverList=None):
+		return self.__doRequest(self._stopXServersRequest(allocObj, serverList))
+
+	def deallocate(self, allocation):
+		"""
+		Free up an allocation. You may pass in an allocation object, or an allocation ID
+		"""
+		return self.__doRequest(self._deallocateRequest(allocation))
 
 	def refreshResourceGroups(self):
 		"""
@@ -4819,19 +5424,157 @@ class ResourceAccess:
 		Sending this message causes the SSM to reload the resource group information.
 		Typically, this message would be used after creating/deleting a Tiled Display.
 		"""
-		if self.sock is None:
-			raise VizError(VizError.NOT_CONNECTED, "Not connected to SSM")
+		def decode(response):
+			self._checkStatus(response, VizError.BAD_CONFIGURATION)
+		return self.__doRequest(["<refresh_resource_groups />", decode])
 
-		message = "<ssm><refresh_resource_groups /></ssm>"
+	def refreshNodeConfig(self):
+		"""
+		This is an administrative message. Will succeed only root sends it.
 
-		statusCode, statusMessage, dom = self.__sendAndRecvMessage(message)
-		if statusCode!=0:
-			raise VizError(VizError.BAD_CONFIGURATION, statusMessage)
+		Sending this message causes the SSM to reload the node configuration,
+		and the resource groups. Nodes and resources may be added or removed
+		this way, without disturbing the existing allocations.
 
-		# Success !
-		return
+		Returns a message from the SSM, summarizing what changed.
+		"""
+		def decode(response):
+			self._checkStatus(response, VizError.BAD_CONFIGURATION)
+			return response[1]
+		return self.__doRequest(["<refresh_node_config />", decode])
+
+class PendingResult:
+	"""
+	The result of a request in a RequestBatch. It is available once the
+	batch has been run.
+	"""
+	def __init__(self):
+		self.done = False
+		self.value = None
+		self.error = None
+
+	def _setValue(self, value):
+		self.done = True
+		self.value = value
+
+	def _setError(self, error):
+		self.done = True
+		self.error = error
+
+	def isDone(self):
+		return self.done
+
+	def failed(self):
+		return self.error is not None
+
+	def get(self):
+		"""
+		Return the result of the request. If the request failed, then the
+		exception it caused is raised.
+		"""
+		if not self.done:
+			raise VizError(VizError.USER_ERROR, "The batch containing this request hasn't been run yet")
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+class RequestBatch:
+	"""
+	A set of requests, which are sent to the SSM in one message. The SSM
+	acts on them in order, and sends a response for each. So a batch costs
+	one round trip, instead of one per request.
+
+	Usage :
+
+	  batch = ra.batch()
+	  nodes = batch.queryResources(VizNode())
+	  gpus = batch.queryResources(GPU())
+	  batch.run()
+	  print nodes.get(), gpus.get()
+
+	The functions of this class take the same arguments as the corresponding
+	functions of ResourceAccess, and return a PendingResult. Bad arguments
+	are reported right away.
+
+	The requests are independent - the failure of one doesn't stop the ones
+	after it. Note that a request which waits (e.g. waitXState) holds up the
+	ones after it.
+	"""
+	def __init__(self, ra):
+		self.ra = ra
+		self.requests = []
+		self.results = []
+
+	def __add(self, request):
+		result = PendingResult()
+		self.requests.append(request)
+		self.results.append(result)
+		return result
+
+	def attach(self, allocId):
+		return self.__add(self.ra._attachRequest(allocId))
+
+	def allocate(self, reqResList, chooseNodeList=[], appName=None, waitTimeout=None, priority=0):
+		return self.__add(self.ra._allocateRequest(reqResList, chooseNodeList, appName, waitTimeout, priority))
+
+	def getAllocationList(self, allocId=None):
+		return self.__add(self.ra._getAllocationListRequest(allocId))
+
+	def queryResources(self, what=None):
+		return self.__add(self.ra._queryResourcesRequest(what))
+
+	def getServerConfig(self, searchServer):
+		return self.__add(self.ra._getServerConfigRequest(searchServer))
+
+	def getTemplates(self, searchOb=None):
+		return self.__add(self.ra._getTemplatesRequest(searchOb))
+
+	def updateServerConfig(self, allocId, serverList):
+		return self.__add(self.ra._updateServerConfigRequest(allocId, serverList))
+
+	def waitXState(self, allocObj, state, timeout=X_WAIT_TIMEOUT, serverList=None):
+		return self.__add(self.ra._waitXStateRequest(allocObj, state, timeout, serverList))
+
+	def stopXServers(self, allocObj, serverList=None):
+		return self.__add(self.ra._stopXServersRequest(allocObj, serverList))
+
+	def deallocate(self, allocation):
+		return self.__add(self.ra._deallocateRequest(allocation))
+
+	def __len__(self):
+		return len(self.requests)
+
+	def run(self):
+		"""
+		Send all the requests, and get their results. Returns the list of
+		results, in the order of the requests. If any request failed, then
+		the exception caused by the first one to fail is raised; the results
+		of the others are still available from their PendingResult.
+
+		A batch can be run only once.
+		"""
+		if len(self.requests)==0:
+			return []
+		if self.results[0].isDone():
+			raise VizError(VizError.USER_ERROR, "This batch has been run already")
+
+		responses = self.ra._doBatch(self.requests)
+		firstError = None
+		for request, response, result in zip(self.requests, responses, self.results):
+			decoder = request[1]
+			try:
+				result._setValue(decoder(response))
+			except (VizError, ValueError), e:
+				result._setError(e)
+				if firstError is None:
+					firstError = e
+		if firstError is not None:
+			raise firstError
+		return map(lambda x: x.value, self.results)
 
 class VizNode(VizResourceAggregate):
+	__slots__ = ('model', 'properties', 'resources')
+
 	rootNodeName = "node"
 	ALL_PROPERTIES = ['remote_hostname', 'fast_network']
 
@@ -4842,6 +5585,10 @@ class VizNode(VizResourceAggregate):
 		self.properties = {}
 		self.resources = []
 
+	def _copyMembers(self, newRes, memo):
+		newRes.properties = self.properties.copy()
+		newRes.resources = map(lambda x: deepcopy(x, memo), self.resources)
+
 	def __init__(self, hostName=None, model=None, idx = None):
 		self.resClass = "VizNode"
 		self.__clearAll()
@@ -0,0 +1,405 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Asynchronous access to the SSM, for programs which drive many sessions
+at once (e.g. a web portal) from a single thread.
+
+Coroutines are generator functions. A coroutine yields a Future (or a
+list of Futures) to wait for it; the value of the yield expression is the
+result, and a failed Future raises its error at the yield. A coroutine
+returns a value by raising Return(value).
+
+  def session(ra):
+      alloc = yield ra.allocate([vsapi.GPU()])
+      yield ra.deallocate(alloc)
+
+  loop = vsasync.EventLoop()
+  ra = vsasync.AsyncResourceAccess(loop)
+  loop.run(loop.spawn(session(ra)))
+
+The functions of AsyncResourceAccess take the same arguments as the
+corresponding functions of vsapi.ResourceAccess, and return a Future.
+Each request carries a request ID, so any number of them can be
+outstanding on one connection. This needs an SSM which supports request
+IDs; with older ones, the requests fail with BAD_PROTOCOL.
+"""
+
+import time
+import socket
+import eventloop
+import vsapi
+from vsapi import VizError
+
+class Return(Exception):
+	"""
+	Raised by a coroutine to return a value.
+	"""
+	def __init__(self, value=None):
+		Exception.__init__(self)
+		self.value = value
+
+class Future:
+	"""
+	The result of an operation which completes later.
+	"""
+	def __init__(self):
+		self.done = False
+		self.result = None
+		self.error = None
+		self.callbacks = []
+
+	def setResult(self, result):
+		self.result = result
+		self.__finish()
+
+	def setError(self, error):
+		self.error = error
+		self.__finish()
+
+	def __finish(self):
+		if self.done:
+			raise VizError(VizError.INTERNAL_ERROR, "Future completed twice")
+		self.done = True
+		callbacks = self.callbacks
+		self.callbacks = []
+		for cb in callbacks:
+			cb(self)
+
+	def addCallback(self, cb):
+		"""
+		Call cb(future) when this completes. If it is complete already,
+		then cb is called right away.
+		"""
+		if self.done:
+			cb(self)
+		else:
+			self.callbacks.append(cb)
+
+	def isDone(self):
+		return self.done
+
+	def failed(self):
+		return self.error is not None
+
+	def getResult(self):
+		"""
+		Return the result. If the operation failed, then its error is raised.
+		"""
+		if not self.done:
+			raise VizError(VizError.USER_ERROR, "The operation hasn't completed yet")
+		if self.error is not None:
+			raise self.error
+		return self.result
+
+def gather(futures):
+	"""
+	Return a Future for the results of all the futures, as a list. It fails
+	with the error of the first one to fail.
+	"""
+	ret = Future()
+	results = [None]*len(futures)
+	remaining = [len(futures)]
+	if len(futures)==0:
+		ret.setResult(results)
+		return ret
+	def done(idx, f):
+		if ret.isDone():
+			return
+		if f.failed():
+			ret.setError(f.error)
+			return
+		results[idx] = f.result
+		remaining[0] -= 1
+		if remaining[0]==0:
+			ret.setResult(results)
+	for idx in range(len(futures)):
+		futures[idx].addCallback(lambda f, idx=idx: done(idx, f))
+	return ret
+
+class Task(Future):
+	"""
+	A coroutine that runs on an EventLoop. Completes with the value the
+	coroutine returns.
+	"""
+	def __init__(self, loop, coroutine):
+		Future.__init__(self)
+		self.loop = loop
+		self.coroutine = coroutine
+		loop.callSoon(self.__step, None, None)
+
+	def __step(self, value, error):
+		try:
+			if error is not None:
+				waitFor = self.coroutine.throw(error)
+			else:
+				waitFor = self.coroutine.send(value)
+		except StopIteration:
+			self.setResult(None)
+			return
+		except Return, r:
+			self.setResult(r.value)
+			return
+		except Exception, e:
+			self.setError(e)
+			return
+
+		if isinstance(waitFor, list):
+			waitFor = gather(waitFor)
+		if not isinstance(waitFor, Future):
+			self.loop.callSoon(self.__step, None, VizError(VizError.USER_ERROR, "A coroutine must yield a Future, or a list of Futures. Got %s"%(repr(waitFor))))
+			return
+		# Resume from the loop, not from inside whatever completed the future
+		waitFor.addCallback(lambda f: self.loop.callSoon(self.__step, f.result, f.error))
+
+class EventLoop:
+	"""
+	Runs coroutines, and dispatches events on sockets to their handlers.
+	Built on eventloop.Poller, like the SSM's main loop.
+	"""
+	def __init__(self):
+		self.poller = eventloop.Poller()
+		self.handlers = {} # fd -> handler(eventMask)
+		self.timers = eventloop.TimerQueue()
+		self.ready = [] # [function, args] to be called on the next iteration
+
+	def register(self, fd, events, handler):
+		self.poller.register(fd, events)
+		self.handlers[fd] = handler
+
+	def modify(self, fd, events):
+		self.poller.modify(fd, events)
+
+	def unregister(self, fd):
+		self.poller.unregister(fd)
+		self.handlers.pop(fd, None)
+
+	def callSoon(self, func, *args):
+		self.ready.append([func, args])
+
+	def callLater(self, delay, func, *args):
+		"""
+		Call func after delay seconds. Returns a handle for cancelTimer()
+		"""
+		return self.timers.add(time.time()+delay, [func, args])
+
+	def cancelTimer(self, handle):
+		self.timers.cancel(handle)
+
+	def sleep(self, delay):
+		"""
+		Return a Future which completes after delay seconds
+		"""
+		ret = Future()
+		self.callLater(delay, ret.setResult, None)
+		return ret
+
+	def spawn(self, coroutine):
+		"""
+		Run a coroutine. Returns a Task, which is a Future for its result.
+		"""
+		return Task(self, coroutine)
+
+	def run(self, future):
+		"""
+		Run till future completes, and return its result.
+		"""
+		while not future.isDone():
+			while len(self.ready)>0:
+				ready = self.ready
+				self.ready = []
+				for func, args in ready:
+					func(*args)
+			if future.isDone():
+				break
+
+			timeout = self.timers.getTimeout(time.time())
+			if (timeout is None) and (len(self.poller)==0):
+				raise VizError(VizError.USER_ERROR, "Nothing left to run. The future will never complete")
+			for fd, eventMask in self.poller.poll(timeout):
+				handler = self.handlers.get(fd)
+				if handler is not None:
+					handler(eventMask)
+			for func, args in self.timers.popExpired(time.time()):
+				func(*args)
+
+		return future.getResult()
+
+	def close(self):
+		self.poller.close()
+		self.handlers = {}
+
+class AsyncResourceAccess(vsapi.SSMProtocol):
+	"""
+	Asynchronous version of vsapi.ResourceAccess. See the top of this file.
+
+	The connection to the SSM is made when the object is created; this
+	blocks, as ResourceAccess does. The X servers of allocated resource
+	groups are validated against the templates, which are got from the
+	SSM the first time they are needed. Allocated GPUs don't validate
+	their settings against the SSM.
+	"""
+	def __init__(self, loop, cleanupOnDisconnect=True, host=None, port=None):
+		if not isinstance(cleanupOnDisconnect, bool):
+			raise ValueError, "cleanupOnDisconnect must be a boolean"
+		self.loop = loop
+		self.pending = {} # request ID -> [future, decoder]
+		self.nextRequestId = 1
+		self.requestIds = None # does the SSM support request IDs ? None till we know
+		self.templates = None
+
+		masterHost, masterPort, masterAuth = vsapi.getMasterParameters()
+		if host is None:
+			host = masterHost
+		if port is None:
+			port = masterPort
+		self.sock = vsapi.connectToSSM(host, port, masterAuth, cleanupOnDisconnect, True)
+		self.fd = self.sock.fileno()
+		self.channel = eventloop.MessageChannel(self.sock)
+		self.channel.setFraming(vsapi.FRAMING_V2)
+		loop.register(self.fd, eventloop.READ, self.__onEvent)
+
+	def _getTemplateSource(self):
+		return self.templates
+
+	def _getValidator(self):
+		return None
+
+	def stop(self):
+		"""
+		Disconnect from the SSM. Requests which are outstanding fail.
+		"""
+		self.__endConnection(VizError(VizError.NOT_CONNECTED, "Disconnected from the SSM"))
+
+	def __endConnection(self, error):
+		if self.sock is None:
+			return
+		self.loop.unregister(self.fd)
+		try:
+			vsapi.closeSocket(self.sock)
+		except socket.error, e:
+			pass
+		self.sock = None
+		self.channel = None
+		pending = self.pending
+		self.pending = {}
+		for future, decoder in pending.values():
+			future.setError(error)
+
+	def __send(self, message):
+		"""
+		Send a request; returns a Future for the response, as
+		[statusCode, statusMessage, dom]
+		"""
+		return self.__request([message, None])
+
+	def __request(self, request):
+		"""
+		Send a request made by one of the _xxxRequest functions. Returns a
+		Future for the decoded response. If the decoder is None, then the
+		Future is for the response itself.
+		"""
+		message, decoder = request
+		future = Future()
+		if self.sock is None:
+			future.setError(VizError(VizError.NOT_CONNECTED, "Not connected to SSM"))
+			return future
+		requestId = self.nextRequestId
+		self.nextRequestId += 1
+		self.pending[requestId] = [future, decoder]
+		self.channel.queueMessage("<ssm>%s</ssm>"%(vsapi.tagRequest(message, requestId)))
+		self.__flush()
+		return future
+
+	def __flush(self):
+		try:
+			self.channel.flush()
+			self.loop.modify(self.fd, self.channel.getEventMask())
+		except vsapi.VizError, e:
+			self.__endConnection(e)
+
+	def __onEvent(self, eventMask):
+		try:
+			if eventMask & (eventloop.WRITE|eventloop.ERROR|eventloop.HANGUP):
+				self.channel.flush()
+			messages = self.channel.readMessages()
+			for msg in messages:
+				if (msg == vsapi.SSM_HANDSHAKE_REPLY) and (self.requestIds is None):
+					self.requestIds = True
+					continue
+				if self.requestIds is None:
+					raise VizError(VizError.BAD_PROTOCOL, "The SSM doesn't support request IDs. A newer SSM is needed for asynchronous access")
+				response = vsapi.parseResponse(msg)
+				responseId = response[2].documentElement.getAttribute("id")
+				if (not responseId.isdigit()) or (not self.pending.has_key(int(responseId))):
+					raise VizError(VizError.BAD_PROTOCOL, "Got a response from the SSM, without a request")
+				future, decoder = self.pending.pop(int(responseId))
+				if decoder is None:
+					future.setResult(response)
+					continue
+				try:
+					result = decoder(response)
+				except (VizError, ValueError), e:
+					future.setError(e)
+				else:
+					future.setResult(result)
+			if self.sock is not None:
+				self.loop.modify(self.fd, self.channel.getEventMask())
+		except VizError, e:
+			self.__endConnection(e)
+
+	def __allocationRequest(self, request):
+		return self.loop.spawn(self.__getAllocation(request))
+
+	def __getAllocation(self, request):
+		message, decoder = request
+		response = yield self.__send(message)
+		# Resource groups need the templates to setup their X servers
+		if (response[0]==0) and (self.templates is None) and (len(response[2].getElementsByTagName(vsapi.ResourceGroup.rootNodeName))>0):
+			self.templates = yield self.getTemplates()
+		raise Return(decoder(response))
+
+	def attach(self, allocId):
+		return self.__allocationRequest(self._attachRequest(allocId))
+
+	def allocate(self, reqResList, chooseNodeList=[], appName=None, waitTimeout=None, priority=0):
+		return self.__allocationRequest(self._allocateRequest(reqResList, chooseNodeList, appName, waitTimeout, priority))
+
+	def getAllocationList(self, allocId=None):
+		return self.__request(self._getAllocationListRequest(allocId))
+
+	def queryResources(self, what=None):
+		return self.__request(self._queryResourcesRequest(what))
+
+	def getServerConfig(self, searchServer):
+		return self.__request(self._getServerConfigRequest(searchServer))
+
+	def getTemplates(self, searchOb=None):
+		return self.__request(self._getTemplatesRequest(searchOb))
+
+	def updateServerConfig(self, allocId, serverList):
+		return self.__request(self._updateServerConfigRequest(allocId, serverList))
+
+	def waitXState(self, allocObj, state, timeout=vsapi.X_WAIT_TIMEOUT, serverList=None):
+		return self.__request(self._waitXStateRequest(allocObj, state, timeout, serverList))
+
+	def stopXServers(self, allocObj, serverList=None):
+		return self.__request(self._stopXServersRequest(allocObj, serverList))
+
+	def deallocate(self, allocation):
+		return self.__request(self._deallocateRequest(allocation))
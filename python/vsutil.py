@@ -24,7 +24,7 @@ import subprocess
 import re
 import sys
 from glob import glob
-from xml.dom import minidom
+import xml.parsers.expat
 import xml
 import domutil
 import copy
@@ -415,7 +415,7 @@ def loadResourceGroups(sysConfig, rg_config_file=None):
 	except:
 		return resgroups
 	try:
-		dom = minidom.parse(rg_config_file)
+		dom = domutil.parse(rg_config_file)
 	except xml.parsers.expat.ExpatError, e:
 		raise vsapi.VizError(vsapi.VizError.BAD_CONFIGURATION, "Failed to parse XML file '%s'. Reason: %s"%(rg_config_file, str(e)))
 
@@ -475,7 +475,7 @@ def loadLocalConfig(
 	fileList += glob('%s/gpus/*.xml'%(overrideTemplateDir))
 	for fname in fileList:
 		try:
-			dom = minidom.parse(fname)
+			dom = domutil.parse(fname)
 		except xml.parsers.expat.ExpatError, e:
 			raise vsapi.VizError(vsapi.VizError.BAD_CONFIGURATION, "Failed to parse XML file '%s'. Reason: %s"%(fname, str(e)))
 
@@ -487,7 +487,7 @@ def loadLocalConfig(
 	fileList += glob('%s/displays/*.xml'%(overrideTemplateDir))
 	for fname in fileList:
 		try:
-			dom = minidom.parse(fname)
+			dom = domutil.parse(fname)
 		except xml.parsers.expat.ExpatError, e:
 			raise vsapi.VizError(vsapi.VizError.BAD_CONFIGURATION, "Failed to parse XML file '%s'. Reason: %s"%(fname, str(e)))
 
@@ -499,7 +499,7 @@ def loadLocalConfig(
 	fileList += glob('%s/keyboard/*.xml'%(overrideTemplateDir))
 	for fname in fileList:
 		try:
-			dom = minidom.parse(fname)
+			dom = domutil.parse(fname)
 		except xml.parsers.expat.ExpatError, e:
 			raise vsapi.VizError(vsapi.VizError.BAD_CONFIGURATION, "Failed to parse XML file '%s'. Reason: %s"%(fname, str(e)))
 		newObj = vsapi.deserializeVizResource(dom.documentElement, [vsapi.Keyboard])
@@ -510,7 +510,7 @@ def loadLocalConfig(
 	fileList += glob('%s/mouse/*.xml'%(overrideTemplateDir))
 	for fname in fileList:
 		try:
-			dom = minidom.parse(fname)
+			dom = domutil.parse(fname)
 		except xml.parsers.expat.ExpatError, e:
 			raise vsapi.VizError(vsapi.VizError.BAD_CONFIGURATION, "Failed to parse XML file '%s'. Reason: %s"%(fname, str(e)))
 
@@ -523,7 +523,7 @@ def loadLocalConfig(
 
 	# Check the master config file.	
 	try:
-		dom = minidom.parse(vsapi.masterConfigFile)
+		dom = domutil.parse(vsapi.masterConfigFile)
 	except xml.parsers.expat.ExpatError, e:
 		raise vsapi.VizError(vsapi.VizError.BAD_CONFIGURATION, "Failed to parse XML file '%s'. Reason: %s"%(vsapi.masterConfigFile, str(e)))
 
@@ -537,7 +537,7 @@ def loadLocalConfig(
 
 	# Read in the node configuration file. This includes the scheduler information
 	try:
-		dom = minidom.parse(node_config_file)
+		dom = domutil.parse(node_config_file)
 	except xml.parsers.expat.ExpatError, e:
 		raise vsapi.VizError(vsapi.VizError.BAD_CONFIGURATION, "Failed to parse XML file '%s'. Reason: %s"%(node_config_file, str(e)))
 
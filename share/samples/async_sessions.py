@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#
+# Starts many sessions on shared GPUs at the same time, from one thread,
+# using the asynchronous client in vsasync. Each session allocates a
+# shared GPU, sets up & starts the shared X server on it (like viz-vgl),
+# holds it for a while, and then gives it up.
+#
+# GPUs need to be configured for sharing (maxShareCount) for this to
+# succeed with a large number of sessions.
+#
+# Run as : python async_sessions.py [number of sessions] [hold time in seconds]
+#
+
+import vsapi
+import vsasync
+import sys
+import time
+
+nSessions = 200
+holdTime = 5.0
+if len(sys.argv)>1:
+	nSessions = int(sys.argv[1])
+if len(sys.argv)>2:
+	holdTime = float(sys.argv[2])
+
+def session(loop, ra):
+	# Allocate a shared GPU
+	gpu = vsapi.GPU()
+	gpu.setShared(True)
+	alloc = yield ra.allocate([ [gpu] ])
+	try:
+		gpu = alloc.getResources()[0][0]
+		srv = gpu.getSharedServer()
+
+		# Setup the X screen; a small virtual framebuffer
+		# is enough for rendering
+		screen = vsapi.Screen(0)
+		if gpu.getAllowNoScanOut():
+			gpu.clearScanouts()
+			screen.setFBProperty('resolution', [640,480])
+		elif len(gpu.getScanouts())==0:
+			sc = gpu.getScanoutCaps()
+			gpu.setScanout(0, 'HP LP2065', sc[0][0])
+		screen.setGPU(gpu)
+		srv.addScreen(screen)
+		yield ra.updateServerConfig(alloc.getId(), [srv])
+
+		# Start the X server, and wait for it to come up
+		srv.start(alloc.getId())
+		yield ra.waitXState(alloc, 1, serverList=[srv])
+
+		# Applications would run here, on srv.getDISPLAY()
+		yield loop.sleep(holdTime)
+
+		# Stop the X server
+		yield ra.stopXServers(alloc, [srv])
+		yield ra.waitXState(alloc, 0, serverList=[srv])
+	finally:
+		# Free the GPU, whatever happened. The exception (if any)
+		# propagates after this.
+		yield ra.deallocate(alloc)
+
+def runAll(loop, ra):
+	"""
+	Run all the sessions, and return the number which succeeded
+	"""
+	tasks = map(lambda x: loop.spawn(session(loop, ra)), range(nSessions))
+	for t in tasks:
+		# Wait for them all. Failures are reported, but don't stop
+		# the other sessions
+		try:
+			yield t
+		except vsapi.VizError, e:
+			print >>sys.stderr, "Session failed : %s"%(str(e))
+	raise vsasync.Return(len(filter(lambda t: not t.failed(), tasks)))
+
+loop = vsasync.EventLoop()
+ra = vsasync.AsyncResourceAccess(loop)
+
+t0 = time.time()
+nSucceeded = loop.run(loop.spawn(runAll(loop, ra)))
+print "%d of %d sessions succeeded, in %.2f seconds"%(nSucceeded, nSessions, time.time()-t0)
+
+ra.stop()
+loop.close()
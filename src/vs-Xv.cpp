@@ -54,6 +54,8 @@
 #include <sys/un.h>
 
 #include <netdb.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
 #include "vsdomparser.hpp"
 #include "vscommon.h"
 
@@ -280,6 +282,10 @@ int main(int argc, char**argv)
 				closeSocket(ssmSocket);
 				exit(-1);
 			}
+
+			// Our messages are requests & responses; don't hold them back
+			int noDelay = 1;
+			setsockopt(ssmSocket, IPPROTO_TCP, TCP_NODELAY, &noDelay, sizeof(noDelay));
 		}
 
 		string myIdentity;
@@ -8,6 +8,8 @@
 #include <sys/socket.h>
 #include <sys/un.h>
 #include <netdb.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
 using namespace std;
 
 bool g_standalone = false;
@@ -176,15 +178,14 @@ bool write_message(int socket, const char* data, unsigned int dataLen)
 	while(strlen(sizeStr)<5)
 		strcat(sizeStr, " ");
 
-	if(write_bytes(socket, sizeStr, 5)!=5)
+	// Send the header and the data with one write. A header written by
+	// itself goes out as a tiny segment, and the data may wait behind it
+	// for a delayed ACK.
+	string frame(sizeStr, 5);
+	frame.append(data, dataLen);
+	if(write_bytes(socket, frame.data(), frame.size())!=(int)frame.size())
 	{
-		fprintf(stderr,"Unable to write message header to scoket\n");
-		return false;
-	}
-
-	if(write_bytes(socket, data, dataLen)!=dataLen)
-	{
-		fprintf(stderr,"Unable to write message data to scoket\n");
+		fprintf(stderr,"Unable to write message to scoket\n");
 		return false;
 	}
 
@@ -483,6 +484,10 @@ int connectToSSM(string ssmHost, string ssmPort)
 			closeSocket(ssmSocket);
 			return -1;
 		}
+
+		// Our messages are requests & responses; don't hold them back
+		int noDelay = 1;
+		setsockopt(ssmSocket, IPPROTO_TCP, TCP_NODELAY, &noDelay, sizeof(noDelay));
 	}
 	return ssmSocket;
 }
@@ -0,0 +1,98 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#
+# bench_allocation.py
+#
+# Measures the time taken by the metascheduler to allocate and free
+# resources, as the number of nodes in the system grows. Half the nodes
+# are kept busy, so that the free resource index has work to do.
+#
+# No SSM or scheduler is needed; nodes are managed by the local scheduler.
+#
+# Run as : PYTHONPATH=../python python bench_allocation.py
+#
+
+import vsapi
+import metascheduler
+import localscheduler
+import time
+import sys
+
+nodeCounts = [16, 64, 256, 1024]
+nIterations = 200
+
+def makeNodes(n):
+	nodes = []
+	for i in range(n):
+		hostName = 'node%d'%(i)
+		node = vsapi.VizNode(hostName, 'bench', i)
+		for gpuIndex in range(2):
+			node.addResource(vsapi.GPU(gpuIndex, hostName, 'Quadro FX 5800', None, False))
+		for serverIndex in range(4):
+			node.addResource(vsapi.Server(serverIndex, hostName))
+		node.addResource(vsapi.Keyboard(0, hostName))
+		node.addResource(vsapi.Mouse(0, hostName))
+		nodes.append(node)
+	return nodes
+
+userInfo = { 'uid' : 1000, 'gid' : 1000 }
+
+# Each benchmark is [description, function returning a request]
+benchmarks = [
+	[ "GPU on a given node", lambda n: [vsapi.GPU(hostName='node%d'%(n-1))] ],
+	[ "GPU+server, given index", lambda n: [[vsapi.GPU(0,'node%d'%(n-1)), vsapi.Server(1,'node%d'%(n-1))]] ],
+	[ "GPU on any node", lambda n: [vsapi.GPU()] ],
+	[ "8 GPUs on any nodes", lambda n: map(lambda x: vsapi.GPU(), range(8)) ],
+]
+
+def benchOne(ms, makeRequest, n):
+	t0 = time.time()
+	for i in range(nIterations):
+		alloc = ms.allocate(makeRequest(n), userInfo, [])
+		ms.deallocate(alloc)
+	return (time.time()-t0)/nIterations
+
+print "%8s"%("nodes"),
+for desc, makeRequest in benchmarks:
+	print "%26s"%(desc),
+print
+print "%8s"%(""),
+for desc, makeRequest in benchmarks:
+	print "%26s"%("(ms per alloc+free)"),
+print
+
+for n in nodeCounts:
+	nodes = makeNodes(n)
+	sched = localscheduler.LocalScheduler(map(lambda x:x.getHostName(), nodes), "")
+	ms = metascheduler.Metascheduler(nodes, [sched], 0)
+
+	# keep the first half of the nodes busy
+	busy = []
+	for i in range(n/2):
+		busy.append(ms.allocate([vsapi.VizNode('node%d'%(i))], userInfo, []))
+
+	print "%8d"%(n),
+	for desc, makeRequest in benchmarks:
+		print "%26.3f"%(benchOne(ms, makeRequest, n)*1000),
+		sys.stdout.flush()
+	print
+
+	for alloc in busy:
+		ms.deallocate(alloc)
+	ms.close()
@@ -0,0 +1,87 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#
+# bench_allocation_soak.py
+#
+# Allocates and frees resources in the metascheduler many times over, like
+# a long running SSM would. Prints the memory used by this process as it
+# goes. The memory used should stay flat.
+#
+# No SSM or scheduler is needed; nodes are managed by the local scheduler.
+#
+# Run as : PYTHONPATH=../python python bench_allocation_soak.py [cycles]
+#
+
+import vsapi
+import metascheduler
+import localscheduler
+import time
+import sys
+
+nCycles = 1000000
+if len(sys.argv)>1:
+	nCycles = int(sys.argv[1])
+reportEvery = max(nCycles/10, 1)
+nNodes = 16
+freedHistory = 100
+
+def getRSS():
+	"""
+	Return the resident set size of this process, in KB.
+	"""
+	for line in open('/proc/self/status').readlines():
+		if line.startswith('VmRSS:'):
+			return int(line.split()[1])
+	return 0
+
+nodes = []
+for i in range(nNodes):
+	hostName = 'node%d'%(i)
+	node = vsapi.VizNode(hostName, 'bench', i)
+	for gpuIndex in range(2):
+		node.addResource(vsapi.GPU(gpuIndex, hostName, 'Quadro FX 5800', None, False))
+	for serverIndex in range(4):
+		node.addResource(vsapi.Server(serverIndex, hostName))
+	node.addResource(vsapi.Keyboard(0, hostName))
+	node.addResource(vsapi.Mouse(0, hostName))
+	nodes.append(node)
+
+sched = localscheduler.LocalScheduler(map(lambda x:x.getHostName(), nodes), "")
+ms = metascheduler.Metascheduler(nodes, [sched], 0, freedHistory=freedHistory)
+userInfo = { 'uid' : 1000, 'gid' : 1000 }
+
+# Keep a few allocations around at any time, freeing the oldest one on
+# every cycle. This way allocations don't get freed in the same order
+# as they were made.
+active = []
+for i in range(4):
+	active.append(ms.allocate([vsapi.GPU()], userInfo, []))
+
+print "%10s %10s %10s %10s %12s"%("cycles", "seconds", "active", "freed", "RSS (KB)")
+t0 = time.time()
+for cycle in xrange(1, nCycles+1):
+	active.append(ms.allocate([[vsapi.GPU(), vsapi.Server()]], userInfo, []))
+	ms.deallocate(active.pop(0))
+	if (cycle % reportEvery)==0:
+		print "%10d %10.1f %10d %10d %12d"%(cycle, time.time()-t0, len(ms.getAllocations()), len(ms.getFreedAllocations()), getRSS())
+		sys.stdout.flush()
+
+for alloc in active:
+	ms.deallocate(alloc)
+ms.close()
@@ -0,0 +1,119 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#
+# bench_clone.py
+#
+# Measures the time taken to copy the resources that the metascheduler and
+# the SSM copy most - nodes, X servers driving tiled displays and resource
+# groups. Copying using the resources' own __deepcopy__ is compared with
+# the generic copy.deepcopy, which walks every attribute of the objects.
+# The copies made both ways must serialize to the same XML.
+#
+# No SSM is needed.
+#
+# Run as : PYTHONPATH=../python python bench_clone.py
+#
+
+import vsapi
+import copy
+import time
+import sys
+
+nIterations = 200
+
+def makeNode(hostName):
+	node = vsapi.VizNode(hostName, 'bench', 0)
+	for gpuIndex in range(2):
+		node.addResource(vsapi.GPU(gpuIndex, hostName, 'Quadro FX 5800', 'PCI:%d:0:0'%(gpuIndex+1), True))
+	for serverIndex in range(4):
+		node.addResource(vsapi.Server(serverIndex, hostName))
+	node.addResource(vsapi.Keyboard(0, hostName))
+	node.addResource(vsapi.Mouse(0, hostName))
+	return node
+
+def makeTiledServer(n):
+	"""
+	An X server driving n displays, one screen for each display
+	"""
+	srv = vsapi.Server(0, 'node0')
+	for i in range(n):
+		gpu = vsapi.GPU(i/2, 'node0', 'Quadro FX 5800', 'PCI:%d:0:0'%(i/2+1), True)
+		gpu.setScanout(i%2, 'LP2065', 'digital')
+		scr = vsapi.Screen(i)
+		scr.setFBProperty('resolution', [1600, 1200])
+		scr.setFBProperty('position', [(i%4)*1600, (i/4)*1200])
+		scr.setGPU(gpu)
+		srv.addScreen(scr)
+	return srv
+
+def makeResourceGroup(n):
+	"""
+	A tiled display resource group using n nodes, each with a GPU and an X server
+	"""
+	resources = []
+	for i in range(n):
+		hostName = 'node%d'%(i)
+		resources.append([vsapi.GPU(0, hostName), vsapi.Server(0, hostName)])
+	params = "block_type='gpu';num_blocks=[%d,1];block_display_layout=[2,1];display_device='LP2065'"%(n)
+	return vsapi.ResourceGroup('bench', 'tiled_display', params, resources)
+
+def genericDeepcopy(ob):
+	"""
+	copy.deepcopy, as it works on objects without a __deepcopy__
+	"""
+	saved = [vsapi.VizResource.__dict__['__deepcopy__'], vsapi.Screen.__dict__['__deepcopy__']]
+	del vsapi.VizResource.__deepcopy__
+	del vsapi.Screen.__deepcopy__
+	try:
+		return copy.deepcopy(ob)
+	finally:
+		vsapi.VizResource.__deepcopy__ = saved[0]
+		vsapi.Screen.__deepcopy__ = saved[1]
+
+def benchOne(copyFunc, ob):
+	t0 = time.time()
+	for i in range(nIterations):
+		copyFunc(ob)
+	return (time.time()-t0)/nIterations
+
+# Each benchmark is [description, function making the object, sizes]
+benchmarks = [
+	[ "node", lambda n: map(lambda x:makeNode('node%d'%(x)), range(n)), [1, 16, 64] ],
+	[ "tiled server", makeTiledServer, [4, 16, 64] ],
+	[ "resource group", makeResourceGroup, [4, 16, 64] ],
+]
+
+print "%-18s %8s %16s %14s %8s"%("", "size", "deepcopy(ms)", "clone(ms)", "speedup")
+for desc, makeObject, sizes in benchmarks:
+	for n in sizes:
+		ob = makeObject(n)
+
+		# Both ways of copying must give the same result
+		if isinstance(ob, list):
+			serialize = lambda x: ''.join(map(lambda y:y.serializeToXML(), x))
+		else:
+			serialize = lambda x: x.serializeToXML()
+		if serialize(copy.deepcopy(ob)) != serialize(genericDeepcopy(ob)):
+			print "FAILED: copies of %s(%d) differ"%(desc, n)
+			sys.exit(1)
+
+		tGeneric = benchOne(genericDeepcopy, ob)
+		tClone = benchOne(copy.deepcopy, ob)
+		print "%-18s %8d %16.3f %14.3f %8.1f"%(desc, n, tGeneric*1000, tClone*1000, tGeneric/tClone)
+		sys.stdout.flush()
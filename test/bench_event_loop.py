@@ -0,0 +1,109 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#
+# bench_event_loop.py
+#
+# Measures the cost of dispatching one message to the SSM as the number of
+# connected (mostly idle) clients grows. Compares the old scheme - building
+# the select() list and scanning the client list for every wakeup - with
+# eventloop.Poller and a fd -> client map.
+#
+# Run as : PYTHONPATH=../python python bench_event_loop.py
+#
+# Two file descriptors are needed per client, so raise the limit first
+# (ulimit -n 12000) to run the larger cases.
+#
+
+import eventloop
+import socket
+import select
+import time
+import sys
+
+clientCounts = [10, 100, 1000, 5000]
+nMessages = 2000
+
+class Client:
+	def __init__(self, sock):
+		self.socket = sock
+		self.fd = sock.fileno()
+
+def makeClients(n):
+	clients = []
+	peers = []
+	for i in range(n):
+		a, b = socket.socketpair()
+		clients.append(Client(a))
+		peers.append(b)
+	return clients, peers
+
+def benchLegacy(clients, peers):
+	# what the SSM did earlier : rebuild the fd list, select, then find
+	# each ready socket by a linear scan of the client list
+	t0 = time.time()
+	for i in range(nMessages):
+		active = i % len(clients)
+		peers[active].send('x')
+		client_sockets = []
+		for c in clients:
+			client_sockets.append(c.socket)
+		rr, wr, er = select.select(client_sockets, [], [], None)
+		for s in rr:
+			for c in clients:
+				if c.socket == s:
+					c.socket.recv(1)
+					break
+	return (time.time()-t0)/nMessages
+
+def benchPoller(clients, peers):
+	poller = eventloop.Poller()
+	client_info = {}
+	for c in clients:
+		client_info[c.fd] = c
+		poller.register(c.fd, eventloop.READ)
+	t0 = time.time()
+	for i in range(nMessages):
+		active = i % len(clients)
+		peers[active].send('x')
+		for fd, eventMask in poller.poll(None):
+			client_info[fd].socket.recv(1)
+	elapsed = (time.time()-t0)/nMessages
+	poller.close()
+	return elapsed, poller.getKind()
+
+print "%8s %18s %18s"%("clients", "select+scan (us)", "poller (us)")
+for n in clientCounts:
+	try:
+		clients, peers = makeClients(n)
+	except socket.error, e:
+		print "%8d : skipped, %s"%(n, str(e))
+		continue
+	# select() can't handle descriptors beyond FD_SETSIZE
+	maxFd = max(map(lambda c: c.fd, clients))
+	if maxFd < 1024:
+		legacy = "%.1f"%(benchLegacy(clients, peers)*1e6)
+	else:
+		legacy = "n/a"
+	elapsed, kind = benchPoller(clients, peers)
+	print "%8d %18s %18s"%(n, legacy, "%.1f (%s)"%(elapsed*1e6, kind))
+	sys.stdout.flush()
+	for c in clients:
+		c.socket.close()
+	for p in peers:
+		p.close()
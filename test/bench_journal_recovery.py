@@ -0,0 +1,120 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#
+# bench_journal_recovery.py
+#
+# Measures what the SSM's allocation journal costs, and how long it takes
+# to recover the allocations from it after a restart. Allocations are
+# recorded the way the SSM does it - the resources & the scheduler
+# allocation, as XML. Recovery reads the journal, decodes the records and
+# takes over the allocations in a fresh metascheduler.
+#
+# No SSM or scheduler is needed; nodes are managed by the local scheduler.
+# The journal is written to a temporary directory.
+#
+# Run as : PYTHONPATH=../python python bench_journal_recovery.py [allocations]
+#
+
+import vsapi
+import metascheduler
+import localscheduler
+import journal
+import domutil
+import tempfile
+import shutil
+import os
+import time
+import sys
+
+nAllocations = 1000
+if len(sys.argv)>1:
+	nAllocations = int(sys.argv[1])
+nNodes = (nAllocations+1)/2
+userInfo = { 'uid' : 1000, 'gid' : 1000 }
+
+def makeMetascheduler():
+	nodes = []
+	for i in range(nNodes):
+		hostName = 'node%d'%(i)
+		node = vsapi.VizNode(hostName, 'bench', i)
+		for gpuIndex in range(2):
+			node.addResource(vsapi.GPU(gpuIndex, hostName, 'Quadro FX 5800', None, False))
+		for serverIndex in range(2):
+			node.addResource(vsapi.Server(serverIndex, hostName))
+		nodes.append(node)
+	sched = localscheduler.LocalScheduler(map(lambda x:x.getHostName(), nodes), "")
+	return metascheduler.Metascheduler(nodes, [sched], 0)
+
+def allocationRecord(allocId, alloc):
+	ret = ["<allocate><allocId>%d</allocId><allocation>"%(allocId)]
+	for res in alloc.getResources():
+		ret.append("<resource><value><list>%s</list></value></resource>"%(''.join(map(lambda x:x.serializeToXML(), res))))
+	ret.append("</allocation><launchers>")
+	for launcher, nodeList in alloc.getLaunchers():
+		ret.append("<launcher>%s%s</launcher>"%(launcher.serializeToXML(), ''.join(map(lambda x:"<hostName>%s</hostName>"%(x), nodeList))))
+	ret.append("</launchers></allocate>")
+	return ''.join(ret)
+
+def recover(ms, records):
+	for rec in records:
+		recNode = domutil.parseDocument(rec).documentElement
+		allocResources = []
+		for resNode in domutil.getChildNodes(domutil.getChildNode(recNode, "allocation"), "resource"):
+			listNode = domutil.getAllChildNodes(domutil.getChildNode(resNode, "value"))[0]
+			allocResources.append(map(lambda x: vsapi.deserializeVizResource(x, [vsapi.GPU, vsapi.Server]), domutil.getAllChildNodes(listNode)))
+		launcherInfo = []
+		for launcherNode in domutil.getChildNodes(domutil.getChildNode(recNode, "launchers"), "launcher"):
+			childNodes = domutil.getAllChildNodes(launcherNode)
+			launcherInfo.append([childNodes[0], map(domutil.getValue, childNodes[1:])])
+		ms.restoreAllocation(allocResources, userInfo, launcherInfo)
+
+tempDir = tempfile.mkdtemp()
+try:
+	print "%-40s %10s"%("step", "seconds")
+	for sync in [False, True]:
+		jnl = journal.Journal(os.path.join(tempDir, "journal-%d"%(sync)), nAllocations+1, sync)
+		jnl.load()
+		ms = makeMetascheduler()
+		t0 = time.time()
+		for i in range(nAllocations):
+			alloc = ms.allocate([[vsapi.GPU(), vsapi.Server()]], userInfo, [])
+			jnl.append(allocationRecord(i+1, alloc))
+		print "%-40s %10.3f"%("%d allocations, journal sync=%s"%(nAllocations, sync), time.time()-t0)
+		jnl.close()
+		ms.close()
+	sys.stdout.flush()
+
+	# Restart, and get back the allocations
+	t0 = time.time()
+	ms = makeMetascheduler()
+	tStart = time.time()-t0
+	jnl = journal.Journal(os.path.join(tempDir, "journal-1"))
+	t0 = time.time()
+	snapshot, records = jnl.load()
+	tLoad = time.time()-t0
+	t0 = time.time()
+	recover(ms, records)
+	tRecover = time.time()-t0
+	print "%-40s %10.3f"%("metascheduler startup", tStart)
+	print "%-40s %10.3f"%("read %d journal records"%(len(records)), tLoad)
+	print "%-40s %10.3f"%("recover %d allocations"%(len(ms.getAllocations())), tRecover)
+	jnl.close()
+	ms.close()
+finally:
+	shutil.rmtree(tempDir)
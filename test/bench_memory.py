@@ -0,0 +1,93 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#
+# bench_memory.py
+#
+# Reports the memory used by resource objects. First, the size of one
+# object of each resource class is printed. Then a configuration with
+# many nodes is loaded into the metascheduler, the way the SSM does, and
+# all GPUs are allocated. The memory used by this process is printed at
+# each step.
+#
+# No SSM or scheduler is needed; nodes are managed by the local scheduler.
+#
+# Run as : PYTHONPATH=../python python bench_memory.py [nodes]
+#
+
+import vsapi
+import metascheduler
+import localscheduler
+import sys
+
+nNodes = 2000
+if len(sys.argv)>1:
+	nNodes = int(sys.argv[1])
+
+def getRSS():
+	"""
+	Return the resident set size of this process, in KB.
+	"""
+	for line in open('/proc/self/status').readlines():
+		if line.startswith('VmRSS:'):
+			return int(line.split()[1])
+	return 0
+
+def getObjectSize(ob):
+	"""
+	Return the size of ob in bytes, including its __dict__ if it has one.
+	The objects ob refers to are not counted.
+	"""
+	size = sys.getsizeof(ob)
+	if hasattr(ob, '__dict__'):
+		size += sys.getsizeof(ob.__dict__)
+	return size
+
+def makeNode(i):
+	hostName = 'node%d'%(i)
+	node = vsapi.VizNode(hostName, 'bench', i)
+	for gpuIndex in range(2):
+		gpu = vsapi.GPU(gpuIndex, hostName, 'Quadro FX 5800', 'PCI:%d:0:0'%(gpuIndex+1), True)
+		gpu.setScanoutCaps({0 : ['digital', 'analog'], 1 : ['digital', 'analog']})
+		node.addResource(gpu)
+	for serverIndex in range(4):
+		node.addResource(vsapi.Server(serverIndex, hostName))
+	node.addResource(vsapi.Keyboard(0, hostName))
+	node.addResource(vsapi.Mouse(0, hostName))
+	return node
+
+print "%-16s %12s"%("class", "bytes")
+for ob in [vsapi.GPU(0, 'node0'), vsapi.Server(0, 'node0'), vsapi.Screen(0), vsapi.Keyboard(0, 'node0'), vsapi.Mouse(0, 'node0'), vsapi.SLI(0, 'node0'), vsapi.DisplayDevice('LP2065'), vsapi.VizNode('node0', 'bench', 0), vsapi.ResourceGroup('rg')]:
+	print "%-16s %12d"%(ob.__class__.__name__, getObjectSize(ob))
+print
+
+print "%-40s %12s"%("step", "RSS (KB)")
+print "%-40s %12d"%("start", getRSS())
+nodes = map(makeNode, range(nNodes))
+print "%-40s %12d"%("%d nodes created"%(nNodes), getRSS())
+sched = localscheduler.LocalScheduler(map(lambda x:x.getHostName(), nodes), "")
+ms = metascheduler.Metascheduler(nodes, [sched], 0)
+print "%-40s %12d"%("loaded into the metascheduler", getRSS())
+userInfo = { 'uid' : 1000, 'gid' : 1000 }
+allocs = []
+for i in range(nNodes):
+	allocs.append(ms.allocate([[vsapi.GPU(), vsapi.GPU(), vsapi.Server()]], userInfo, []))
+print "%-40s %12d"%("%d allocations"%(len(allocs)), getRSS())
+for alloc in allocs:
+	ms.deallocate(alloc)
+ms.close()
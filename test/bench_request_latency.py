@@ -0,0 +1,110 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#
+# bench_request_latency.py
+#
+# Measures the round trip time of a request/response exchange, framed the
+# way clients and the SSM frame their messages, over loopback TCP and a
+# Unix domain socket. Compares the old way of sending - the header and the
+# message in two sends, with Nagle's algorithm on - with the current one, a
+# single send with TCP_NODELAY.
+#
+# Run as : PYTHONPATH=../python python bench_request_latency.py
+#
+
+import vsapi
+import socket
+import threading
+import tempfile
+import time
+import os
+import sys
+
+nRequests = 300
+request = '<ssm><query_allocation><allocId>1</allocId></query_allocation></ssm>'
+response = '<ssm><response><status>0</status><message>Success</message><return_value>%s</return_value></response></ssm>'%('<gpu><index>0</index><hostname>node1</hostname></gpu>'*8)
+
+def legacySend(sock, message):
+	# what vsapi did earlier
+	sock.sendall(vsapi.encodeFrameHeader(len(message)))
+	sock.sendall(message)
+
+def serve(listener, legacy, reply):
+	conn, address = listener.accept()
+	listener.close()
+	if not legacy:
+		vsapi.setNoDelay(conn)
+	try:
+		while True:
+			try:
+				vsapi.readMessageFromSocket(conn)
+			except vsapi.VizError, e:
+				break
+			if legacy:
+				legacySend(conn, reply)
+			else:
+				vsapi.sendMessageOnSocket(conn, reply)
+	finally:
+		conn.close()
+
+def connect(kind, legacy, reply):
+	if kind == 'tcp':
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind(('127.0.0.1', 0))
+		address = listener.getsockname()
+	else:
+		address = tempfile.mktemp(prefix='vs-bench-')
+		listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		listener.bind(address)
+	listener.listen(1)
+	server = threading.Thread(target=serve, args=(listener, legacy, reply))
+	server.setDaemon(True)
+	server.start()
+
+	sock = socket.socket(listener.family, socket.SOCK_STREAM)
+	sock.connect(address)
+	if not legacy:
+		vsapi.setNoDelay(sock)
+	if kind != 'tcp':
+		os.remove(address)
+	return sock, server
+
+def benchLatency(kind, legacy):
+	sock, server = connect(kind, legacy, response)
+	times = []
+	for i in range(nRequests):
+		t0 = time.time()
+		if legacy:
+			legacySend(sock, request)
+		else:
+			vsapi.sendMessageOnSocket(sock, request)
+		vsapi.readMessageFromSocket(sock)
+		times.append(time.time()-t0)
+	sock.close()
+	server.join()
+	times.sort()
+	return sum(times)/len(times), times[int(len(times)*0.99)]
+
+print "Round trip of a small request & response, %d requests"%(nRequests)
+print "%-6s %-30s %12s %12s"%("socket", "sending", "avg (ms)", "p99 (ms)")
+for kind in ['tcp', 'unix']:
+	for legacy, desc in [(True, 'two sends, Nagle on'), (False, 'single send, TCP_NODELAY')]:
+		avg, p99 = benchLatency(kind, legacy)
+		print "%-6s %-30s %12.3f %12.3f"%(kind, desc, avg*1000, p99*1000)
+		sys.stdout.flush()
@@ -0,0 +1,126 @@
+# VizStack - A Framework to manage visualization resources
+
+# Copyright (C) 2009-2010 Hewlett-Packard
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#
+# bench_xml_parsing.py
+#
+# Measures the time taken to parse and deserialize the XML that VizStack
+# deals with most - node configurations, allocation responses from the SSM
+# and X server configurations for tiled displays. Parsing with domutil is
+# compared with parsing using xml.dom.minidom.
+#
+# No SSM is needed.
+#
+# Run as : PYTHONPATH=../python python bench_xml_parsing.py
+#
+
+import vsapi
+import domutil
+from xml.dom import minidom
+import time
+import sys
+
+nIterations = 20
+
+def makeNodes(n):
+	nodes = []
+	for i in range(n):
+		hostName = 'node%d'%(i)
+		node = vsapi.VizNode(hostName, 'bench', i)
+		for gpuIndex in range(2):
+			gpu = vsapi.GPU(gpuIndex, hostName, 'Quadro FX 5800', 'PCI:%d:0:0'%(gpuIndex+1), True)
+			node.addResource(gpu)
+		for serverIndex in range(4):
+			node.addResource(vsapi.Server(serverIndex, hostName))
+		node.addResource(vsapi.Keyboard(0, hostName))
+		node.addResource(vsapi.Mouse(0, hostName))
+		nodes.append(node)
+	return nodes
+
+def nodeConfig(n):
+	"""
+	A node configuration file for n nodes
+	"""
+	return "<nodeconfig><nodes>%s</nodes></nodeconfig>"%(''.join(map(lambda x:x.serializeToXML(), makeNodes(n))))
+
+def loadNodeConfig(dom):
+	nodesNode = domutil.getChildNode(dom.documentElement, "nodes")
+	for node in domutil.getChildNodes(nodesNode, "node"):
+		vsapi.deserializeVizResource(node, [vsapi.VizNode])
+
+def allocationResponse(n):
+	"""
+	The response to an allocation of n GPUs and X servers, as the SSM sends it
+	"""
+	ret = "<ssm><response><status>0</status><allocId>1</allocId><message>Success</message><allocation>"
+	for node in makeNodes(n):
+		ret += "<resource><value><list>"
+		for res in node.getResources():
+			if isinstance(res, vsapi.GPU) or isinstance(res, vsapi.Server):
+				ret += res.serializeToXML()
+		ret += "</list></value></resource>"
+	ret += "</allocation></response></ssm>"
+	return ret
+
+def loadAllocationResponse(dom):
+	allocationNode = dom.getElementsByTagName("allocation")[0]
+	for resNode in domutil.getChildNodes(allocationNode, "resource"):
+		valueNode = domutil.getChildNode(resNode, "value")
+		for node in domutil.getAllChildNodes(domutil.getAllChildNodes(valueNode)[0]):
+			vsapi.deserializeVizResource(node, [vsapi.GPU, vsapi.Server])
+	domutil.getValue(dom.getElementsByTagName("allocId")[0])
+
+def tiledServerConfig(n):
+	"""
+	An X server driving n displays, one screen for each display
+	"""
+	srv = vsapi.Server(0, 'node0')
+	for i in range(n):
+		gpu = vsapi.GPU(i/2, 'node0')
+		gpu.setScanout(i%2, 'LP2065', 'digital')
+		scr = vsapi.Screen(i)
+		scr.setFBProperty('resolution', [1600, 1200])
+		scr.setFBProperty('position', [(i%4)*1600, (i/4)*1200])
+		scr.setGPU(gpu)
+		srv.addScreen(scr)
+	return srv.serializeToXML()
+
+def loadServerConfig(dom):
+	vsapi.deserializeVizResource(dom.documentElement, [vsapi.Server])
+
+# Each benchmark is [description, function making the XML, sizes, function loading the XML]
+benchmarks = [
+	[ "node config", nodeConfig, [16, 256, 1024], loadNodeConfig ],
+	[ "allocation response", allocationResponse, [16, 256, 1024], loadAllocationResponse ],
+	[ "tiled server config", tiledServerConfig, [4, 16, 64], loadServerConfig ],
+]
+
+def benchOne(parse, load, msg):
+	t0 = time.time()
+	for i in range(nIterations):
+		load(parse(msg))
+	return (time.time()-t0)/nIterations
+
+print "%-22s %8s %10s %14s %14s %8s"%("", "size", "XML bytes", "minidom(ms)", "domutil(ms)", "speedup")
+for desc, makeXML, sizes, load in benchmarks:
+	for n in sizes:
+		msg = makeXML(n)
+		tMinidom = benchOne(minidom.parseString, load, msg)
+		tDomutil = benchOne(domutil.parseDocument, load, msg)
+		print "%-22s %8d %10d %14.3f %14.3f %8.1f"%(desc, n, len(msg), tMinidom*1000, tDomutil*1000, tMinidom/tDomutil)
+		sys.stdout.flush()
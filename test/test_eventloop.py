@@ -0,0 +1,397 @@
+import unittest
+import socket
+import select
+import threading
+import logging
+import vsapi
+import eventloop
+
+#
+# Tests for the building blocks of the SSM's event loop. These don't need
+# a running SSM.
+#
+# Run as : PYTHONPATH=../python python test_eventloop.py
+#
+
+class MessageChannelTestCases(unittest.TestCase):
+	def setUp(self):
+		self.sock, self.peer = socket.socketpair()
+		self.channel = eventloop.MessageChannel(self.sock)
+
+	def tearDown(self):
+		self.sock.close()
+		self.peer.close()
+
+	def flushAll(self):
+		while not self.channel.flush():
+			pass
+
+	def readAll(self, nBytes):
+		data = ''
+		while len(data) < nBytes:
+			data += self.peer.recv(nBytes-len(data))
+		return data
+
+	def test_00000_read_nothing(self):
+		self.assertEqual(self.channel.readMessages(), [])
+
+	def test_00010_read_v1_message(self):
+		self.peer.sendall(vsapi.encodeFrameHeader(5, vsapi.FRAMING_V1)+"hello")
+		self.assertEqual(self.channel.readMessages(), ["hello"])
+
+	def test_00020_read_v2_message(self):
+		self.peer.sendall(vsapi.encodeFrameHeader(5, vsapi.FRAMING_V2)+"hello")
+		self.assertEqual(self.channel.readMessages(), ["hello"])
+
+	def test_00030_read_mixed_framing(self):
+		# A client may use either framing, on any message
+		data = vsapi.encodeFrameHeader(3, vsapi.FRAMING_V1)+"one"
+		data += vsapi.encodeFrameHeader(3, vsapi.FRAMING_V2)+"two"
+		data += vsapi.encodeFrameHeader(5, vsapi.FRAMING_V1)+"three"
+		self.peer.sendall(data)
+		self.assertEqual(self.channel.readMessages(), ["one", "two", "three"])
+
+	def test_00040_read_in_pieces(self):
+		# Partial headers & messages wait for the rest to arrive
+		data = vsapi.encodeFrameHeader(11, vsapi.FRAMING_V2)+"hello world"
+		for ch in data[:-1]:
+			self.peer.sendall(ch)
+			self.assertEqual(self.channel.readMessages(), [])
+		self.peer.sendall(data[-1])
+		self.assertEqual(self.channel.readMessages(), ["hello world"])
+
+	def test_00050_read_large_message(self):
+		# Larger than what v1 framing can carry, and than the read budget
+		msg = "x"*(3*eventloop.MessageChannel.readBudget)
+		self.peer.setblocking(0)
+		data = vsapi.encodeFrameHeader(len(msg))+msg
+		messages = []
+		while len(messages)==0:
+			try:
+				sent = self.peer.send(data)
+				data = data[sent:]
+			except socket.error:
+				pass
+			messages = self.channel.readMessages()
+		self.assertEqual(messages, [msg])
+
+	def test_00060_disconnect(self):
+		self.peer.sendall(vsapi.encodeFrameHeader(3)+"bye")
+		self.peer.close()
+		# Complete messages come out first; the disconnect after that
+		self.assertEqual(self.channel.readMessages(), ["bye"])
+		try:
+			self.channel.readMessages()
+			self.fail("Disconnect was not reported")
+		except vsapi.VizError, e:
+			self.assertEqual(e.errorCode, vsapi.VizError.NOT_CONNECTED)
+
+	def test_00070_disconnect_midway(self):
+		self.peer.sendall(vsapi.encodeFrameHeader(10)+"abc")
+		self.peer.close()
+		try:
+			self.channel.readMessages()
+			self.fail("Incomplete message was not reported")
+		except vsapi.VizError, e:
+			self.assertEqual(e.errorCode, vsapi.VizError.BAD_PROTOCOL)
+
+	def test_00080_bad_header(self):
+		self.peer.sendall("abcdefghij")
+		try:
+			self.channel.readMessages()
+			self.fail("Bad header was accepted")
+		except vsapi.VizError, e:
+			self.assertEqual(e.errorCode, vsapi.VizError.BAD_PROTOCOL)
+
+	def test_00090_message_too_long(self):
+		self.peer.sendall(vsapi.encodeFrameHeader(eventloop.MessageChannel.maxMessageLength+1, vsapi.FRAMING_V2))
+		try:
+			self.channel.readMessages()
+			self.fail("Message longer than the maximum was accepted")
+		except vsapi.VizError, e:
+			self.assertEqual(e.errorCode, vsapi.VizError.BAD_PROTOCOL)
+
+	def test_00100_send_v1_by_default(self):
+		self.channel.queueMessage("hello")
+		self.flushAll()
+		self.assertEqual(self.readAll(10), "5    hello")
+
+	def test_00110_send_v2(self):
+		self.channel.setFraming(vsapi.FRAMING_V2)
+		self.assertEqual(self.channel.getFraming(), vsapi.FRAMING_V2)
+		self.channel.queueMessage("hello")
+		self.flushAll()
+		self.assertEqual(vsapi.readMessageFromSocket(self.peer), "hello")
+
+	def test_00120_bad_framing(self):
+		self.assertRaises(ValueError, self.channel.setFraming, 3)
+
+	def test_00130_v1_limit(self):
+		# A message too large for v1 framing can't be queued on a v1 channel
+		self.assertRaises(vsapi.VizError, self.channel.queueMessage, "x"*(vsapi.FRAME_V1_MAX_LENGTH+1))
+		self.assertFalse(self.channel.hasPendingOutput())
+
+	def test_00140_send_fragments(self):
+		# A message given as a list of fragments goes out as one message
+		self.channel.setFraming(vsapi.FRAMING_V2)
+		self.channel.queueMessage(["<ssm>", "", "<response/>", "</ssm>"])
+		self.channel.queueMessage("second")
+		self.flushAll()
+		self.assertEqual(vsapi.readMessageFromSocket(self.peer), "<ssm><response/></ssm>")
+		self.assertEqual(vsapi.readMessageFromSocket(self.peer), "second")
+
+	def test_00150_congestion(self):
+		# Nobody reads from the peer, so the output backs up
+		self.channel.setFraming(vsapi.FRAMING_V2)
+		msg = "x"*(256*1024)
+		while not self.channel.isCongested():
+			self.channel.queueMessage(msg)
+			self.channel.flush()
+		self.assertEqual(self.channel.getEventMask(), eventloop.WRITE)
+
+		# Drain the peer, and we catch up
+		self.peer.setblocking(0)
+		while self.channel.hasPendingOutput():
+			try:
+				while len(self.peer.recv(1024*1024))>0:
+					pass
+			except socket.error:
+				pass
+			self.channel.flush()
+		self.assertEqual(self.channel.getPendingBytes(), 0)
+		self.assertEqual(self.channel.getEventMask(), eventloop.READ)
+
+	def test_00160_shutdown_after_output(self):
+		self.channel.queueMessage("last")
+		self.channel.shutdownWrite()
+		self.flushAll()
+		self.assertEqual(vsapi.readMessageFromSocket(self.peer), "last")
+		self.assertEqual(self.peer.recv(10), "")
+
+	def test_00170_save_restore_state(self):
+		# What a handoff does : unsent output and partial input move to
+		# another channel on the same connection
+		self.channel.setFraming(vsapi.FRAMING_V2)
+		self.channel.queueMessage("queued")
+		data = vsapi.encodeFrameHeader(7)+"partial"
+		self.peer.sendall(data[:6])
+		self.assertEqual(self.channel.readMessages(), [])
+		state = self.channel.saveState()
+
+		other = eventloop.MessageChannel(self.sock)
+		other.restoreState(state)
+		self.assertEqual(other.getFraming(), vsapi.FRAMING_V2)
+		self.peer.sendall(data[6:])
+		self.assertEqual(other.readMessages(), ["partial"])
+		while not other.flush():
+			pass
+		self.assertEqual(vsapi.readMessageFromSocket(self.peer), "queued")
+
+class TimerQueueTestCases(unittest.TestCase):
+	def setUp(self):
+		self.timers = eventloop.TimerQueue()
+
+	def test_00000_empty(self):
+		self.assertEqual(len(self.timers), 0)
+		self.assertEqual(self.timers.nextDeadline(), None)
+		self.assertEqual(self.timers.getTimeout(100.0), None)
+		self.assertEqual(self.timers.popExpired(100.0), [])
+
+	def test_00010_order(self):
+		self.timers.add(30.0, "c")
+		self.timers.add(10.0, "a")
+		self.timers.add(20.0, "b")
+		self.assertEqual(len(self.timers), 3)
+		self.assertEqual(self.timers.nextDeadline(), 10.0)
+		self.assertEqual(self.timers.getTimeout(4.0), 6.0)
+		self.assertEqual(self.timers.popExpired(20.0), ["a", "b"])
+		self.assertEqual(len(self.timers), 1)
+		self.assertEqual(self.timers.popExpired(29.9), [])
+		self.assertEqual(self.timers.popExpired(30.0), ["c"])
+		self.assertEqual(len(self.timers), 0)
+
+	def test_00020_same_deadline_fifo(self):
+		for item in range(10):
+			self.timers.add(5.0, item)
+		self.assertEqual(self.timers.popExpired(5.0), range(10))
+
+	def test_00030_past_deadline(self):
+		self.timers.add(5.0, "late")
+		self.assertEqual(self.timers.getTimeout(8.0), 0.0)
+
+	def test_00040_cancel(self):
+		first = self.timers.add(10.0, "a")
+		self.timers.add(20.0, "b")
+		third = self.timers.add(30.0, "c")
+		self.timers.cancel(third)
+		self.assertEqual(len(self.timers), 2)
+		# A cancelled timer at the head doesn't decide the timeout
+		self.timers.cancel(first)
+		self.assertEqual(len(self.timers), 1)
+		self.assertEqual(self.timers.nextDeadline(), 20.0)
+		self.assertEqual(self.timers.popExpired(100.0), ["b"])
+		self.assertEqual(self.timers.nextDeadline(), None)
+
+	def test_00050_cancel_twice(self):
+		handle = self.timers.add(10.0, "a")
+		self.timers.cancel(handle)
+		self.timers.cancel(handle)
+		self.assertEqual(len(self.timers), 0)
+
+	def test_00060_cancel_after_expiry(self):
+		# Cancelling a timer that has fired already does nothing
+		handle = self.timers.add(10.0, "a")
+		self.timers.add(20.0, "b")
+		self.assertEqual(self.timers.popExpired(10.0), ["a"])
+		self.timers.cancel(handle)
+		self.assertEqual(len(self.timers), 1)
+		self.assertEqual(self.timers.popExpired(20.0), ["b"])
+
+	def test_00070_cancel_all(self):
+		handles = map(lambda x: self.timers.add(float(x), x), range(100))
+		for h in handles:
+			self.timers.cancel(h)
+		self.assertEqual(len(self.timers), 0)
+		self.assertEqual(self.timers.getTimeout(0.0), None)
+		self.assertEqual(self.timers.popExpired(1000.0), [])
+
+class WorkerPoolTestCases(unittest.TestCase):
+	class LogCollector(logging.Handler):
+		def __init__(self):
+			logging.Handler.__init__(self)
+			self.records = []
+
+		def emit(self, record):
+			self.records.append(record)
+
+	def setUp(self):
+		self.log = WorkerPoolTestCases.LogCollector()
+		self.logger = logging.getLogger("test_eventloop")
+		self.logger.propagate = False
+		self.logger.addHandler(self.log)
+		self.pool = eventloop.WorkerPool(2, self.logger)
+
+	def tearDown(self):
+		self.pool.close()
+		self.logger.removeHandler(self.log)
+
+	def test_00000_results(self):
+		self.pool.submit(lambda x, y: x+y, [1, 2], lambda result, error: [result, error])
+		self.assertEqual(self.pool.getOutstanding(), 1)
+		self.assertEqual(self.pool.waitForAll(), [[3, None]])
+		self.assertEqual(self.pool.getOutstanding(), 0)
+
+	def test_00010_errors(self):
+		def fails():
+			raise ValueError, "bad"
+		self.pool.submit(fails, [], lambda result, error: [result, error.__class__])
+		self.assertEqual(self.pool.waitForAll(), [[None, ValueError]])
+
+	def test_00020_completions_in_caller_thread(self):
+		# Completions run where runCompletions is called, not on the workers
+		threads = []
+		self.pool.submit(threading.currentThread, [], lambda result, error: threads.append([result, threading.currentThread()]))
+		self.pool.waitForAll()
+		worker, completion = threads[0]
+		self.assertNotEqual(worker, threading.currentThread())
+		self.assertEqual(completion, threading.currentThread())
+
+	def test_00030_notify_fd(self):
+		self.pool.submit(lambda: 1, [], lambda result, error: result)
+		ready = select.select([self.pool.getNotifyFd()], [], [], 10)[0]
+		self.assertEqual(ready, [self.pool.getNotifyFd()])
+		results = []
+		while len(results)==0:
+			results = self.pool.runCompletions()
+		self.assertEqual(results, [1])
+		# Nothing left; the descriptor has been drained
+		self.assertEqual(self.pool.runCompletions(), [])
+
+	def test_00040_failing_completion(self):
+		# A completion that fails is logged, and the others still run
+		def badCompletion(result, error):
+			raise KeyError, "oops"
+		self.pool.submit(lambda: 1, [], lambda result, error: result)
+		self.pool.submit(lambda: 2, [], badCompletion)
+		self.pool.submit(lambda: 3, [], lambda result, error: result)
+		results = self.pool.waitForAll()
+		results.sort()
+		self.assertEqual(results, [None, 1, 3])
+		self.assertEqual(self.pool.getOutstanding(), 0)
+		self.assertTrue(len(self.log.records)>0)
+		self.assertTrue("oops" in ''.join(map(lambda x: x.getMessage(), self.log.records)))
+
+	def test_00050_many_calls(self):
+		for i in range(200):
+			self.pool.submit(lambda x: x*x, [i], lambda result, error: result)
+		results = self.pool.waitForAll()
+		results.sort()
+		self.assertEqual(results, map(lambda x: x*x, range(200)))
+
+	def test_00060_bad_thread_count(self):
+		self.assertRaises(ValueError, eventloop.WorkerPool, 0)
+
+class FramingTestCases(unittest.TestCase):
+	def test_00000_v1_header(self):
+		self.assertEqual(vsapi.encodeFrameHeader(42, vsapi.FRAMING_V1), "42   ")
+		self.assertEqual(vsapi.decodeFrameHeader("42   "), [vsapi.FRAME_V1_HEADER_LENGTH, 42])
+
+	def test_00010_v2_header(self):
+		header = vsapi.encodeFrameHeader(42, vsapi.FRAMING_V2)
+		self.assertEqual(len(header), vsapi.FRAME_V2_HEADER_LENGTH)
+		self.assertEqual(header[0], vsapi.FRAME_V2_MARKER)
+		self.assertEqual(vsapi.decodeFrameHeader(header), [vsapi.FRAME_V2_HEADER_LENGTH, 42])
+
+	def test_00020_automatic_framing(self):
+		# v1 while the length fits in it, v2 after that
+		self.assertEqual(len(vsapi.encodeFrameHeader(vsapi.FRAME_V1_MAX_LENGTH)), vsapi.FRAME_V1_HEADER_LENGTH)
+		self.assertEqual(len(vsapi.encodeFrameHeader(vsapi.FRAME_V1_MAX_LENGTH+1)), vsapi.FRAME_V2_HEADER_LENGTH)
+
+	def test_00030_incomplete_header(self):
+		self.assertEqual(vsapi.decodeFrameHeader(""), None)
+		self.assertEqual(vsapi.decodeFrameHeader("42"), None)
+		self.assertEqual(vsapi.decodeFrameHeader(vsapi.encodeFrameHeader(42, vsapi.FRAMING_V2)[:-1]), None)
+
+	def test_00040_bad_lengths(self):
+		self.assertRaises(vsapi.VizError, vsapi.decodeFrameHeader, "0    ")
+		self.assertRaises(vsapi.VizError, vsapi.decodeFrameHeader, "-1   ")
+		self.assertRaises(vsapi.VizError, vsapi.decodeFrameHeader, "abcde")
+		self.assertRaises(vsapi.VizError, vsapi.decodeFrameHeader, vsapi.FRAME_V2_MARKER+"\0"*8)
+		self.assertRaises(vsapi.VizError, vsapi.encodeFrameHeader, vsapi.FRAME_V1_MAX_LENGTH+1, vsapi.FRAMING_V1)
+
+	def test_00050_blocking_socket_functions(self):
+		# The functions used by ResourceAccess understand both framings
+		a, b = socket.socketpair()
+		try:
+			msg = "y"*(vsapi.FRAME_V1_MAX_LENGTH+10)
+			vsapi.sendMessageOnSocket(a, "small")
+			vsapi.sendMessageOnSocket(a, "small v2", vsapi.FRAMING_V2)
+			self.assertEqual(vsapi.readMessageFromSocket(b), "small")
+			self.assertEqual(vsapi.readMessageFromSocket(b), "small v2")
+			vsapi.sendMessageOnSocket(a, msg)
+			self.assertEqual(vsapi.readMessageFromSocket(b), msg)
+			a.close()
+			try:
+				vsapi.readMessageFromSocket(b)
+				self.fail("Disconnect was not reported")
+			except vsapi.VizError, e:
+				self.assertEqual(e.errorCode, vsapi.VizError.NOT_CONNECTED)
+		finally:
+			a.close()
+			b.close()
+
+if __name__ == '__main__':
+	tl = unittest.TestLoader()
+	suite1 = tl.loadTestsFromTestCase(MessageChannelTestCases)
+	suite2 = tl.loadTestsFromTestCase(FramingTestCases)
+	suite3 = tl.loadTestsFromTestCase(TimerQueueTestCases)
+	suite4 = tl.loadTestsFromTestCase(WorkerPoolTestCases)
+
+	print 'Running message channel tests'
+	unittest.TextTestRunner().run(suite1)
+	print 'Running message framing tests'
+	unittest.TextTestRunner().run(suite2)
+	print 'Running timer queue tests'
+	unittest.TextTestRunner().run(suite3)
+	print 'Running worker pool tests'
+	unittest.TextTestRunner().run(suite4)
@@ -0,0 +1,170 @@
+import unittest
+import tempfile
+import shutil
+import os
+import journal
+
+#
+# Tests for the journal that the SSM records its allocations in. These
+# don't need a running SSM.
+#
+# Run as : PYTHONPATH=../python python test_journal.py
+#
+
+class JournalTestCases(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.fileName = os.path.join(self.dir, "journal")
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def openJournal(self, snapshotInterval=1000):
+		j = journal.Journal(self.fileName, snapshotInterval, sync=False)
+		ret = j.load()
+		return [j, ret]
+
+	def test_00000_empty(self):
+		j, [snapshot, records] = self.openJournal()
+		self.assertEqual(snapshot, None)
+		self.assertEqual(records, [])
+		self.assertTrue(os.path.exists(self.fileName))
+		j.close()
+
+	def test_00010_replay(self):
+		j, ret = self.openJournal()
+		for data in ["one", "two\nlines", "", "<three/>"]:
+			j.append(data)
+		j.close()
+
+		j, [snapshot, records] = self.openJournal()
+		self.assertEqual(snapshot, None)
+		self.assertEqual(records, ["one", "two\nlines", "", "<three/>"])
+		j.close()
+
+	def test_00020_append_after_load(self):
+		j, ret = self.openJournal()
+		j.append("one")
+		j.close()
+		j, ret = self.openJournal()
+		j.append("two")
+		j.close()
+
+		j, [snapshot, records] = self.openJournal()
+		self.assertEqual(records, ["one", "two"])
+		j.close()
+
+	def test_00030_snapshot(self):
+		j, ret = self.openJournal()
+		j.append("one")
+		j.append("two")
+		j.writeSnapshot("state after two")
+		self.assertEqual(os.path.getsize(self.fileName), 0)
+		j.append("three")
+		j.close()
+
+		j, [snapshot, records] = self.openJournal()
+		self.assertEqual(snapshot, "state after two")
+		self.assertEqual(records, ["three"])
+		j.close()
+
+	def test_00040_needs_snapshot(self):
+		j, ret = self.openJournal(3)
+		j.append("one")
+		j.append("two")
+		self.assertFalse(j.needsSnapshot())
+		j.append("three")
+		self.assertTrue(j.needsSnapshot())
+		j.writeSnapshot("state")
+		self.assertFalse(j.needsSnapshot())
+		for data in ["four", "five", "six"]:
+			j.append(data)
+		j.close()
+
+		# Records after the snapshot count on load too
+		j, ret = self.openJournal(3)
+		self.assertTrue(j.needsSnapshot())
+		j.close()
+
+	def test_00050_incomplete_record(self):
+		# We died while writing the last record. It is dropped, and the
+		# next one goes in its place
+		j, ret = self.openJournal()
+		j.append("one")
+		j.append("two")
+		j.close()
+		goodLength = os.path.getsize(self.fileName)
+		f = open(self.fileName, "ab")
+		f.write("3 100\npartial")
+		f.close()
+
+		j, [snapshot, records] = self.openJournal()
+		self.assertEqual(records, ["one", "two"])
+		self.assertEqual(os.path.getsize(self.fileName), goodLength)
+		j.append("three")
+		j.close()
+
+		j, [snapshot, records] = self.openJournal()
+		self.assertEqual(records, ["one", "two", "three"])
+		j.close()
+
+	def test_00060_garbage_at_end(self):
+		j, ret = self.openJournal()
+		j.append("one")
+		j.close()
+		f = open(self.fileName, "ab")
+		f.write("not a header\n")
+		f.close()
+
+		j, [snapshot, records] = self.openJournal()
+		self.assertEqual(records, ["one"])
+		j.close()
+
+	def test_00070_snapshot_not_truncated(self):
+		# We died after the snapshot was written, but before the journal
+		# was emptied. The records in the snapshot are skipped
+		j, ret = self.openJournal()
+		j.append("one")
+		j.append("two")
+		j.close()
+		saved = open(self.fileName, "rb").read()
+
+		j, ret = self.openJournal()
+		j.writeSnapshot("state after two")
+		j.close()
+		f = open(self.fileName, "wb")
+		f.write(saved)
+		f.close()
+
+		j, [snapshot, records] = self.openJournal()
+		self.assertEqual(snapshot, "state after two")
+		self.assertEqual(records, [])
+		j.append("three")
+		j.close()
+
+		j, [snapshot, records] = self.openJournal()
+		self.assertEqual(records, ["three"])
+		j.close()
+
+	def test_00080_leftover_temporary_snapshot(self):
+		# We died while writing a snapshot. The old one is still good
+		j, ret = self.openJournal()
+		j.append("one")
+		j.writeSnapshot("state after one")
+		j.append("two")
+		j.close()
+		f = open(self.fileName+".snapshot.tmp", "wb")
+		f.write("2 5\nstate")
+		f.close()
+
+		j, [snapshot, records] = self.openJournal()
+		self.assertEqual(snapshot, "state after one")
+		self.assertEqual(records, ["two"])
+		j.close()
+
+if __name__ == '__main__':
+	tl = unittest.TestLoader()
+	suite1 = tl.loadTestsFromTestCase(JournalTestCases)
+
+	print 'Running journal tests'
+	unittest.TextTestRunner().run(suite1)
@@ -0,0 +1,217 @@
+import unittest
+import copy
+import pickle
+import xml.dom.minidom
+import vsapi
+import metascheduler
+
+#
+# Tests for the resource classes, and the bookkeeping the allocator does
+# with them. These don't need a running SSM.
+#
+# Run as : PYTHONPATH=../python python test_resources.py
+#
+
+class ResourceIdMapTestCases(unittest.TestCase):
+	def setUp(self):
+		self.ids = vsapi.ResourceIdMap()
+		self.gpu0 = vsapi.GPU(0, "node1", model="Quadro FX 5800", busID="PCI:1:0:0")
+		self.gpu1 = vsapi.GPU(1, "node1", model="Quadro FX 5800", busID="PCI:2:0:0")
+		self.gpu0b = vsapi.GPU(0, "node2", model="Quadro FX 5800", busID="PCI:1:0:0")
+		self.srv0 = vsapi.Server(0, "node1")
+
+	def test_00000_dense_ids(self):
+		ids = map(self.ids.add, [self.gpu0, self.gpu1, self.gpu0b, self.srv0])
+		self.assertEqual(ids, [0, 1, 2, 3])
+		for resId, res in zip(ids, [self.gpu0, self.gpu1, self.gpu0b, self.srv0]):
+			self.assertTrue(self.ids.getResource(resId) is res)
+
+	def test_00010_same_resource_same_id(self):
+		# Any object referring to the same resource has the same ID
+		resId = self.ids.add(self.gpu0)
+		other = vsapi.GPU(0, "node1")
+		self.assertEqual(self.ids.add(other), resId)
+		self.assertEqual(self.ids.getId(other), resId)
+		self.assertTrue(self.ids.getResource(resId) is self.gpu0)
+
+	def test_00020_ids_tell_classes_and_hosts_apart(self):
+		# Same index, different host or different class
+		self.ids.add(self.gpu0)
+		self.ids.add(self.gpu0b)
+		self.ids.add(self.srv0)
+		self.assertEqual(len(set(map(self.ids.getId, [self.gpu0, self.gpu0b, self.srv0]))), 3)
+
+	def test_00030_unknown_resource(self):
+		self.ids.add(self.gpu0)
+		self.assertEqual(self.ids.getId(self.gpu1), None)
+		self.assertEqual(self.ids.getId(vsapi.GPU(0, "node9")), None)
+		self.assertEqual(self.ids.getId(vsapi.Keyboard(0, "node1")), None)
+
+	def test_00040_unresolvable(self):
+		self.assertRaises(ValueError, self.ids.add, vsapi.GPU())
+		self.assertRaises(ValueError, self.ids.add, vsapi.GPU(0))
+
+	def test_00050_replace(self):
+		resId = self.ids.add(self.gpu0)
+		newGPU = self.gpu0.clone()
+		self.ids.replace(resId, newGPU)
+		self.assertTrue(self.ids.getResource(resId) is newGPU)
+		self.assertRaises(ValueError, self.ids.replace, resId, self.gpu1)
+
+def canonicalXML(xmlString):
+	"""
+	Return a form of xmlString which doesn't depend on the order of the
+	elements. Some attributes (e.g. the arguments of X servers) are
+	dictionaries, and come out in any order.
+	"""
+	def canonical(node):
+		children = map(canonical, filter(lambda x: x.nodeType != x.TEXT_NODE or len(x.data.strip())>0, node.childNodes))
+		children.sort()
+		return (node.nodeName, (node.nodeValue or '').strip(), children)
+	return canonical(xml.dom.minidom.parseString(xmlString).documentElement)
+
+class CopyTestCases(unittest.TestCase):
+	def assertSameResource(self, a, b):
+		self.assertEqual(canonicalXML(a.serializeToXML()), canonicalXML(b.serializeToXML()))
+
+	def setUp(self):
+		self.gpu = vsapi.GPU(0, "node1", model="Quadro FX 5800", busID="PCI:1:0:0")
+		self.gpu.setShareLimit(2)
+		self.gpu.setSharedServerIndex(10)
+		self.srv = vsapi.Server(0, "node1")
+		screen = vsapi.Screen(0)
+		screen.setGPU(self.gpu)
+		self.srv.addScreen(screen)
+
+	def test_00000_slots(self):
+		# The resource classes keep their attributes in slots
+		for ob in [self.gpu, self.srv, self.srv.getScreens()[0], vsapi.Keyboard(0, "node1"), vsapi.VizNode("node1")]:
+			self.assertFalse(hasattr(ob, '__dict__'), "%s has a __dict__"%(ob.__class__.__name__))
+
+	def test_00010_clone_is_independent(self):
+		newGPU = self.gpu.clone()
+		self.assertSameResource(newGPU, self.gpu)
+		self.assertFalse(newGPU.getSharedServer() is self.gpu.getSharedServer())
+
+		self.gpu.doAllocate(vsapi.GPU(0, "node1"), 5)
+		self.assertEqual(self.gpu.getOwners(), [5])
+		self.assertEqual(self.gpu.getSharedServer().getOwners(), [5])
+		self.assertEqual(newGPU.getOwners(), [])
+		self.assertEqual(newGPU.getSharedServer().getOwners(), [])
+
+	def test_00020_deepcopy_nested(self):
+		newSrv = copy.deepcopy(self.srv)
+		self.assertSameResource(newSrv, self.srv)
+		newScreen = newSrv.getScreens()[0]
+		self.assertFalse(newScreen is self.srv.getScreens()[0])
+		self.assertFalse(newScreen.getGPUs()[0] is self.gpu)
+
+		newScreen.getGPUs()[0].setScanout(0, 'HP LP2065')
+		self.assertEqual(self.gpu.getScanouts(), {})
+
+	def test_00030_deepcopy_keeps_sharing(self):
+		# An object that appears twice comes out as one copy
+		pair = copy.deepcopy([self.gpu, self.gpu])
+		self.assertTrue(pair[0] is pair[1])
+		self.assertFalse(pair[0] is self.gpu)
+
+	def test_00040_shallow_copy(self):
+		newGPU = copy.copy(self.gpu)
+		self.assertFalse(newGPU is self.gpu)
+		self.assertTrue(newGPU.getSharedServer() is self.gpu.getSharedServer())
+		self.assertEqual(newGPU.hashKey(), self.gpu.hashKey())
+
+	def test_00050_pickle(self):
+		for protocol in [0, 2]:
+			newSrv = pickle.loads(pickle.dumps(self.srv, protocol))
+			self.assertSameResource(newSrv, self.srv)
+			newGPU = pickle.loads(pickle.dumps(self.gpu, protocol))
+			self.assertEqual(newGPU.getBusId(), "PCI:1:0:0")
+			self.assertEqual(newGPU.getSharedServer().getIndex(), 10)
+
+	def test_00060_subclass_without_slots(self):
+		# Subclasses elsewhere may not declare slots. Their attributes
+		# are copied too
+		class TaggedGPU(vsapi.GPU):
+			pass
+		gpu = TaggedGPU(1, "node1")
+		gpu.tag = ["a"]
+		newGPU = gpu.clone()
+		self.assertEqual(newGPU.tag, ["a"])
+		self.assertEqual(newGPU.hashKey(), gpu.hashKey())
+		self.assertEqual(copy.copy(gpu).tag, ["a"])
+
+class UndoLogTestCases(unittest.TestCase):
+	def setUp(self):
+		self.gpu = vsapi.GPU(0, "node1", model="Quadro FX 5800", busID="PCI:1:0:0")
+		self.gpu.setShareLimit(2)
+		self.gpu.setSharedServerIndex(10)
+		self.kbd = vsapi.Keyboard(0, "node1")
+		self.sharedReq = vsapi.GPU(0, "node1")
+		self.sharedReq.setShared(True)
+
+	def test_00000_rollback_all(self):
+		undoLog = metascheduler.UndoLog()
+		undoLog.record(self.gpu)
+		self.gpu.doAllocate(self.sharedReq, 5)
+		undoLog.record(self.kbd)
+		self.kbd.doAllocate(vsapi.Keyboard(0, "node1"), 5)
+		self.assertEqual(self.gpu.getOwners(), [5])
+		self.assertTrue(self.gpu.isShared())
+
+		undoLog.rollback()
+		self.assertEqual(self.gpu.getOwners(), [])
+		self.assertFalse(self.gpu.isShared())
+		self.assertEqual(self.gpu.getSharedServer().getOwners(), [])
+		self.assertEqual(self.kbd.getOwners(), [])
+
+	def test_00010_rollback_to_mark(self):
+		undoLog = metascheduler.UndoLog()
+		undoLog.record(self.gpu)
+		self.gpu.doAllocate(self.sharedReq, 5)
+		mark = undoLog.mark()
+		undoLog.record(self.gpu)
+		self.gpu.doAllocate(self.sharedReq, 6)
+		undoLog.record(self.kbd)
+		self.kbd.doAllocate(vsapi.Keyboard(0, "node1"), 6)
+		self.assertEqual(self.gpu.getOwners(), [5, 6])
+
+		# Only the changes after the mark are undone
+		undoLog.rollback(mark)
+		self.assertEqual(self.gpu.getOwners(), [5])
+		self.assertEqual(self.gpu.getSharedServer().getOwners(), [5])
+		self.assertEqual(self.kbd.getOwners(), [])
+		self.assertEqual(undoLog.mark(), mark)
+
+		undoLog.rollback()
+		self.assertEqual(self.gpu.getOwners(), [])
+
+	def test_00020_state_is_a_copy(self):
+		# Changes after record() don't leak into the recorded state
+		undoLog = metascheduler.UndoLog()
+		undoLog.record(self.kbd)
+		self.kbd.doAllocate(vsapi.Keyboard(0, "node1"), 5)
+		undoLog.rollback()
+		self.kbd.doAllocate(vsapi.Keyboard(0, "node1"), 7)
+		undoLog.record(self.kbd)
+		self.kbd.deallocate(vsapi.Keyboard(0, "node1"), 7)
+		undoLog.rollback()
+		self.assertEqual(self.kbd.getOwners(), [7])
+
+	def test_00030_rollback_empty(self):
+		undoLog = metascheduler.UndoLog()
+		undoLog.rollback()
+		self.assertEqual(undoLog.mark(), 0)
+
+if __name__ == '__main__':
+	tl = unittest.TestLoader()
+	suite1 = tl.loadTestsFromTestCase(ResourceIdMapTestCases)
+	suite2 = tl.loadTestsFromTestCase(CopyTestCases)
+	suite3 = tl.loadTestsFromTestCase(UndoLogTestCases)
+
+	print 'Running resource ID tests'
+	unittest.TextTestRunner().run(suite1)
+	print 'Running resource copy tests'
+	unittest.TextTestRunner().run(suite2)
+	print 'Running allocation undo log tests'
+	unittest.TextTestRunner().run(suite3)
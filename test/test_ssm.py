@@ -0,0 +1,412 @@
+import unittest
+import os
+import imp
+import socket
+import select
+import logging
+import vsapi
+import domutil
+import eventloop
+import metascheduler
+import localscheduler
+
+#
+# Tests for the parts of the SSM which don't need it to be running. The
+# SSM is a script, so we load its definitions (but not the code that
+# starts it) as a module.
+#
+# Run as : PYTHONPATH=../python python test_ssm.py
+#
+
+def loadSSM():
+	fileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sbin', 'vs-ssm')
+	src = open(fileName).read()
+	src = src[:src.index('# Deamon class code leeched')]
+	module = imp.new_module('vs_ssm')
+	exec compile(src, fileName, 'exec') in module.__dict__
+	module.g_logger = logging.getLogger("test_ssm")
+	module.g_logger.addHandler(logging.NullHandler())
+	module.g_logger.propagate = False
+	return module
+
+ssm = loadSSM()
+
+class AllocationWaitersTestCases(unittest.TestCase):
+	class Waiter:
+		def __init__(self, uid, priority=0, resReq=None, searchNodeNames=[]):
+			if resReq is None:
+				resReq = [vsapi.GPU()]
+			self.userInfo = { 'uid' : uid }
+			self.requestParams = {
+				'priority' : priority,
+				'endAt' : 1000,
+				'resReq' : resReq,
+				'searchNodeNames' : searchNodeNames
+			}
+
+	def setUp(self):
+		self.waiters = ssm.AllocationWaiters()
+
+	def addWaiters(self, *args):
+		for waiter in args:
+			self.waiters.add(waiter)
+
+	def test_00000_empty(self):
+		self.assertEqual(len(self.waiters), 0)
+		self.assertEqual(self.waiters.getReady(0, {}), [])
+		self.assertEqual(self.waiters.getTimeout(0), None)
+
+	def test_00010_nothing_ready_till_freed(self):
+		w1 = self.Waiter(1)
+		self.addWaiters(w1)
+		self.assertEqual(len(self.waiters), 1)
+		self.assertEqual(self.waiters.getReady(0, {}), [])
+		self.waiters.resourcesFreed([vsapi.GPU(0, "node1")])
+		self.assertEqual(self.waiters.getTimeout(0), 0)
+		self.assertEqual(self.waiters.getReady(0, {}), [w1])
+		# Tried once per wakeup
+		self.assertEqual(self.waiters.getReady(0, {}), [])
+
+	def test_00020_arrival_order(self):
+		w1, w2, w3 = self.Waiter(1), self.Waiter(1), self.Waiter(1)
+		self.addWaiters(w3, w1, w2)
+		self.waiters.wakeUpAll()
+		self.assertEqual(self.waiters.getReady(0, {}), [w3, w1, w2])
+
+	def test_00030_priority_first(self):
+		low, normal, high = self.Waiter(1, -1), self.Waiter(2), self.Waiter(3, 1)
+		self.addWaiters(low, normal, high)
+		self.waiters.wakeUpAll()
+		# Priority wins over fair-share
+		self.assertEqual(self.waiters.getReady(0, {3:10}), [high, normal, low])
+
+	def test_00040_fair_share(self):
+		a1, a2, a3 = self.Waiter(1), self.Waiter(1), self.Waiter(1)
+		b1, b2 = self.Waiter(2), self.Waiter(2)
+		self.addWaiters(a1, a2, a3, b1, b2)
+		self.waiters.wakeUpAll()
+		# User 1 holds two allocations, so user 2 goes first till they
+		# are even. Then the older request breaks the tie
+		self.assertEqual(self.waiters.getReady(0, {1:2}), [b1, b2, a1, a2, a3])
+
+		self.waiters.wakeUpAll()
+		self.assertEqual(self.waiters.getReady(0, {}), [a1, b1, a2, b2, a3])
+
+	def test_00050_freed_resources_wake_matching(self):
+		anyGPU = self.Waiter(1)
+		onNode1 = self.Waiter(1, resReq=[vsapi.GPU(hostName="node1")])
+		searchNode2 = self.Waiter(1, searchNodeNames=["node2"])
+		wantsServer = self.Waiter(1, resReq=[vsapi.Server()])
+		self.addWaiters(anyGPU, onNode1, searchNode2, wantsServer)
+
+		self.waiters.resourcesFreed([vsapi.GPU(0, "node1")])
+		self.assertEqual(self.waiters.getReady(0, {}), [anyGPU, onNode1])
+		self.waiters.resourcesFreed([vsapi.GPU(0, "node2")])
+		self.assertEqual(self.waiters.getReady(0, {}), [anyGPU, searchNode2])
+		self.waiters.resourcesFreed([vsapi.Server(0, "node3")])
+		self.assertEqual(self.waiters.getReady(0, {}), [wantsServer])
+
+	def test_00060_aggregates_wake_on_anything(self):
+		# Aggregates may be expanded from templates, so any freed resource
+		# may be of use
+		waiter = self.Waiter(1, resReq=[vsapi.ResourceGroup("rg")])
+		self.addWaiters(waiter)
+		self.waiters.resourcesFreed([vsapi.Keyboard(0, "node1")])
+		self.assertEqual(self.waiters.getReady(0, {}), [waiter])
+
+	def test_00070_timeout(self):
+		w1, w2 = self.Waiter(1), self.Waiter(1)
+		w2.requestParams['endAt'] = 500
+		self.addWaiters(w1, w2)
+		self.assertEqual(self.waiters.getTimeout(0), 500)
+		self.assertEqual(self.waiters.getReady(499, {}), [])
+		self.assertEqual(self.waiters.getReady(500, {}), [w2])
+		self.assertEqual(self.waiters.getTimeout(500), 500)
+
+	def test_00080_remove(self):
+		w1, w2 = self.Waiter(1), self.Waiter(1)
+		w2.requestParams['endAt'] = 500
+		self.addWaiters(w1, w2)
+		self.waiters.wakeUpAll()
+		self.waiters.remove(w1)
+		self.waiters.remove(w2)
+		self.assertEqual(len(self.waiters), 0)
+		self.assertEqual(self.waiters.getReady(1000, {}), [])
+		self.assertEqual(self.waiters.getTimeout(0), None)
+		# Removing twice is harmless
+		self.waiters.remove(w1)
+
+	def test_00090_requeue_keeps_place(self):
+		w1, w2 = self.Waiter(1), self.Waiter(1)
+		self.addWaiters(w1, w2)
+		self.waiters.wakeUpAll()
+		for waiter in self.waiters.getReady(0, {}):
+			self.waiters.remove(waiter)
+		# Tried again & put back in the queue, in the other order
+		self.addWaiters(w2, w1)
+		self.waiters.wakeUpAll()
+		self.assertEqual(self.waiters.getReady(0, {}), [w1, w2])
+
+class RequestTestCase(unittest.TestCase):
+	"""
+	Runs requests through the SSM's message handling, against a single
+	node with one GPU. Clients are connected over socket pairs; what the
+	SSM sends them is read off the other end.
+	"""
+	def setUp(self):
+		node = vsapi.VizNode("node1", "localscheduler", 0)
+		node.addResource(vsapi.GPU(0, "node1", "Quadro FX 5800", None, False))
+		resIds = vsapi.ResourceIdMap()
+		self.ms = metascheduler.Metascheduler([node], [localscheduler.LocalScheduler(["node1"], "")], 0, resIds)
+		self.sysConfig = { 'nodes' : { 'node1' : node }, 'resource_groups' : {}, 'templates' : {} }
+		self.ssmState = {
+			'lastReservationId' : 0,
+			'resource_ids' : resIds,
+			'x_server_config' : {},
+			'allocations' : {},
+			'server_allocs' : {},
+			'alloc_x_clients' : {},
+			'x_waiters' : ssm.XStateWaiters(),
+			'alloc_waiters' : ssm.AllocationWaiters(),
+			'workers' : eventloop.WorkerPool(1),
+			'journal' : None,
+			'orphans' : {},
+			'orphan_timers' : eventloop.TimerQueue()
+		}
+		self.client_info = {}
+		self.poller = select.poll()
+		self.peers = {}
+
+	def tearDown(self):
+		self.ssmState['workers'].close()
+		self.ms.close()
+		for client in self.client_info.values():
+			client.socket.close()
+			self.peers[client.fd][0].close()
+
+	def connect(self, identity="<client/>"):
+		sock, peer = socket.socketpair()
+		client = ssm.createClient(sock)
+		self.assertTrue(ssm.authenticateClient(None, client, identity, self.ssmState))
+		self.client_info[client.fd] = client
+		self.peers[client.fd] = [peer, eventloop.MessageChannel(peer)]
+		self.poller.register(client.fd, eventloop.READ)
+		ssm.flushClient(client, self.poller)
+		return client
+
+	def send(self, client, message):
+		"""
+		Send a message to the SSM. Returns False if the SSM disconnects
+		the client.
+		"""
+		ret = ssm.processMessage(self.ms, domutil.parseDocument(message), self.sysConfig, self.ssmState, client)
+		ssm.flushClient(client, self.poller)
+		return ret
+
+	def runWorkers(self):
+		"""
+		Wait for the schedulers, and send out the deferred responses, like
+		the SSM's main loop does.
+		"""
+		for ret in self.ssmState['workers'].waitForAll():
+			if ret is not None:
+				client, response = ret
+				ssm.sendDeferredResponse(self.ms, self.ssmState, client, self.client_info, self.poller, response)
+				ssm.resumeClient(self.ms, self.sysConfig, self.ssmState, client, self.client_info, self.poller)
+		ssm.serveAllocationWaiters(self.ms, self.sysConfig, self.ssmState, self.client_info, self.poller)
+
+	def getResponses(self, client):
+		"""
+		Returns what the SSM sent to the client since the last call, as a
+		list of [request ID, status, allocation IDs] for each response
+		"""
+		ret = []
+		for message in self.peers[client.fd][1].readMessages():
+			rootNode = domutil.parseDocument(message).documentElement
+			responseNode = domutil.getChildNode(rootNode, "response")
+			status = int(domutil.getValue(domutil.getChildNode(responseNode, "status")))
+			allocIds = map(lambda x: int(domutil.getValue(x)), rootNode.getElementsByTagName("allocId"))
+			ret.append([rootNode.getAttribute("id"), status, allocIds])
+		return ret
+
+	def allocateRequest(self, waitTimeout=None, requestId=None, resources=None):
+		if resources is None:
+			resources = [vsapi.GPU()]
+		if requestId is None:
+			message = "<allocate>"
+		else:
+			message = '<allocate id="%s">'%(requestId)
+		message += "<resdesc><list>%s</list></resdesc>"%(''.join(map(lambda x: x.serializeToXML(), resources)))
+		if waitTimeout is not None:
+			message += "<wait><timeout>%d</timeout><priority>0</priority></wait>"%(waitTimeout)
+		return message + "</allocate>"
+
+class BatchedRequestTestCases(RequestTestCase):
+	def test_00000_single_request(self):
+		client = self.connect()
+		self.assertTrue(self.send(client, "<ssm><query_allocation/></ssm>"))
+		self.assertEqual(self.getResponses(client), [["", 0, []]])
+
+	def test_00010_responses_in_order(self):
+		client = self.connect()
+		self.assertTrue(self.send(client, "<ssm>%s<query_allocation/><query_allocation><allocId>5</allocId></query_allocation></ssm>"%(self.allocateRequest())))
+		# The allocation needs the scheduler. The other requests wait for it
+		self.assertEqual(self.getResponses(client), [])
+		self.assertEqual(len(client.requestQueue), 2)
+		self.runWorkers()
+		self.assertEqual(self.getResponses(client), [["", 0, [1]], ["", 0, [1]], ["", 1, []]])
+		self.assertEqual(client.requestQueue, [])
+
+	def test_00020_queued_behind_waiting_allocation(self):
+		client1 = self.connect()
+		client2 = self.connect()
+		self.send(client1, "<ssm>%s</ssm>"%(self.allocateRequest()))
+		self.runWorkers()
+		self.assertEqual(self.getResponses(client1), [["", 0, [1]]])
+
+		# The GPU is busy, so this waits
+		self.assertTrue(self.send(client2, "<ssm>%s<query_allocation/></ssm>"%(self.allocateRequest(100))))
+		self.runWorkers()
+		self.assertEqual(self.getResponses(client2), [])
+		self.assertTrue(client2.responsePending)
+		self.assertEqual(len(client2.requestQueue), 1)
+
+		# ... till it is freed
+		self.send(client1, "<ssm><deallocate><allocId>1</allocId></deallocate></ssm>")
+		self.runWorkers()
+		self.assertEqual(self.getResponses(client1), [["", 0, []]])
+		# The waiting allocation is tried again, and needs the scheduler too
+		self.runWorkers()
+		self.assertEqual(self.getResponses(client2), [["", 0, [2]], ["", 0, [2]]])
+		self.assertFalse(client2.responsePending)
+
+	def test_00030_bad_messages(self):
+		client = self.connect()
+		self.assertFalse(self.send(client, "<ssm/>"))
+		self.assertFalse(self.send(client, "<notssm><query_allocation/></notssm>"))
+		# Nothing in the message is acted upon if any request is unknown
+		self.assertFalse(self.send(client, "<ssm><query_allocation/><no_such_request/></ssm>"))
+		self.assertEqual(self.getResponses(client), [])
+
+	def test_00040_too_many_requests(self):
+		client = self.connect()
+		saved = ssm.g_max_queued_requests
+		ssm.g_max_queued_requests = 3
+		try:
+			self.assertTrue(self.send(client, "<ssm>%s</ssm>"%("<query_allocation/>"*3)))
+			self.assertEqual(len(self.getResponses(client)), 3)
+			self.assertFalse(self.send(client, "<ssm>%s</ssm>"%("<query_allocation/>"*4)))
+		finally:
+			ssm.g_max_queued_requests = saved
+
+class TaggedRequestTestCases(RequestTestCase):
+	def test_00000_handshake(self):
+		client = self.connect("<client><requestIds>1</requestIds></client>")
+		self.assertEqual(self.peers[client.fd][1].readMessages(), [vsapi.SSM_HANDSHAKE_REPLY])
+		# Older clients don't ask, and get nothing
+		client = self.connect()
+		self.assertEqual(self.peers[client.fd][1].readMessages(), [])
+
+	def test_00010_response_carries_id(self):
+		client = self.connect()
+		self.assertTrue(self.send(client, '<ssm><query_allocation id="3"/><query_allocation/><query_allocation id="12"/></ssm>'))
+		self.assertEqual(self.getResponses(client), [["3", 0, []], ["12", 0, []], ["", 0, []]])
+
+	def test_00020_not_held_up_by_deferred(self):
+		client = self.connect()
+		self.send(client, "<ssm>%s<query_allocation/></ssm>"%(self.allocateRequest()))
+		self.assertTrue(self.send(client, '<ssm><query_allocation id="7"/></ssm>'))
+		self.assertEqual(self.getResponses(client), [["7", 0, []]])
+		self.runWorkers()
+		self.assertEqual(self.getResponses(client), [["", 0, [1]], ["", 0, [1]]])
+
+	def test_00030_deferred_tagged_request(self):
+		client = self.connect()
+		self.send(client, '<ssm>%s</ssm>'%(self.allocateRequest()))
+		self.runWorkers()
+		self.assertEqual(self.getResponses(client), [["", 0, [1]]])
+
+		self.assertTrue(self.send(client, '<ssm>%s</ssm>'%(self.allocateRequest(100, "5"))))
+		self.runWorkers()
+		self.assertEqual(client.taggedRequests.keys(), ["5"])
+		self.assertFalse(client.responsePending)
+		# The ID is in use till the response goes out
+		self.assertFalse(self.send(client, '<ssm><query_allocation id="5"/></ssm>'))
+
+		self.assertTrue(self.send(client, '<ssm><deallocate id="6"><allocId>1</allocId></deallocate><query_allocation/></ssm>'))
+		# The allocation is gone right away; the scheduler cleans up later
+		self.assertEqual(self.getResponses(client), [["", 0, []]])
+		self.runWorkers()
+		self.runWorkers()
+		self.assertEqual(self.getResponses(client), [["6", 0, []], ["5", 0, [2]]])
+		self.assertEqual(client.taggedRequests, {})
+		# ... and may be used again after that
+		self.assertTrue(self.send(client, '<ssm><query_allocation id="5"/></ssm>'))
+		self.assertEqual(self.getResponses(client), [["5", 0, [2]]])
+
+	def test_00040_bad_ids(self):
+		for requestId in ["abc", "-1", "1.5", " 2"]:
+			client = self.connect()
+			self.assertFalse(self.send(client, '<ssm><query_allocation/><query_allocation id="%s"/></ssm>'%(requestId)))
+			self.assertEqual(self.getResponses(client), [])
+
+	def test_00050_duplicate_ids(self):
+		client = self.connect()
+		self.assertFalse(self.send(client, '<ssm><query_allocation id="1"/><query_allocation id="1"/></ssm>'))
+		self.assertEqual(self.getResponses(client), [])
+
+class AllocationWaitTestCases(RequestTestCase):
+	def setUp(self):
+		RequestTestCase.setUp(self)
+		self.holder = self.connect()
+		self.send(self.holder, "<ssm>%s</ssm>"%(self.allocateRequest()))
+		self.runWorkers()
+		self.assertEqual(self.getResponses(self.holder), [["", 0, [1]]])
+
+	def test_00000_busy_errors(self):
+		# Requests for resources which are in use fail as busy, whether
+		# they name the node or not
+		for resources in [[vsapi.GPU()], [vsapi.GPU(0)], [vsapi.GPU(hostName="node1")], [vsapi.GPU(0, "node1")]]:
+			try:
+				self.ms.allocate([resources], { 'uid' : 1000, 'gid' : 1000 }, [])
+			except vsapi.VizError, e:
+				self.assertEqual(e.errorCode, vsapi.VizError.RESOURCE_BUSY, "%s : %s"%(resources, str(e)))
+			else:
+				self.fail("%s was allocated"%(resources))
+
+	def test_00010_named_host_waits(self):
+		client = self.connect()
+		self.assertTrue(self.send(client, "<ssm>%s</ssm>"%(self.allocateRequest(100, resources=[vsapi.GPU(hostName="node1")]))))
+		self.runWorkers()
+		self.assertEqual(self.getResponses(client), [])
+		self.assertTrue(client.responsePending)
+		self.assertEqual(len(self.ssmState['alloc_waiters']), 1)
+
+		self.send(self.holder, "<ssm><deallocate><allocId>1</allocId></deallocate></ssm>")
+		self.runWorkers()
+		self.assertEqual(self.getResponses(self.holder), [["", 0, []]])
+		self.runWorkers()
+		self.assertEqual(self.getResponses(client), [["", 0, [2]]])
+		self.assertEqual(len(self.ssmState['alloc_waiters']), 0)
+
+	def test_00020_unknown_node_fails_right_away(self):
+		client = self.connect()
+		self.assertTrue(self.send(client, "<ssm>%s</ssm>"%(self.allocateRequest(100, resources=[vsapi.GPU(hostName="node9")]))))
+		self.assertEqual(self.getResponses(client), [["", 1, []]])
+		self.assertEqual(len(self.ssmState['alloc_waiters']), 0)
+
+if __name__ == '__main__':
+	tl = unittest.TestLoader()
+	suite1 = tl.loadTestsFromTestCase(AllocationWaitersTestCases)
+	suite2 = tl.loadTestsFromTestCase(BatchedRequestTestCases)
+	suite3 = tl.loadTestsFromTestCase(TaggedRequestTestCases)
+	suite4 = tl.loadTestsFromTestCase(AllocationWaitTestCases)
+
+	print 'Running allocation wait queue tests'
+	unittest.TextTestRunner().run(suite1)
+	print 'Running batched request tests'
+	unittest.TextTestRunner().run(suite2)
+	print 'Running tagged request tests'
+	unittest.TextTestRunner().run(suite3)
+	print 'Running allocation wait tests'
+	unittest.TextTestRunner().run(suite4)